@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+""" Micro-benchmark suite for the pogle_math primitives.
+
+Only the compiled pogle_math and pogle_bvh modules are imported (not the
+pogle package), so it runs on a headless box without OpenGL. All the inputs come from fixed
+seeds, and results are written as JSON (operations per second).
+
+Benchmarks of primitives missing from the measured build (older builds
+have no Matrix4x4Array, TransformGraph, pogle_bvh, ...) are skipped, and
+reported as missing on one side by --compare.
+
+Usage:
+    bench_math.py [--path BUILD_DIR] [--output FILE] [--filter SUBSTRING]
+    bench_math.py --compare BASE.json NEW.json [--threshold 0.05]
+
+--path selects the directory holding the pogle_math build to measure
+(defaults to the in-tree pogle/ directory), so two builds can be measured
+and then compared. --compare exits with status 1 if any benchmark got
+slower than the threshold.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SEED = 1234
+REPEAT = 5
+MIN_TIME = 0.2
+
+
+def _random_vectors(rnd, count, size=3):
+    return [[rnd.uniform(-10.0, 10.0) for _ in range(size)] for _ in range(count)]
+
+
+def _has(obj, *names):
+    return obj is not None and all(hasattr(obj, name) for name in names)
+
+
+def build_cases(pm, pb, seed):
+    """ Return a list of (name, items per call, callable). pb is None when
+    the build has no pogle_bvh.
+    """
+    rnd = random.Random(seed)
+    V = pm.Vector
+    M = pm.Matrix4x4
+
+    cases = []
+
+    # Matrix4x4
+    angles = _random_vectors(rnd, 2)
+    offsets = _random_vectors(rnd, 2)
+    rigid_a = M.translation(V(*offsets[0])) * M.rotation(V(*angles[0]))
+    rigid_b = M.translation(V(*offsets[1])) * M.rotation(V(*angles[1]))
+    affine = rigid_a * M.scale(V(2.0, 3.0, 0.5))
+    proj = M.perspective(60.0, 1.5, 0.1, 1000.0)
+    general = proj * affine
+
+    if _has(M, 'inverse'):
+        cases += [
+            ('matrix4x4.inverse.rigid', 1, lambda: rigid_a.inverse()),
+            ('matrix4x4.inverse.affine', 1, lambda: affine.inverse()),
+            ('matrix4x4.inverse.general', 1, lambda: general.inverse()),
+        ]
+    cases += [
+        ('matrix4x4.mul.rigid', 1, lambda: rigid_a * rigid_b),
+        ('matrix4x4.mul.general', 1, lambda: general * proj),
+        ('matrix4x4.lookat', 1, lambda: M.lookat(V(1.0, 2.0, 10.0), V(0.0, 0.0, 0.0))),
+        ('matrix4x4.perspective', 1, lambda: M.perspective(60.0, 1.5, 0.1, 1000.0)),
+        ('matrix4x4.rotation', 1, lambda: M.rotation(V(*angles[0]))),
+    ]
+
+    # Vector
+    va = V(*_random_vectors(rnd, 1)[0])
+    vb = V(*_random_vectors(rnd, 1)[0])
+
+    def normalize():
+        v = va * 1.0
+        v.normalize()
+
+    cases += [
+        ('vector.add', 1, lambda: va + vb),
+        ('vector.sub', 1, lambda: va - vb),
+        ('vector.mul', 1, lambda: va * 2.5),
+        ('vector.cross', 1, lambda: va.cross(vb)),
+        ('vector.dot', 1, lambda: va.dot(vb)),
+        ('vector.normalize', 1, normalize),
+    ]
+
+    # Transform hierarchies : set the root matrix, then read the world
+    # matrices back (this is what a frame does)
+    def deep_chain(depth):
+        root = pm.Transform()
+        tf = root
+        for _ in range(depth):
+            child = pm.Transform(M.translation(V(1.0, 0.0, 0.0)))
+            tf.add_child(child)
+            tf = child
+        return root, tf
+
+    deep_root, deep_leaf = deep_chain(1000)
+
+    def deep_update():
+        deep_root.matrix = rigid_a
+        deep_leaf.premul_matrix
+
+    wide_root = pm.Transform()
+    for offset in _random_vectors(rnd, 10000):
+        wide_root.add_child(pm.Transform(M.translation(V(*offset))))
+
+    def wide_update():
+        wide_root.matrix = rigid_a
+        wide_root.flush()
+
+    cases += [
+        ('transform.update.deep1000', 1000, deep_update),
+    ]
+    if _has(pm.Transform, 'flush'):
+        cases += [
+            ('transform.update.wide10000', 10000, wide_update),
+        ]
+
+    # Batched storage
+    count = 10000
+    box_mins = [[rnd.uniform(-10.0, 0.0) for _ in range(3)] for _ in range(count)]
+    box_maxs = [[rnd.uniform(0.0, 10.0) for _ in range(3)] for _ in range(count)]
+    box = pm.AABB(V(*box_mins[0]), V(*box_maxs[0]))
+
+    if _has(pm.AABB, 'transformed'):
+        cases += [
+            ('aabb.transformed', 1, lambda: box.transformed(affine)),
+        ]
+
+    if _has(pm, 'Matrix4x4Array'):
+        arr_a = pm.Matrix4x4Array.translation(_random_vectors(rnd, count))
+        arr_b = pm.Matrix4x4Array.rotation(_random_vectors(rnd, count))
+        out = pm.Matrix4x4Array(count)
+
+        if _has(pm, 'transform_aabbs'):
+            cases += [
+                ('transform_aabbs.10000', count, lambda: pm.transform_aabbs(box_mins, box_maxs, arr_a)),
+            ]
+        cases += [
+            ('matrix4x4array.mul.10000', count, lambda: pm.Matrix4x4Array.multiply(arr_a, arr_b, out)),
+            ('matrix4x4array.inverse.10000', count, lambda: arr_b.inverse()),
+        ]
+
+    if _has(pm, 'TransformGraph'):
+        graph = pm.TransformGraph(count)
+        handles = [graph.create()]
+        for i, offset in enumerate(_random_vectors(rnd, count - 1)):
+            parent = handles[rnd.randrange(len(handles))]
+            handles.append(graph.create(M.translation(V(*offset)), parent))
+
+        def graph_update():
+            handles[0].matrix = rigid_a
+            graph.update()
+
+        cases += [
+            ('transformgraph.update.10000', count, graph_update),
+        ]
+
+    # Spatial index
+    if _has(pb, 'BVH'):
+        count = 50000
+        bvh = pb.BVH(2 * count)
+        for i, center in enumerate(_random_vectors(rnd, count)):
+            center = [c * 100.0 for c in center]
+            bvh.insert(i, [c - 1.0 for c in center], [c + 1.0 for c in center])
+        bvh.rebuild()
+
+        if _has(pm, 'Frustum'):
+            frustum = pm.Frustum(proj * M.lookat(V(0.0, 0.0, 1000.0), V(0.0, 0.0, 0.0)))
+            cases += [
+                ('bvh.query_frustum.50000', count, lambda: bvh.query_frustum(frustum)),
+            ]
+        cases += [
+            ('bvh.raycast.50000', 1, lambda: bvh.raycast(V(-2000.0, 1.0, 2.0), V(1.0, 0.01, 0.02))),
+            ('bvh.rebuild.50000', count, bvh.rebuild),
+        ]
+
+    return cases
+
+
+def measure(func):
+    """ Best time per call, over REPEAT runs of at least MIN_TIME seconds """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        t = timer.timeit(number)
+        if t >= MIN_TIME:
+            break
+        number = max(number * 2, int(number * MIN_TIME / max(t, 1e-9)))
+
+    best = min([t] + timer.repeat(REPEAT - 1, number))
+    return best / number, number
+
+
+def run(args):
+    path = os.path.abspath(args.path or os.path.join(ROOT, 'pogle'))
+    sys.path.insert(0, path)
+    import pogle_math as pm
+    try:
+        import pogle_bvh as pb
+    except ImportError:
+        pb = None
+
+    results = {}
+    for name, items, func in build_cases(pm, pb, args.seed):
+        if args.filter and args.filter not in name:
+            continue
+        per_call, number = measure(func)
+        results[name] = {
+            'ops_per_sec': 1.0 / per_call,
+            'items_per_sec': items / per_call,
+            'number': number,
+            'repeat': REPEAT,
+        }
+        sys.stderr.write('%-32s %14.1f ops/s %16.1f items/s\n' % (
+            name, results[name]['ops_per_sec'], results[name]['items_per_sec']))
+
+    report = {
+        'meta': {
+            'module': os.path.abspath(pm.__file__),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+
+def compare(args):
+    with open(args.compare[0]) as f:
+        base = json.load(f)['results']
+    with open(args.compare[1]) as f:
+        new = json.load(f)['results']
+
+    regressions = 0
+    print('%-32s %14s %14s %8s' % ('benchmark', 'base ops/s', 'new ops/s', 'ratio'))
+    for name in sorted(set(base) & set(new)):
+        ratio = new[name]['ops_per_sec'] / base[name]['ops_per_sec']
+        flag = ''
+        if ratio < 1.0 - args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-32s %14.1f %14.1f %7.2fx%s' % (
+            name, base[name]['ops_per_sec'], new[name]['ops_per_sec'], ratio, flag))
+
+    for name in sorted(set(base) ^ set(new)):
+        print('%-32s missing in %s' % (name, 'new' if name in base else 'base'))
+
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pogle_math micro-benchmarks')
+    parser.add_argument('--path', help='directory containing the pogle_math build to measure')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--filter', help='only run benchmarks containing this string')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two JSON reports instead of running')
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(args))
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
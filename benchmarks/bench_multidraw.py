@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+""" Benchmark of the multi draw indirect path.
+
+Renders many distinct small meshes with a same material, first with one
+instanced call per geometry, then with their geometries in a shared
+GeometryArena and RenderPass.multidraw enabled (one call per material).
+Needs an OpenGL 4.3 context (hidden GLFW window); Mesa software rendering
+provides one with LIBGL_ALWAYS_SOFTWARE=1.
+"""
+
+import os
+import random
+import sys
+import time
+from ctypes import *
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pogle import *
+
+GEOMETRIES = 500
+NODES_PER_GEOMETRY = 4
+FRAMES = 50
+
+SHADER = """
+<shader version="430">
+    <vertex><![CDATA[
+        DEFINE_VAO_3D_INSTANCED
+
+        void main(void)
+        {
+            gl_Position = projMatrix * viewMatrix * instanceModelMatrix * position;
+        }
+    ]]></vertex>
+    <fragment><![CDATA[
+        out vec4 fragColor;
+
+        void main(void)
+        {
+            fragColor = vec4(1.0, 1.0, 1.0, 1.0);
+        }
+    ]]></fragment>
+</shader>
+"""
+
+
+def _random_tetrahedron(rnd, arena):
+    attribs = (DefaultAttribStruct * 4)()
+    for attrib in attribs:
+        attrib.position.x, attrib.position.y, attrib.position.z = \
+            [rnd.uniform(-0.5, 0.5) for _ in range(3)]
+    indices = (GLuint * 12)(0, 1, 2, 0, 3, 1, 0, 2, 3, 1, 3, 2)
+    return Geometry(attribs, indices, arena=arena)
+
+
+class Bench(GLFWRenderer):
+    def __init__(self):
+        super(Bench, self).__init__(format=(4, 3), hidden=True)
+
+    def _frame_time(self, multidraw):
+        rnd = random.Random(1234)
+        arena = GeometryArena() if multidraw else None
+        mat = Material(GLProgram(xml=SHADER))
+
+        scene = Scene()
+        scene.camera.view = Matrix4x4.lookat(Vector(0.0, 0.0, 60.0), Vector(0.0, 0.0, 0.0))
+        for _ in range(GEOMETRIES):
+            geom = _random_tetrahedron(rnd, arena)
+            for _ in range(NODES_PER_GEOMETRY):
+                pos = Vector(*[rnd.uniform(-20.0, 20.0) for _ in range(3)])
+                scene.add_node(GeometryNode(geom, Transform(Matrix4x4.translation(pos)), mat))
+
+        pass_ = RenderPass('bench', scene)
+        pass_.multidraw = multidraw
+        self.renderer.passes = [pass_]
+
+        self.renderer.render()
+        glFinish()
+        start = time.time()
+        for _ in range(FRAMES):
+            self.renderer.render()
+        glFinish()
+        return (time.time() - start) / FRAMES, Stats.drawcalls
+
+    def setup(self):
+        print('%d geometries, %d nodes' % (GEOMETRIES, GEOMETRIES * NODES_PER_GEOMETRY))
+        for name, multidraw in [('instanced per geometry', False), ('multi draw indirect', True)]:
+            frame, drawcalls = self._frame_time(multidraw)
+            print('%-24s %8.3f ms/frame %6d draw calls' % (name, frame * 1e3, drawcalls))
+
+    def run(self):
+        pass
+
+
+if __name__ == '__main__':
+    Bench().run()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+""" Micro-benchmark of Matrix4x4 uniform uploads.
+
+Compares the PyOpenGL path (glUniformMatrix4fv with a ctypes pointer built
+on every call, as done before), the cached data() pointer, and the native
+Matrix4x4.upload_uniform path. Needs a GL context (hidden GLFW window).
+"""
+
+import os
+import sys
+import timeit
+from ctypes import *
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pogle import *
+
+UPLOADS = 100000
+
+
+def _uncached_data(mat):
+    # What Matrix4x4.data() cost on every call before it was cached
+    return cast(cast(mat.data(), c_void_p).value, POINTER(c_float))
+
+
+class Bench(GLFWRenderer):
+    def __init__(self):
+        super(Bench, self).__init__(hidden=True)
+
+    def setup(self):
+        shader = self.renderer.default_mat._shader
+        shader.use()
+        loc = glGetUniformLocation(shader.prog, 'modelMatrix')
+        mat = Matrix4x4.translation(Vector(1.0, 2.0, 3.0))
+
+        cases = [
+            ('pyopengl + new ctypes pointer',
+             lambda: glUniformMatrix4fv(loc, 1, GL_FALSE, _uncached_data(mat))),
+            ('pyopengl + cached data()',
+             lambda: glUniformMatrix4fv(loc, 1, GL_FALSE, mat.data())),
+            ('native upload_uniform',
+             lambda: mat.upload_uniform(loc)),
+            ('GLProgram.set_uniform',
+             lambda: shader.set_uniform('modelMatrix', mat)),
+        ]
+
+        print('%d uploads per case' % UPLOADS)
+        for name, func in cases:
+            glFinish()
+            best = min(timeit.repeat(func, number=UPLOADS, repeat=3))
+            print('%-32s %8.3f us/upload' % (name, best * 1e6 / UPLOADS))
+
+        if not mat.upload_uniform(loc):
+            print('WARNING : native entry point not installed, upload_uniform fell back')
+
+    def run(self):
+        pass
+
+
+if __name__ == '__main__':
+    Bench().run()
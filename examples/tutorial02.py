@@ -14,25 +14,27 @@ class App(GLFWRenderer):
         self.shader_sdf = GLProgram(os.path.join(CWD, 'sdf.xml'))
         self.shader_shade = GLProgram(os.path.join(CWD, 'shade.xml'))
 
-        depth_tex = Texture2D(None, 512, 512, format='rgba32f', filtering='linear')
-        self.fbo = FBO(color0=depth_tex)
-
         self.scene = Scene()
         self.quad = GeometryNode(FullScreenQuad())
         self.scene.add_node(self.quad)
 
-        self.renderer.add_pass(RenderPass(
-            'depth-render-sdf', 
-            self.scene, 
+        # The graph allocates the intermediate target
+        self.graph = RenderGraph()
+        self.graph.declare('depth', format='rgba32f', filtering='linear')
+
+        self.graph.add_pass(RenderPass(
+            'depth-render-sdf',
+            self.scene,
             overridematerial=Material(self.shader_sdf),
-            fbo=self.fbo
-            ))
+            ), writes={'color0': 'depth'})
 
-        self.renderer.add_pass(RenderPass(
+        self.graph.add_pass(RenderPass(
             'render-shaded',
             self.scene,
-            overridematerial=Material(self.shader_shade, depth=depth_tex),
-            ))
+            overridematerial=Material(self.shader_shade),
+            ), reads={'depth': 'depth'}, writes={'color0': RenderGraph.BACKBUFFER})
+
+        self.renderer.graph = self.graph
 
         # self.renderer.add_pass(DefaultForwardRenderingPass(self.scene))
 
@@ -1,12 +1,26 @@
 from pogle_fbo import Texture3DAttachment, FBO
+from pogle_gputimer import GPUTimer
+from pogle_capture import CaptureQueue
+from pogle_cmdlist import CommandList
 from pogle_glprogram import GLProgram
 from pogle_gltexture import Texture1D, Texture2D, Texture3D, TextureBuffer
-from pogle_math import Vector, Rect, AABB, Sphere, Matrix4x4, Transform
-from pogle_mesh import Vec2, Vec3, DefaultAttribStruct, AttribStruct2D, VAO, GeometryNode, DynamicGeom, DynamicGeomRef, Geometry, FullScreenQuad
-from pogle_glfwrenderer import GLFWRenderer
+from pogle_math import Vector, Rect, AABB, Sphere, Frustum, Matrix4x4, Matrix4x4Array, Transform, TransformGraph
+from pogle_math import transform_aabbs, aabbs_to_spheres
+from pogle_math import pack_matrices, unpack_matrices, pack_transforms, unpack_transforms
+from pogle_bvh import BVH
+from pogle_mesh import Vec2, Vec3, DefaultAttribStruct, AttribStruct2D, VAO, GeometryNode, DynamicGeom, DynamicGeomRef, Geometry, GeometryArena, FullScreenQuad
+from pogle_headless import RenderJob, HeadlessRenderer
+try:
+    from pogle_glfwrenderer import GLFWRenderer
+except ImportError:
+    # No GLFW : headless rendering only
+    pass
 from pogle_renderer import Material, RenderPass, DefaultForwardRenderingPass, GLRenderer
+from pogle_rendergraph import RenderGraph
+from pogle_renderqueue import SortKeyLayout, RenderQueue
+from pogle_renderstate import RenderState
 from pogle_scene import Light, Camera, Scene, SceneNode
 
 # DEBUG PURPOSES
 from pogle_opengl import *
-from pogle_bufferobject import BufferObject
+from pogle_bufferobject import BufferObject, InstanceBuffer, UniformBufferObject
@@ -48,6 +48,17 @@ class BufferObject(object):
 		self.bind()
 		glBufferSubData(self.target, off, self.size, data)
 
+	def stream(self, data, hint=GL_STREAM_DRAW):
+		""" Upload a NumPy array at the start of the buffer, growing it if
+		needed
+		"""
+		self.bind()
+		if data.nbytes > self.size:
+			self.size = max(data.nbytes, self.size * 2)
+			glBufferData(self.target, self.size, None, hint)
+		if data.nbytes != 0:
+			glBufferSubData(self.target, 0, data.nbytes, data)
+
 	def map(self, mode):
 		self.bind()
 		if mode == 'r':
@@ -67,18 +78,60 @@ class BufferObject(object):
 			glBindBuffer(target, 0)
 			BufferObject._current[target] = None
 
-# class UniformBufferObject(BufferObject):
-# 	def __init__(self, type_, count):
-# 		self._client_mem_object = (type_ * count)()
-# 		self._count = 0
+class InstanceBuffer(BufferObject):
+	""" A vertex buffer of per-instance model matrices, streamed every frame
+	and read as a mat4 attribute (4 consecutive locations, one per column)
+	"""
+	# First attribute location of the instanceModelMatrix (see
+	# DEFINE_VAO_3D_INSTANCED)
+	LOCATION = 5
 
-# 		# Init the backing buffer
-# 		super(UniformBufferObject, self).__init__(GL_UNIFORM_BUFFER, self._client_mem_object, GL_DYNAMIC_DRAW)
-		
-# 	def append(self, data):
-# 		self._client_mem_object[self._count] = data
-# 		self._count += 1
-# 		self._changed = True
+	def __init__(self, capacity=64):
+		super(InstanceBuffer, self).__init__(GL_ARRAY_BUFFER, capacity * 64, GL_STREAM_DRAW)
+		self.count = 0
+
+	def upload(self, matrices):
+		""" Stream the matrices (a Matrix4x4Array), growing the buffer if
+		needed
+		"""
+		self.count = len(matrices)
+		self.stream(matrices.array)
+
+	def bind_attribs(self, location=LOCATION):
+		""" Point the instance matrix attributes of the bound VAO to this
+		buffer
+		"""
+		self.bind()
+		for col in range(4):
+			glEnableVertexAttribArray(location + col)
+			glVertexAttribPointer(location + col, 4, GL_FLOAT, GL_FALSE, 64, c_void_p(16 * col))
+			glVertexAttribDivisor(location + col, 1)
+
+class UniformBufferObject(BufferObject):
+	""" A uniform buffer mirroring an array of ctypes structures, which must
+	follow the std140 layout of the matching GLSL uniform block
+	"""
+	def __init__(self, type_, count=1):
+		self._client_mem_object = (type_ * count)()
+		self.binding = None
+
+		# Init the backing buffer
+		super(UniformBufferObject, self).__init__(GL_UNIFORM_BUFFER, self._client_mem_object, GL_DYNAMIC_DRAW)
+
+	def __getitem__(self, idx):
+		return self._client_mem_object[idx]
 
-# 	def clear(self):
-# 		self._count = 0
+	def __setitem__(self, idx, val):
+		self._client_mem_object[idx] = val
+
+	def upload(self):
+		""" Copy the client structures to the buffer
+		"""
+		self.fill(self._client_mem_object)
+
+	def bind_base(self, binding):
+		""" Bind the buffer to an uniform block binding point
+		"""
+		glBindBufferBase(GL_UNIFORM_BUFFER, binding, self.glid)
+		BufferObject._current[GL_UNIFORM_BUFFER] = self
+		self.binding = binding
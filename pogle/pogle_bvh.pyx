@@ -0,0 +1,727 @@
+import numpy as np
+
+from pogle_math import AABB, Vector
+
+cimport cython
+from libc.math cimport fabs, INFINITY
+
+__author__ = 'Clement JACOB'
+__copyright__ = "Copyright 2013, The Python OpenGL Engine"
+__license__ = "Closed Source"
+__version__ = "0.0.1"
+__email__ = "clems71@gmail.com"
+__status__ = "Prototype"
+
+cdef enum:
+	# Number of bins used by the SAH rebuild, per axis
+	BINS = 12
+
+	# Frustum classification of a box
+	OUTSIDE = 0
+	INTERSECTS = 1
+	INSIDE = 2
+
+cdef inline float _area(const float *mn, const float *mx) noexcept nogil:
+	""" Half the surface area of a box
+	"""
+	cdef float dx = mx[0] - mn[0]
+	cdef float dy = mx[1] - mn[1]
+	cdef float dz = mx[2] - mn[2]
+	return dx * dy + dy * dz + dz * dx
+
+cdef inline float _union_area(const float *amn, const float *amx,
+		const float *bmn, const float *bmx) noexcept nogil:
+	cdef float[3] mn, mx
+	cdef int r
+	for r in range(3):
+		mn[r] = amn[r] if amn[r] < bmn[r] else bmn[r]
+		mx[r] = amx[r] if amx[r] > bmx[r] else bmx[r]
+	return _area(mn, mx)
+
+cdef inline void _grow_box(float *mn, float *mx, const float *bmn, const float *bmx) noexcept nogil:
+	cdef int r
+	for r in range(3):
+		if bmn[r] < mn[r]:
+			mn[r] = bmn[r]
+		if bmx[r] > mx[r]:
+			mx[r] = bmx[r]
+
+cdef inline void _empty_box(float *mn, float *mx) noexcept nogil:
+	cdef int r
+	for r in range(3):
+		mn[r] = INFINITY
+		mx[r] = -INFINITY
+
+cdef inline int _frustum_classify(const float *planes, const float *mn, const float *mx) noexcept nogil:
+	cdef int p, inside = 1
+	cdef const float *pl
+	cdef float cx = (mn[0] + mx[0]) * 0.5, cy = (mn[1] + mx[1]) * 0.5, cz = (mn[2] + mx[2]) * 0.5
+	cdef float ex = (mx[0] - mn[0]) * 0.5, ey = (mx[1] - mn[1]) * 0.5, ez = (mx[2] - mn[2]) * 0.5
+	cdef float d, r
+	for p in range(6):
+		pl = planes + p * 4
+		d = pl[0] * cx + pl[1] * cy + pl[2] * cz + pl[3]
+		r = fabs(pl[0]) * ex + fabs(pl[1]) * ey + fabs(pl[2]) * ez
+		if d + r < 0.0:
+			return OUTSIDE
+		if d - r < 0.0:
+			inside = 0
+	return INSIDE if inside else INTERSECTS
+
+cdef inline int _overlaps(const float *amn, const float *amx, const float *bmn, const float *bmx) noexcept nogil:
+	cdef int r
+	for r in range(3):
+		if amn[r] > bmx[r] or amx[r] < bmn[r]:
+			return 0
+	return 1
+
+cdef inline int _sphere_overlaps(const float *c, float radius, const float *mn, const float *mx) noexcept nogil:
+	cdef float d, dist2 = 0.0
+	cdef int r
+	for r in range(3):
+		if c[r] < mn[r]:
+			d = mn[r] - c[r]
+		elif c[r] > mx[r]:
+			d = c[r] - mx[r]
+		else:
+			d = 0.0
+		dist2 += d * d
+	return dist2 <= radius * radius
+
+@cython.cdivision(True)
+cdef inline float _ray_box(const float *o, const float *inv, const float *mn, const float *mx,
+		float tmax) noexcept nogil:
+	""" Entry distance of the ray in the box (slab test), INFINITY if missed
+	"""
+	cdef float t0, t1, tmp, tmin = 0.0
+	cdef int r
+	for r in range(3):
+		t0 = (mn[r] - o[r]) * inv[r]
+		t1 = (mx[r] - o[r]) * inv[r]
+		if t0 > t1:
+			tmp = t0 ; t0 = t1 ; t1 = tmp
+		if t0 > tmin:
+			tmin = t0
+		if t1 < tmax:
+			tmax = t1
+		if tmin > tmax:
+			return INFINITY
+	return tmin
+
+cdef inline void _vec3(v, float *out) except *:
+	out[0] = v[0]
+	out[1] = v[1]
+	out[2] = v[2]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.final
+cdef class BVH(object):
+	""" A dynamic bounding volume hierarchy of axis aligned boxes, each one
+	associated to a (hashable) object.
+
+	Objects are inserted incrementally, choosing the sibling which minimizes
+	the surface area growth, and moving ones are refitted in place with
+	update(). As refits degrade the tree, rebuild() recomputes it from scratch
+	with a binned SAH split. cost() / rebuild_cost tells when it is worth it.
+
+	Nodes are stored in flat arrays, with one object per leaf. Queries are
+	native loops returning lists of objects.
+	"""
+	cdef float[:, ::1] _mins
+	cdef float[:, ::1] _maxs
+	cdef int[::1] _left          # -1 on leaves, next free node on free ones
+	cdef int[::1] _right
+	cdef int[::1] _parent
+	cdef int[::1] _item          # Item of a leaf, -1 on internal nodes
+	cdef int[::1] _stack
+	cdef int _root
+	cdef int _free
+	cdef int _capacity
+
+	cdef list _objects           # Item -> object (None for free items)
+	cdef int[::1] _leaf_of       # Item -> leaf node
+	cdef int[::1] _found
+	cdef list _free_items
+	cdef dict _ids               # Object -> item
+
+	cdef readonly float rebuild_cost
+	cdef double _internal_area   # Summed area of the internal nodes
+
+	def __init__(self, int capacity=64):
+		self._root = -1
+		self._free = -1
+		self._capacity = 0
+		self._objects = []
+		self._free_items = []
+		self._ids = {}
+		self._leaf_of = np.zeros(0, dtype=np.intc)
+		self._found = np.zeros(0, dtype=np.intc)
+		self.rebuild_cost = 0.0
+		self._internal_area = 0.0
+		self._grow(max(capacity, 1))
+
+	cdef _grow(self, int capacity):
+		""" Reallocate the node storage, linking the new nodes in the free list
+		"""
+		cdef int i, n = self._capacity
+		mins = np.zeros((capacity, 3), dtype=np.float32)
+		maxs = np.zeros((capacity, 3), dtype=np.float32)
+		left = np.full(capacity, -1, dtype=np.intc)
+		right = np.full(capacity, -1, dtype=np.intc)
+		parent = np.full(capacity, -1, dtype=np.intc)
+		item = np.full(capacity, -1, dtype=np.intc)
+
+		if n != 0:
+			mins[:n] = self._mins
+			maxs[:n] = self._maxs
+			left[:n] = self._left
+			right[:n] = self._right
+			parent[:n] = self._parent
+			item[:n] = self._item
+
+		self._mins = mins
+		self._maxs = maxs
+		self._left = left
+		self._right = right
+		self._parent = parent
+		self._item = item
+		self._stack = np.empty(capacity + 1, dtype=np.intc)
+		self._capacity = capacity
+
+		for i in range(n, capacity - 1):
+			self._left[i] = i + 1
+		self._left[capacity - 1] = self._free
+		self._free = n
+
+	cdef int _alloc_node(self) except -1:
+		cdef int node
+		if self._free == -1:
+			self._grow(self._capacity * 2)
+		node = self._free
+		self._free = self._left[node]
+		self._left[node] = -1
+		self._right[node] = -1
+		self._parent[node] = -1
+		self._item[node] = -1
+		return node
+
+	cdef void _free_node(self, int node) noexcept:
+		self._left[node] = self._free
+		self._item[node] = -1
+		self._free = node
+
+	cdef int _alloc_item(self, obj) except -1:
+		cdef int item
+		if len(self._free_items) != 0:
+			item = self._free_items.pop()
+			self._objects[item] = obj
+		else:
+			item = len(self._objects)
+			self._objects.append(obj)
+			if item >= self._leaf_of.shape[0]:
+				leaf_of = np.empty(max(2 * item, 64), dtype=np.intc)
+				leaf_of[:item] = self._leaf_of[:item]
+				self._leaf_of = leaf_of
+				self._found = np.empty(leaf_of.shape[0], dtype=np.intc)
+		self._ids[obj] = item
+		return item
+
+	cdef void _refit_up(self, int node) noexcept nogil:
+		""" Recompute the boxes of node and its ancestors from their children
+		"""
+		cdef int l, r, k
+		while node != -1:
+			l = self._left[node]
+			r = self._right[node]
+			self._internal_area -= _area(&self._mins[node, 0], &self._maxs[node, 0])
+			for k in range(3):
+				self._mins[node, k] = min(self._mins[l, k], self._mins[r, k])
+				self._maxs[node, k] = max(self._maxs[l, k], self._maxs[r, k])
+			self._internal_area += _area(&self._mins[node, 0], &self._maxs[node, 0])
+			node = self._parent[node]
+
+	cdef float _descend_cost(self, int child, int leaf) noexcept nogil:
+		cdef float cost = _union_area(&self._mins[child, 0], &self._maxs[child, 0],
+			&self._mins[leaf, 0], &self._maxs[leaf, 0])
+		if self._left[child] != -1:
+			cost -= _area(&self._mins[child, 0], &self._maxs[child, 0])
+		return cost
+
+	cdef int _insert_leaf(self, int leaf) except -1:
+		cdef int node, sibling, old_parent, l, r, k
+		cdef float area, combined, cost, inherit, cost_l, cost_r
+
+		if self._root == -1:
+			self._root = leaf
+			self._parent[leaf] = -1
+			return 0
+
+		# Allocated first : growing replaces the arrays
+		node = self._alloc_node()
+
+		# Descend towards the sibling minimizing the area growth
+		sibling = self._root
+		while self._left[sibling] != -1:
+			l = self._left[sibling]
+			r = self._right[sibling]
+			area = _area(&self._mins[sibling, 0], &self._maxs[sibling, 0])
+			combined = _union_area(&self._mins[sibling, 0], &self._maxs[sibling, 0],
+				&self._mins[leaf, 0], &self._maxs[leaf, 0])
+			cost = 2.0 * combined
+			inherit = 2.0 * (combined - area)
+			cost_l = self._descend_cost(l, leaf) + inherit
+			cost_r = self._descend_cost(r, leaf) + inherit
+			if cost < cost_l and cost < cost_r:
+				break
+			sibling = l if cost_l < cost_r else r
+
+		old_parent = self._parent[sibling]
+		self._parent[node] = old_parent
+		if old_parent == -1:
+			self._root = node
+		elif self._left[old_parent] == sibling:
+			self._left[old_parent] = node
+		else:
+			self._right[old_parent] = node
+
+		self._left[node] = sibling
+		self._right[node] = leaf
+		self._parent[sibling] = node
+		self._parent[leaf] = node
+		for k in range(3):
+			self._mins[node, k] = min(self._mins[sibling, k], self._mins[leaf, k])
+			self._maxs[node, k] = max(self._maxs[sibling, k], self._maxs[leaf, k])
+		self._internal_area += _area(&self._mins[node, 0], &self._maxs[node, 0])
+		self._refit_up(old_parent)
+		return 0
+
+	cdef void _remove_leaf(self, int leaf) noexcept:
+		cdef int parent = self._parent[leaf]
+		cdef int grand_parent, sibling
+
+		if parent == -1:
+			self._root = -1
+			return
+
+		self._internal_area -= _area(&self._mins[parent, 0], &self._maxs[parent, 0])
+		grand_parent = self._parent[parent]
+		sibling = self._left[parent] if self._right[parent] == leaf else self._right[parent]
+		self._parent[sibling] = grand_parent
+		if grand_parent == -1:
+			self._root = sibling
+		else:
+			if self._left[grand_parent] == parent:
+				self._left[grand_parent] = sibling
+			else:
+				self._right[grand_parent] = sibling
+			self._refit_up(grand_parent)
+		self._free_node(parent)
+
+	def __len__(self):
+		return len(self._ids)
+
+	def __contains__(self, obj):
+		return obj in self._ids
+
+	def objects(self):
+		return list(self._ids)
+
+	@property
+	def bounds(self):
+		""" The AABB enclosing everything, None if empty
+		"""
+		if self._root == -1:
+			return None
+		mn = self._mins[self._root]
+		mx = self._maxs[self._root]
+		return AABB(Vector(mn[0], mn[1], mn[2]), Vector(mx[0], mx[1], mx[2]))
+
+	def insert(self, obj, mn, mx):
+		""" Add obj, bounded by the box (mn, mx)
+		"""
+		cdef int leaf, item
+		if obj in self._ids:
+			raise ValueError('The object is already in the BVH')
+
+		leaf = self._alloc_node()
+		item = self._alloc_item(obj)
+		self._leaf_of[item] = leaf
+		self._item[leaf] = item
+		_vec3(mn, &self._mins[leaf, 0])
+		_vec3(mx, &self._maxs[leaf, 0])
+		self._insert_leaf(leaf)
+
+	def update(self, obj, mn, mx):
+		""" Set the new box of obj, and refit its ancestors
+		"""
+		cdef int leaf = self._leaf_of[self._ids[obj]]
+		_vec3(mn, &self._mins[leaf, 0])
+		_vec3(mx, &self._maxs[leaf, 0])
+		self._refit_up(self._parent[leaf])
+
+	def remove(self, obj):
+		cdef int item = self._ids.pop(obj)
+		cdef int leaf = self._leaf_of[item]
+		self._remove_leaf(leaf)
+		self._free_node(leaf)
+		self._objects[item] = None
+		self._free_items.append(item)
+
+	def clear(self):
+		self._root = -1
+		self._capacity = 0
+		self._free = -1
+		self._objects = []
+		self._free_items = []
+		self._ids = {}
+		self.rebuild_cost = 0.0
+		self._internal_area = 0.0
+		self._grow(64)
+
+	cdef double _summed_area(self) noexcept nogil:
+		""" The summed area of the internal nodes, walking the whole tree
+		"""
+		cdef int top = 0, node
+		cdef double total = 0.0
+		if self._root == -1:
+			return 0.0
+
+		self._stack[top] = self._root
+		top += 1
+		while top != 0:
+			top -= 1
+			node = self._stack[top]
+			if self._left[node] == -1:
+				continue
+			total += _area(&self._mins[node, 0], &self._maxs[node, 0])
+			self._stack[top] = self._left[node]
+			self._stack[top + 1] = self._right[node]
+			top += 2
+		return total
+
+	def cost(self):
+		""" SAH cost of the tree : the summed area of the internal nodes,
+		relative to the area of the root. The summed area is kept up to date
+		by the insertions, removals and refits, so this is O(1).
+		"""
+		cdef float root_area
+		if self._root == -1 or self._left[self._root] == -1:
+			return 0.0
+
+		root_area = _area(&self._mins[self._root, 0], &self._maxs[self._root, 0])
+		if root_area <= 0.0:
+			return 0.0
+		return max(self._internal_area, 0.0) / root_area
+
+	def rebuild(self):
+		""" Rebuild the whole tree, top-down with a binned SAH split
+		"""
+		cdef int n = len(self._ids)
+		cdef int k, i
+
+		items = np.empty(n, dtype=np.intc)
+		mins = np.empty((n, 3), dtype=np.float32)
+		maxs = np.empty((n, 3), dtype=np.float32)
+		cdef int[::1] it = items
+		cdef float[:, ::1] mn = mins
+		cdef float[:, ::1] mx = maxs
+		for k, i in enumerate(self._ids.itervalues()):
+			it[k] = i
+			mn[k, :] = self._mins[self._leaf_of[i], :]
+			mx[k, :] = self._maxs[self._leaf_of[i], :]
+
+		self._capacity = 0
+		self._free = -1
+		self._root = -1
+		self._grow(max(2 * n, 64))
+		self._internal_area = 0.0
+		if n == 0:
+			self.rebuild_cost = 0.0
+			return
+
+		cdef int[::1] order = np.arange(n, dtype=np.intc)
+		cdef float[:, ::1] centroids = (mins + maxs) * 0.5
+		cdef int[:, ::1] tasks = np.empty((2 * n, 3), dtype=np.intc)
+		with nogil:
+			self._build(it, mn, mx, centroids, order, tasks)
+			# Exact again, whatever the rounding of the incremental updates
+			self._internal_area = self._summed_area()
+		self.rebuild_cost = self.cost()
+
+	@cython.cdivision(True)
+	cdef void _build(self, int[::1] items, float[:, ::1] mins, float[:, ::1] maxs,
+			float[:, ::1] centroids, int[::1] order, int[:, ::1] tasks) noexcept nogil:
+		cdef int top = 0, used = 1
+		cdef int node, start, end, i, j, k, a, b, axis, split, mid, tmp
+		cdef int best_axis, best_split
+		cdef float best_cost, cost, extent, scale
+		cdef float[3] cmin, cmax
+		cdef int[BINS] counts
+		cdef float[BINS * 3] bin_mn
+		cdef float[BINS * 3] bin_mx
+		cdef float[BINS] right_area
+		cdef int[BINS] right_count
+		cdef float[3] acc_mn, acc_mx
+		cdef int acc_count
+
+		self._root = 0
+		tasks[0, 0] = 0
+		tasks[0, 1] = 0
+		tasks[0, 2] = items.shape[0]
+		top = 1
+
+		while top != 0:
+			top -= 1
+			node = tasks[top, 0]
+			start = tasks[top, 1]
+			end = tasks[top, 2]
+
+			_empty_box(&self._mins[node, 0], &self._maxs[node, 0])
+			_empty_box(cmin, cmax)
+			for i in range(start, end):
+				k = order[i]
+				_grow_box(&self._mins[node, 0], &self._maxs[node, 0], &mins[k, 0], &maxs[k, 0])
+				_grow_box(cmin, cmax, &centroids[k, 0], &centroids[k, 0])
+
+			if end - start == 1:
+				k = order[start]
+				self._item[node] = items[k]
+				self._leaf_of[items[k]] = node
+				self._left[node] = -1
+				self._right[node] = -1
+				continue
+
+			# Evaluate BINS - 1 split planes per axis
+			best_axis = -1
+			best_split = 0
+			best_cost = INFINITY
+			for axis in range(3):
+				extent = cmax[axis] - cmin[axis]
+				if extent <= 0.0:
+					continue
+				scale = BINS / extent
+				for b in range(BINS):
+					counts[b] = 0
+					_empty_box(&bin_mn[b * 3], &bin_mx[b * 3])
+				for i in range(start, end):
+					k = order[i]
+					b = <int>((centroids[k, axis] - cmin[axis]) * scale)
+					if b >= BINS:
+						b = BINS - 1
+					counts[b] += 1
+					_grow_box(&bin_mn[b * 3], &bin_mx[b * 3], &mins[k, 0], &maxs[k, 0])
+
+				_empty_box(acc_mn, acc_mx)
+				acc_count = 0
+				for b in range(BINS - 1, 0, -1):
+					_grow_box(acc_mn, acc_mx, &bin_mn[b * 3], &bin_mx[b * 3])
+					acc_count += counts[b]
+					right_area[b] = _area(acc_mn, acc_mx) if acc_count != 0 else 0.0
+					right_count[b] = acc_count
+
+				_empty_box(acc_mn, acc_mx)
+				acc_count = 0
+				for b in range(BINS - 1):
+					_grow_box(acc_mn, acc_mx, &bin_mn[b * 3], &bin_mx[b * 3])
+					acc_count += counts[b]
+					if acc_count == 0 or right_count[b + 1] == 0:
+						continue
+					cost = acc_count * _area(acc_mn, acc_mx) + right_count[b + 1] * right_area[b + 1]
+					if cost < best_cost:
+						best_cost = cost
+						best_axis = axis
+						best_split = b + 1
+
+			# Partition the range around the best plane
+			mid = start
+			if best_axis != -1:
+				scale = BINS / (cmax[best_axis] - cmin[best_axis])
+				j = end - 1
+				while mid <= j:
+					k = order[mid]
+					b = <int>((centroids[k, best_axis] - cmin[best_axis]) * scale)
+					if b >= BINS:
+						b = BINS - 1
+					if b < best_split:
+						mid += 1
+					else:
+						tmp = order[j] ; order[j] = order[mid] ; order[mid] = tmp
+						j -= 1
+
+			# Coincident centroids : any split will do
+			if mid == start or mid == end:
+				mid = (start + end) // 2
+
+			a = used
+			used += 2
+			self._left[node] = a
+			self._right[node] = a + 1
+			self._item[node] = -1
+			self._parent[a] = node
+			self._parent[a + 1] = node
+
+			tasks[top, 0] = a
+			tasks[top, 1] = start
+			tasks[top, 2] = mid
+			tasks[top + 1, 0] = a + 1
+			tasks[top + 1, 1] = mid
+			tasks[top + 1, 2] = end
+			top += 2
+
+		# Internal nodes boxes were computed top-down : leaves are exact, so
+		# are their unions
+		self._parent[0] = -1
+
+		# The remaining nodes form the free list
+		for i in range(used, self._capacity - 1):
+			self._left[i] = i + 1
+		if used < self._capacity:
+			self._left[self._capacity - 1] = -1
+			self._free = used
+		else:
+			self._free = -1
+
+	cdef list _results(self, int count):
+		return [self._objects[self._found[i]] for i in range(count)]
+
+	def query_aabb(self, mn, mx):
+		""" Objects whose box overlaps the box (mn, mx)
+		"""
+		cdef float[3] bmn, bmx
+		cdef int top = 0, count = 0, node
+		_vec3(mn, bmn)
+		_vec3(mx, bmx)
+		if self._root == -1:
+			return []
+
+		with nogil:
+			self._stack[top] = self._root
+			top += 1
+			while top != 0:
+				top -= 1
+				node = self._stack[top]
+				if not _overlaps(&self._mins[node, 0], &self._maxs[node, 0], bmn, bmx):
+					continue
+				if self._left[node] == -1:
+					self._found[count] = self._item[node]
+					count += 1
+				else:
+					self._stack[top] = self._left[node]
+					self._stack[top + 1] = self._right[node]
+					top += 2
+		return self._results(count)
+
+	def query_sphere(self, center, float radius):
+		""" Objects whose box overlaps the sphere
+		"""
+		cdef float[3] c
+		cdef int top = 0, count = 0, node
+		_vec3(center, c)
+		if self._root == -1:
+			return []
+
+		with nogil:
+			self._stack[top] = self._root
+			top += 1
+			while top != 0:
+				top -= 1
+				node = self._stack[top]
+				if not _sphere_overlaps(c, radius, &self._mins[node, 0], &self._maxs[node, 0]):
+					continue
+				if self._left[node] == -1:
+					self._found[count] = self._item[node]
+					count += 1
+				else:
+					self._stack[top] = self._left[node]
+					self._stack[top + 1] = self._right[node]
+					top += 2
+		return self._results(count)
+
+	def query_frustum(self, frustum):
+		""" Objects whose box is (potentially) visible in the Frustum. The
+		subtrees fully inside it are gathered without further tests.
+		"""
+		cdef float[24] planes
+		cdef int top = 0, count = 0, node, i, cls
+		for i, val in enumerate(frustum.planes.ravel()):
+			planes[i] = val
+		if self._root == -1:
+			return []
+
+		# Fully inside nodes are pushed as ~node
+		with nogil:
+			self._stack[top] = self._root
+			top += 1
+			while top != 0:
+				top -= 1
+				node = self._stack[top]
+				if node < 0:
+					node = ~node
+					cls = INSIDE
+				else:
+					cls = _frustum_classify(planes, &self._mins[node, 0], &self._maxs[node, 0])
+					if cls == OUTSIDE:
+						continue
+
+				if self._left[node] == -1:
+					self._found[count] = self._item[node]
+					count += 1
+				elif cls == INSIDE:
+					self._stack[top] = ~self._left[node]
+					self._stack[top + 1] = ~self._right[node]
+					top += 2
+				else:
+					self._stack[top] = self._left[node]
+					self._stack[top + 1] = self._right[node]
+					top += 2
+		return self._results(count)
+
+	@cython.cdivision(True)
+	def raycast(self, origin, direction, float max_distance=INFINITY):
+		""" Return (object, distance) for the closest box hit by the ray, or
+		None. The distance is the one to the box, in direction units.
+		"""
+		cdef float[3] o, d, inv
+		cdef int top = 0, node, l, r, best = -1
+		cdef float best_t = max_distance, tl, tr, t
+		cdef int i
+		_vec3(origin, o)
+		_vec3(direction, d)
+		for i in range(3):
+			inv[i] = 1.0 / d[i]
+		if self._root == -1:
+			return None
+
+		with nogil:
+			if _ray_box(o, inv, &self._mins[self._root, 0], &self._maxs[self._root, 0], best_t) != INFINITY:
+				self._stack[top] = self._root
+				top += 1
+			while top != 0:
+				top -= 1
+				node = self._stack[top]
+				if self._left[node] == -1:
+					t = _ray_box(o, inv, &self._mins[node, 0], &self._maxs[node, 0], best_t)
+					if t <= best_t:
+						best_t = t
+						best = self._item[node]
+					continue
+
+				# Nearest child last, so that it is visited first
+				l = self._left[node]
+				r = self._right[node]
+				tl = _ray_box(o, inv, &self._mins[l, 0], &self._maxs[l, 0], best_t)
+				tr = _ray_box(o, inv, &self._mins[r, 0], &self._maxs[r, 0], best_t)
+				if tl > tr:
+					l, r = r, l
+					tl, tr = tr, tl
+				if tr != INFINITY:
+					self._stack[top] = r
+					top += 1
+				if tl != INFINITY:
+					self._stack[top] = l
+					top += 1
+
+		if best == -1:
+			return None
+		return self._objects[best], best_t
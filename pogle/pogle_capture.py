@@ -0,0 +1,203 @@
+# Python Imaging Library : PIL
+from PIL import Image
+
+from ctypes import *
+import logging
+import Queue
+import threading
+
+import OpenEXR
+import numpy as np
+
+from pogle_opengl import *
+from pogle_bufferobject import BufferObject
+from pogle_fbo import FBO
+
+__author__ = 'Clement JACOB'
+__copyright__ = "Copyright 2013, The Python OpenGL Engine"
+__license__ = "Closed Source"
+__version__ = "0.0.1"
+__email__ = "clems71@gmail.com"
+__status__ = "Prototype"
+
+
+class _Capture(object):
+    def __init__(self, pbo, path, callback, width, height, exr, frame):
+        self.pbo = pbo
+        self.path = path
+        self.callback = callback
+        self.width = width
+        self.height = height
+        self.exr = exr
+        self.frame = frame
+
+
+def _save(path, data, width, height, exr):
+    """ Encode and write a captured frame (run by the workers)
+    """
+    if exr:
+        pixels = np.flipud(np.frombuffer(data, dtype=np.float32).reshape((height, width, 4)))
+        f = OpenEXR.OutputFile(path, OpenEXR.Header(width, height))
+        f.writePixels(dict((chan, np.ascontiguousarray(pixels[:, :, i]).tobytes())
+                           for i, chan in enumerate('RGB')))
+        f.close()
+    else:
+        im = Image.frombuffer("RGBA", (width, height), data)
+        im.save(path)
+
+
+class CaptureQueue(object):
+    """ Asynchronous captures of the render passes results.
+
+    Pixels are read back into a ring of pixel pack buffers, which are only
+    mapped latency frames later, once the GPU is done with them. Encoding
+    (PNG, or EXR for .exr paths) and file writing happen on worker threads,
+    and the callbacks are then called on the render thread, by update().
+    """
+    def __init__(self, latency=2, ring_size=4, workers=2):
+        """
+        latency -- Frames between a read back and its mapping
+        ring_size -- Pixel pack buffers in flight at most. When they are all
+                     used, the oldest capture is mapped early (stalling).
+        workers -- Encoding threads
+        """
+        self.latency = latency
+        self.ring_size = ring_size
+        self.workers = workers
+
+        self._frame = 0
+        self._free = []
+        self._pbo_count = 0
+        self._inflight = []
+
+        self._jobs = Queue.Queue()
+        self._done = Queue.Queue()
+        self._threads = []
+
+    def _start_workers(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                return
+
+            path, data, width, height, exr, callback = job
+            try:
+                _save(path, data, width, height, exr)
+            except Exception:
+                logging.exception('Could not save the capture \'%s\'' % path)
+            self._done.put(callback)
+            self._jobs.task_done()
+
+    def _pbo(self, size):
+        if self._free:
+            pbo = self._free.pop()
+        elif self._pbo_count < self.ring_size:
+            pbo = BufferObject(GL_PIXEL_PACK_BUFFER, size, GL_STREAM_READ)
+            self._pbo_count += 1
+        else:
+            self._complete(self._inflight.pop(0))
+            pbo = self._free.pop()
+
+        if pbo.size < size:
+            pbo.bind()
+            glBufferData(GL_PIXEL_PACK_BUFFER, size, None, GL_STREAM_READ)
+            pbo.size = size
+        return pbo
+
+    def request(self, renderer, pass_, path, callback=None):
+        """ Start the read back of the last rendering of a pass
+        """
+        if not self._threads:
+            self._start_workers()
+
+        fbo = renderer.target_fbo(pass_)
+        if fbo is None:
+            FBO.bind_default()
+            width, height = renderer.width, renderer.height
+        else:
+            fbo.bind()
+            width, height = fbo.width, fbo.height
+
+        exr = path is not None and path.lower().endswith('.exr')
+        pbo = self._pbo(width * height * (16 if exr else 4))
+
+        pbo.bind()
+        glReadPixels(0, 0, width, height, GL_RGBA, GL_FLOAT if exr else GL_UNSIGNED_BYTE, c_void_p(0))
+        BufferObject.unbind(GL_PIXEL_PACK_BUFFER)
+
+        self._inflight.append(_Capture(pbo, path, callback, width, height, exr, self._frame))
+        logging.info('Captured a frame in the render pass \'%s\'' % pass_.name)
+
+    def readback(self, renderer, pass_, callback):
+        """ Like request, but the pixels are handed to callback as an
+        (height, width, 4) uint8 array (top row first) instead of being saved
+        """
+        self.request(renderer, pass_, None, callback)
+
+    def _complete(self, capture):
+        """ Copy the pixels out of the buffer, and hand them to the workers
+        """
+        size = capture.width * capture.height * (16 if capture.exr else 4)
+        ptr = capture.pbo.map('r')
+        data = string_at(ptr, size)
+        capture.pbo.unmap()
+        BufferObject.unbind(GL_PIXEL_PACK_BUFFER)
+        self._free.append(capture.pbo)
+
+        if capture.path is None:
+            pixels = np.frombuffer(data, dtype=np.uint8).reshape((capture.height, capture.width, 4))
+            callback = capture.callback
+            self._done.put(lambda: callback(pixels[::-1]))
+            return
+
+        self._jobs.put((capture.path, data, capture.width, capture.height,
+                        capture.exr, capture.callback))
+
+    def _call_callbacks(self):
+        while True:
+            try:
+                callback = self._done.get_nowait()
+            except Queue.Empty:
+                return
+            if callback:
+                callback()
+
+    def update(self):
+        """ Called by the renderer once per frame : map the old enough read
+        backs, and call the callbacks of the saved captures
+        """
+        self._frame += 1
+        while self._inflight and self._frame - self._inflight[0].frame >= self.latency:
+            self._complete(self._inflight.pop(0))
+        self._call_callbacks()
+
+    def finish(self):
+        """ Wait for all the pending captures to be saved
+        """
+        while self._inflight:
+            self._complete(self._inflight.pop(0))
+        self._jobs.join()
+        self._call_callbacks()
+
+    def close(self):
+        """ Finish the pending captures, and stop the workers
+        """
+        self.finish()
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __len__(self):
+        """ The captures not saved yet
+        """
+        return len(self._inflight) + self._jobs.unfinished_tasks
@@ -0,0 +1,208 @@
+import numpy as np
+
+from pogle_math import Matrix4x4Array
+
+cimport cython
+
+__author__ = 'Clement JACOB'
+__copyright__ = "Copyright 2013, The Python OpenGL Engine"
+__license__ = "Closed Source"
+__version__ = "0.0.1"
+__email__ = "clems71@gmail.com"
+__status__ = "Prototype"
+
+cdef enum:
+	# Command opcodes. A command is a row of 5 integers : the opcode and up
+	# to 4 arguments.
+	OP_CALL = 0         # Python callable index
+	OP_BIND_VAO = 1     # VAO name
+	OP_MATRIX = 2       # Uniform location, matrix slot
+	OP_DRAW = 3         # Mode, index count, byte offset, base vertex
+
+	GL_UNSIGNED_INT = 0x1405
+
+# Native GL entry points used by the replay, installed by the renderer once
+# a context exists
+ctypedef void (*bind_vertex_array_t)(unsigned int array) noexcept nogil
+ctypedef void (*uniform_matrix4fv_t)(int location, int count, unsigned char transpose, const float *value) noexcept nogil
+ctypedef void (*draw_elements_t)(unsigned int mode, int count, unsigned int type, const void *indices) noexcept nogil
+ctypedef void (*draw_elements_base_vertex_t)(unsigned int mode, int count, unsigned int type, const void *indices, int basevertex) noexcept nogil
+
+cdef bind_vertex_array_t _glBindVertexArray = NULL
+cdef uniform_matrix4fv_t _glUniformMatrix4fv = NULL
+cdef draw_elements_t _glDrawElements = NULL
+cdef draw_elements_base_vertex_t _glDrawElementsBaseVertex = NULL
+
+def set_command_procs(size_t bind_vertex_array, size_t uniform_matrix4fv,
+		size_t draw_elements, size_t draw_elements_base_vertex):
+	""" Install the native entry points of glBindVertexArray,
+	glUniformMatrix4fv, glDrawElements and glDrawElementsBaseVertex (0
+	disables the native commands)
+	"""
+	global _glBindVertexArray, _glUniformMatrix4fv, _glDrawElements, _glDrawElementsBaseVertex
+	_glBindVertexArray = <bind_vertex_array_t>bind_vertex_array
+	_glUniformMatrix4fv = <uniform_matrix4fv_t>uniform_matrix4fv
+	_glDrawElements = <draw_elements_t>draw_elements
+	_glDrawElementsBaseVertex = <draw_elements_base_vertex_t>draw_elements_base_vertex
+
+def native_commands():
+	""" Whether the native commands can be replayed
+	"""
+	return _glBindVertexArray != NULL and _glUniformMatrix4fv != NULL and \
+		_glDrawElements != NULL and _glDrawElementsBaseVertex != NULL
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.final
+cdef class CommandList(object):
+	""" A recorded sequence of GL commands, replayed in a native loop.
+
+	Commands are either native (VAO binds, model matrix uploads, indexed
+	draws) or calls to Python callables, for everything else. The matrices
+	are read from the recorded transforms, and patch() only copies the ones
+	whose transform changed.
+
+	Commands are appended with call(), bind_vao(), uniform_matrix() and
+	draw_elements(), then finish() must be called before replaying.
+	"""
+	cdef list _pending
+	cdef long long[:, ::1] _ops
+	cdef readonly list calls
+	cdef list _transforms
+	cdef readonly object matrices
+	cdef float[:, :, ::1] _mats
+	cdef dict _slots
+	cdef set _moved
+	cdef object _graph
+	cdef unsigned int _stamp
+	cdef readonly int draw_count
+	cdef readonly int matrix_count
+	cdef int _native_count
+
+	def __init__(self):
+		self._pending = []
+		self.calls = []
+		self._transforms = []
+		self._slots = {}
+		self.draw_count = 0
+		self.matrix_count = 0
+		self._native_count = 0
+
+	def call(self, func):
+		""" Call func (with no argument) at replay
+		"""
+		self._pending.append((OP_CALL, len(self.calls), 0, 0, 0))
+		self.calls.append(func)
+
+	def bind_vao(self, unsigned int glid):
+		self._pending.append((OP_BIND_VAO, glid, 0, 0, 0))
+		self._native_count += 1
+
+	def uniform_matrix(self, int location, transform):
+		""" Upload the world matrix of transform to a mat4 uniform of the
+		current program
+		"""
+		self._pending.append((OP_MATRIX, location, len(self._transforms), 0, 0))
+		self._transforms.append(transform)
+		self._native_count += 1
+		self.matrix_count += 1
+
+	def draw_elements(self, unsigned int mode, int count, size_t offset=0, int base_vertex=0):
+		""" Draw GL_UNSIGNED_INT indices of the bound VAO
+		"""
+		self._pending.append((OP_DRAW, mode, count, offset, base_vertex))
+		self._native_count += 1
+		self.draw_count += 1
+
+	def finish(self, graph=None):
+		""" Pack the recorded commands
+
+		graph -- The TransformGraph of the recorded transforms, if any : the
+		         changed matrices are then found from its update stamps.
+		         Otherwise the list listens to the Transforms until
+		         release() is called.
+		"""
+		self._ops = np.array(self._pending, dtype=np.int64).reshape((-1, 5))
+		self._pending = None
+
+		self.matrices = Matrix4x4Array.from_matrices(
+			[tf.premul_matrix for tf in self._transforms])
+		self._mats = self.matrices.array
+
+		self._graph = graph
+		for slot, tf in enumerate(self._transforms):
+			self._slots.setdefault(tf, []).append(slot)
+		if graph is not None:
+			self._stamp = graph.stamp
+		else:
+			# Transforms report themselves when they change
+			self._moved = set()
+			for tf in self._slots:
+				tf.add_listener(self._moved.add)
+
+	def release(self):
+		""" Stop listening to the recorded transforms, once the list is not
+		replayed anymore
+		"""
+		if self._graph is None and self._moved is not None:
+			for tf in self._slots:
+				tf.remove_listener(self._moved.add)
+		self._slots = {}
+		self._moved = None
+
+	def patch(self):
+		""" Copy the matrices whose transform changed since the last patch
+		(or the recording), and return how many were copied
+		"""
+		cdef Py_ssize_t slot
+		cdef int patched = 0
+		matrices = self.matrices
+
+		if self._graph is not None:
+			# Nothing moved : the stamp only changes when matrices do
+			self._graph.update()
+			if self._graph.stamp == self._stamp:
+				return 0
+			for tf in self._graph.updated_since(self._stamp):
+				for slot in self._slots.get(tf, ()):
+					matrices[slot] = tf.premul_matrix
+					patched += 1
+			self._stamp = self._graph.stamp
+			return patched
+
+		if not self._moved:
+			return 0
+		for tf in self._moved:
+			for slot in self._slots.get(tf, ()):
+				matrices[slot] = tf.premul_matrix
+				patched += 1
+		self._moved.clear()
+		return patched
+
+	def replay(self):
+		cdef Py_ssize_t i, n = self._ops.shape[0]
+		cdef long long[:, ::1] ops = self._ops
+		cdef float[:, :, ::1] mats = self._mats
+		cdef long long op
+		calls = self.calls
+
+		if self._native_count != 0 and not native_commands():
+			raise RuntimeError('The native GL commands are not installed')
+
+		for i in range(n):
+			op = ops[i, 0]
+			if op == OP_CALL:
+				calls[ops[i, 1]]()
+			elif op == OP_BIND_VAO:
+				_glBindVertexArray(<unsigned int>ops[i, 1])
+			elif op == OP_MATRIX:
+				_glUniformMatrix4fv(<int>ops[i, 1], 1, 0, &mats[ops[i, 2], 0, 0])
+			elif ops[i, 4] == 0:
+				_glDrawElements(<unsigned int>ops[i, 1], <int>ops[i, 2], GL_UNSIGNED_INT,
+					<const void *><size_t>ops[i, 3])
+			else:
+				_glDrawElementsBaseVertex(<unsigned int>ops[i, 1], <int>ops[i, 2], GL_UNSIGNED_INT,
+					<const void *><size_t>ops[i, 3], <int>ops[i, 4])
+
+	def __len__(self):
+		return self._ops.shape[0]
@@ -93,9 +93,18 @@ class FBO(object):
             self.bind()
             glClear(self.clearflags)
 
+    def delete(self):
+        """ Delete the GL framebuffer now, instead of when garbage collected
+        """
+        if self.fboid:
+            if FBO._current is self:
+                FBO.bind_default()
+            glDeleteFramebuffers(1, [self.fboid])
+            glFlush()
+            self.fboid = 0
+
     def __del__(self):
-        glDeleteFramebuffers([self.fboid])
-        glFlush()
+        self.delete()
 
     def bind(self):
         if FBO._current != self:
@@ -50,6 +50,9 @@ class GLFWRenderer(object):
             glfw.SwapBuffers(self.window)
             glfw.PollEvents()
 
+        # Do not lose the captures still in flight
+        self.renderer.finish_captures()
+
     def setup(self):
         pass
 
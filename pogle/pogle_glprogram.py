@@ -6,9 +6,10 @@ from ctypes import *
 from cStringIO import StringIO
 
 from pogle_gltexture import Texture1D, Texture2D, Texture3D, TextureBuffer
-from pogle_math import Vector, Matrix4x4
+from pogle_math import Vector, Vec2, Vec3, Vec4, Matrix4x4
 from pogle_mesh import DefaultAttribStruct
 from pogle_opengl import *
+from pogle_stats import Stats
 
 __author__ = 'Clement JACOB'
 __copyright__ = "Copyright 2013, The Python OpenGL Engine"
@@ -21,13 +22,37 @@ GL_GEOMETRY_SHADER = 0x8DD9
 GL_TESS_CONTROL_SHADER = 0x8E88
 GL_TESS_EVALUATION_SHADER = 0x8E87
 
+# Uniform blocks filled once per pass by the renderer, and their binding
+# points
+MAX_LIGHTS = 8
+UNIFORM_BLOCK_BINDINGS = {
+	'CameraBlock': 0,
+	'LightBlock': 1,
+}
+
 UNIFORMS_DEFAULT = """
-uniform mat4 viewMatrix;
-uniform mat4 projMatrix;
-uniform mat4 modelMatrix;
+#define MAX_LIGHTS %d
+
+layout(std140) uniform CameraBlock
+{
+	mat4 viewMatrix;
+	mat4 projMatrix;
+	mat4 viewProjMatrix;
+	mat4 invViewMatrix;
+	mat4 invViewProjMatrix;
+};
+
+layout(std140) uniform LightBlock
+{
+	vec4 lightPositions[MAX_LIGHTS];
+	int lightCount;
+};
+
+// The first light, as before the light block
+#define lightPos (lightPositions[0].xyz)
 
-uniform vec3 lightPos;
-"""
+uniform mat4 modelMatrix;
+""" % MAX_LIGHTS
 
 # Defines used across all shaders
 VERTEX_SHADER_DEFINES = """
@@ -46,6 +71,11 @@ VERTEX_SHADER_DEFINES = """
 	layout(location=0) in vec4 position; \
 	layout(location=1) in vec2 uv0;
 
+// Hardware instancing : use instanceModelMatrix instead of modelMatrix
+#define DEFINE_VAO_3D_INSTANCED \
+	DEFINE_VAO_3D_DEFAULT \
+	layout(location=5) in mat4 instanceModelMatrix;
+
 
 """
 
@@ -59,6 +89,11 @@ def _glUniformNf(idx, vec):
 	else:
 		raise Exception('Unsupported Vector%d' % len(vec))
 
+def _uniform_mat4(idx, mat):
+	# Native upload when available, else through PyOpenGL
+	if not mat.upload_uniform(idx):
+		glUniformMatrix4fv(idx, 1, GL_FALSE, mat.data())
+
 def _uniform_tex(idx, tex):
 	tex.bind()
 	glUniform1i(idx, tex.sampler_unit)
@@ -75,9 +110,28 @@ class GLProgram(object):
 		TextureBuffer  : _uniform_tex,
 		float 		   : lambda idx, v: glUniform1f(idx, v),
 		Vector 		   : lambda idx, v: _glUniformNf(idx, v),
-		Matrix4x4 	   : lambda idx, v: glUniformMatrix4fv(idx, 1, GL_FALSE, v.data()),
+		Vec2 		   : lambda idx, v: _glUniformNf(idx, v),
+		Vec3 		   : lambda idx, v: _glUniformNf(idx, v),
+		Vec4 		   : lambda idx, v: _glUniformNf(idx, v),
+		Matrix4x4 	   : _uniform_mat4,
 	}
 
+	# Snapshot of a value, compared to the last uploaded one to skip
+	# redundant uploads. Textures are not cached : they are always bound.
+	UNIFORM_SNAPSHOT = {
+		int            : lambda v: v,
+		float          : lambda v: v,
+		Vector         : lambda v: tuple(v.vals),
+		Vec2           : lambda v: tuple(v.vals),
+		Vec3           : lambda v: tuple(v.vals),
+		Vec4           : lambda v: tuple(v.vals),
+		Matrix4x4      : Matrix4x4.tobytes,
+	}
+
+	# Per draw uniforms, which almost never repeat : they are uploaded
+	# without taking a snapshot
+	UNCACHED_UNIFORMS = set(['modelMatrix'])
+
 
 	def __init__(self, path=None, xml=None, defines=[], **kwargs):
 		""" Create a shader from .shader file (XML syntax)
@@ -104,6 +158,9 @@ class GLProgram(object):
 
 
 		vert_src = uniforms + root.find('vertex').text
+
+		# Buckets of a same geometry are drawn in a single instanced call
+		self.supports_instancing = 'DEFINE_VAO_3D_INSTANCED' in root.find('vertex').text
 		frag_src = uniforms + root.find('fragment').text
 
 		geom_src = root.find('geometry')
@@ -166,23 +223,58 @@ class GLProgram(object):
 		if not temp:
 			raise Exception(glGetProgramInfoLog(self.prog))
 
+		# Blocks not used by the shader are optimized out
+		for block, binding in UNIFORM_BLOCK_BINDINGS.iteritems():
+			idx = glGetUniformBlockIndex(self.prog, block)
+			if idx != GL_INVALID_INDEX:
+				glUniformBlockBinding(self.prog, idx, binding)
+
 		self._uniforms_indices = {}
-		
+
+		# Location -> snapshot of the last uploaded value
+		self._uniforms_values = {}
+
+		# The last Material used with this program
+		self.last_material = None
+
 
 	def use(self):
 		""" Mark the shader as active
 		"""
 		glUseProgram(self.prog)
 
-	def set_uniform(self, name, value):
+	def uniform_location(self, name):
+		""" The location of an uniform, -1 if it is not used
+		"""
 		if name not in self._uniforms_indices:
 			idx = glGetUniformLocation(self.prog, name)
 			self._uniforms_indices[name] = idx
+		return self._uniforms_indices[name]
 
-		idx = self._uniforms_indices[name]
+	def set_uniform(self, name, value):
+		idx = self.uniform_location(name)
 		if idx == -1:
 			return
+
+		snapshot = None
+		if name not in GLProgram.UNCACHED_UNIFORMS:
+			snapshot = GLProgram.UNIFORM_SNAPSHOT.get(type(value))
+		if snapshot is not None:
+			snap = snapshot(value)
+			if self._uniforms_values.get(idx) == snap:
+				Stats.uniforms_skipped += 1
+				return
+			self._uniforms_values[idx] = snap
+
 		GLProgram.UNIFORM_VTBL[type(value)](idx, value)
+		Stats.uniforms_issued += 1
+
+	def invalidate_uniforms(self):
+		""" Forget the uploaded values, to be called if uniforms were set
+		without set_uniform
+		"""
+		self._uniforms_values.clear()
+		self.last_material = None
 
 	@staticmethod
 	def __create_shader(src, shader_type):
@@ -30,6 +30,7 @@ GL_MAPPING = {
 
     'depth8'                : (GL_DEPTH_COMPONENT, GL_UNSIGNED_BYTE, GL_DEPTH_COMPONENT, 1),
     'depth16'               : (GL_DEPTH_COMPONENT, GL_UNSIGNED_SHORT, GL_DEPTH_COMPONENT16, 2),
+    'depth24'               : (GL_DEPTH_COMPONENT, GL_UNSIGNED_INT, GL_DEPTH_COMPONENT24, 4),
 
     'rg8'                   : (GL_RG, GL_UNSIGNED_BYTE, GL_RG, 2),
     'rg16'                  : (GL_RG, GL_UNSIGNED_SHORT, GL_RG16, 4),
@@ -113,10 +114,17 @@ class GLTexture(object):
     def format(self):
         return self.fmtk
 
+    def delete(self):
+        """ Delete the GL texture now, instead of when garbage collected
+        """
+        if self.texid:
+            glDeleteTextures([self.texid])
+            glFlush()
+            TextureUnit.unbind(self.wref)
+            self.texid = 0
+
     def __del__(self):
-        glDeleteTextures([self.texid])
-        glFlush()
-        TextureUnit.unbind(self.wref)
+        self.delete()
 
     def _bind(self, unit):
         self.sampler_unit = unit
@@ -0,0 +1,103 @@
+from ctypes import *
+import time
+
+from pogle_opengl import *
+from pogle_stats import Stats
+
+__author__ = 'Clement JACOB'
+__copyright__ = "Copyright 2013, The Python OpenGL Engine"
+__license__ = "Closed Source"
+__version__ = "0.0.1"
+__email__ = "clems71@gmail.com"
+__status__ = "Prototype"
+
+
+class GPUTimer(object):
+    """ Per pass GPU and CPU timings, reported to Stats (cpu_times,
+    gpu_times and their histories).
+
+    The GPU times come from GL_TIME_ELAPSED queries, only read back once
+    their results are available, a few frames later, so that timing never
+    stalls the pipeline. The CPU time of a pass is the time spent submitting
+    it.
+    """
+    def __init__(self, latency=3):
+        """
+        latency -- Frames of queries in flight at most. Beyond, the oldest
+                   results are waited for.
+        """
+        self.latency = latency
+        self.enabled = True
+
+        self._free = []
+        self._current = None
+        self._frame = []
+        self._cpu = {}
+        self._pending = []
+
+    def _query(self):
+        if self._free:
+            return self._free.pop()
+        query = GLuint(0)
+        glGenQueries(1, byref(query))
+        return query.value
+
+    def begin(self, name):
+        """ Start timing a pass. Timings can not be nested.
+        """
+        if not self.enabled:
+            return
+        if self._current is not None:
+            raise Exception('The timing of \'%s\' is not ended' % self._current[0])
+
+        query = self._query()
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        self._current = (name, query, time.time())
+
+    def end(self):
+        if self._current is None:
+            return
+
+        name, query, start = self._current
+        glEndQuery(GL_TIME_ELAPSED)
+        self._current = None
+
+        self._cpu[name] = self._cpu.get(name, 0.0) + (time.time() - start) * 1e3
+        self._frame.append((name, query))
+
+    def _available(self, frame):
+        # Queries complete in order : the last one of the frame is enough
+        available = GLint(0)
+        glGetQueryObjectiv(frame[-1][1], GL_QUERY_RESULT_AVAILABLE, byref(available))
+        return available.value != 0
+
+    def _read(self, frame):
+        times = {}
+        elapsed = GLuint64(0)
+        for name, query in frame:
+            glGetQueryObjectui64v(query, GL_QUERY_RESULT, byref(elapsed))
+            times[name] = times.get(name, 0.0) + elapsed.value * 1e-6
+            self._free.append(query)
+        Stats.set_gpu_times(times)
+
+    def update(self):
+        """ Called by the renderer once per frame : report the CPU times of
+        the frame, and the GPU times of the older frames now available
+        """
+        Stats.set_cpu_times(self._cpu)
+        self._cpu = {}
+
+        if self._frame:
+            self._pending.append(self._frame)
+            self._frame = []
+
+        while len(self._pending) > self.latency:
+            self._read(self._pending.pop(0))
+        while self._pending and self._available(self._pending[0]):
+            self._read(self._pending.pop(0))
+
+    def finish(self):
+        """ Wait for the results of all the timed frames
+        """
+        while self._pending:
+            self._read(self._pending.pop(0))
@@ -0,0 +1,190 @@
+from ctypes import *
+import logging
+import os
+
+from pogle_opengl import *
+from pogle_fbo import FBO
+from pogle_gltexture import Texture2D
+from pogle_renderer import GLRenderer, RenderPass
+
+__author__ = 'Clement JACOB'
+__copyright__ = "Copyright 2013, The Python OpenGL Engine"
+__license__ = "Closed Source"
+__version__ = "0.0.1"
+__email__ = "clems71@gmail.com"
+__status__ = "Prototype"
+
+# EGL_MESA_platform_surfaceless
+EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+
+
+def _egl_context(format):
+    from OpenGL import EGL
+
+    display = None
+    if hasattr(EGL, 'eglGetPlatformDisplayEXT'):
+        display = EGL.eglGetPlatformDisplayEXT(EGL_PLATFORM_SURFACELESS_MESA, None, None)
+    if not display:
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not EGL.eglInitialize(display, pointer(major), pointer(minor)):
+        raise Exception('Could not initialize EGL')
+
+    config = EGL.EGLConfig()
+    count = EGL.EGLint()
+    attribs = (EGL.EGLint * 5)(
+        EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+        EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+        EGL.EGL_NONE)
+    if not EGL.eglChooseConfig(display, attribs, pointer(config), 1, pointer(count)) or count.value == 0:
+        raise Exception('No EGL config supports OpenGL')
+
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    attribs = (EGL.EGLint * 7)(
+        EGL.EGL_CONTEXT_MAJOR_VERSION, format[0],
+        EGL.EGL_CONTEXT_MINOR_VERSION, format[1],
+        EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+        EGL.EGL_NONE)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, attribs)
+    if not context:
+        raise Exception('Could not create an OpenGL %d.%d EGL context' % format)
+
+    # No surface at all : everything is rendered into FBOs
+    if not EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, context):
+        raise Exception('Could not make the EGL context current')
+
+    return lambda: EGL.eglDestroyContext(display, context)
+
+
+def _osmesa_context(format, size):
+    from OpenGL import arrays, osmesa
+
+    attribs = arrays.GLintArray.asArray([
+        osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+        osmesa.OSMESA_DEPTH_BITS, 24,
+        osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+        osmesa.OSMESA_CONTEXT_MAJOR_VERSION, format[0],
+        osmesa.OSMESA_CONTEXT_MINOR_VERSION, format[1],
+        0])
+    context = osmesa.OSMesaCreateContextAttribs(attribs, None)
+    if not context:
+        raise Exception('Could not create an OpenGL %d.%d OSMesa context' % format)
+
+    # OSMesa needs a color buffer to be made current, even if unused
+    buf = arrays.GLubyteArray.zeros((size[1], size[0], 4))
+    if not osmesa.OSMesaMakeCurrent(context, buf, GL_UNSIGNED_BYTE, size[0], size[1]):
+        raise Exception('Could not make the OSMesa context current')
+
+    return lambda: osmesa.OSMesaDestroyContext(context)
+
+
+class RenderJob(object):
+    """ A frame to render by HeadlessRenderer.render_jobs
+    """
+    def __init__(self, scene, camera=None, output=None):
+        """
+        scene -- The scene to render
+        camera -- If given, it becomes the scene camera before rendering
+        output -- A file path (saved in the background), or a callable
+                  receiving the pixels as an (height, width, 4) uint8 array
+        """
+        self.scene = scene
+        self.camera = camera
+        self.output = output
+
+
+class HeadlessRenderer(object):
+    """ A GLRenderer context without window, for batch rendering on servers.
+    The passes rendering to the default framebuffer render into the fbo
+    attribute instead.
+
+    PyOpenGL selects its platform when OpenGL is first imported, so
+    PYOPENGL_PLATFORM must be set to 'egl' (surfaceless EGL on Mesa) or
+    'osmesa' before importing pogle. Both run on Mesa's software rasterizer
+    when no GPU is available.
+    """
+    def __init__(self, format=(3, 3), size=(800, 600), backend=None):
+        """
+        backend -- 'egl' or 'osmesa', defaults to PYOPENGL_PLATFORM
+        """
+        if backend is None:
+            backend = os.environ.get('PYOPENGL_PLATFORM')
+        if backend == 'egl':
+            self._destroy = _egl_context(format)
+        elif backend == 'osmesa':
+            self._destroy = _osmesa_context(format, size)
+        else:
+            raise Exception('Headless rendering needs PYOPENGL_PLATFORM=egl or osmesa')
+
+        self.size = size
+
+        logging.basicConfig(level=logging.DEBUG)
+        self.renderer = GLRenderer(self)
+        self.renderer.init_gl()
+
+        self.color = Texture2D(None, size[0], size[1], format='rgba', filtering='nearest')
+        self.depth = Texture2D(None, size[0], size[1], format='depth24', filtering='nearest')
+        self.fbo = FBO(color0=self.color, depth=self.depth)
+        self.renderer.default_fbo = self.fbo
+
+        # One pass per job scene, so that their render lists are kept
+        self._job_passes = {}
+
+        self.setup()
+
+    def width(self):
+        return self.size[0]
+
+    def height(self):
+        return self.size[1]
+
+    def run(self, frames=1):
+        for _ in range(frames):
+            self.update()
+            self.renderer.render()
+        self.renderer.finish_captures()
+
+    def setup(self):
+        pass
+
+    def update(self):
+        pass
+
+    def job_pass(self, scene):
+        """ The RenderPass used to render the jobs of a scene. It can be
+        configured (culling, depthsort, ...) before rendering the jobs.
+        """
+        pass_ = self._job_passes.get(scene)
+        if pass_ is None:
+            pass_ = self._job_passes[scene] = RenderPass('job', scene)
+        return pass_
+
+    def render_jobs(self, jobs):
+        """ Render the RenderJobs back to back. Read backs are pipelined
+        (see CaptureQueue) : the GPU keeps rendering the next jobs while the
+        previous frames are copied back and saved.
+        """
+        queue = self.renderer.capture_queue
+        count = 0
+        for job in jobs:
+            if job.camera is not None:
+                job.scene.camera = job.camera
+
+            pass_ = self.job_pass(job.scene)
+            self.renderer.render_pass(pass_)
+
+            if callable(job.output):
+                queue.readback(self.renderer, pass_, job.output)
+            elif job.output is not None:
+                queue.request(self.renderer, pass_, job.output)
+            queue.update()
+            self.renderer.timer.update()
+            count += 1
+
+        queue.finish()
+        return count
+
+    def close(self):
+        self.renderer.capture_queue.close()
+        self._destroy()
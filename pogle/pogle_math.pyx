@@ -1,8 +1,17 @@
 import math
+import operator
+import weakref
 from ctypes import *
 
+import numpy as np
+
+from pogle_stats import Stats
+
 cimport cython
+from cpython.buffer cimport PyBUF_WRITABLE
 from cython cimport view
+from libc.math cimport cos, fabs, sin, sqrt
+from libc.string cimport memcpy
 
 __author__ = 'Clement JACOB'
 __copyright__ = "Copyright 2013, The Python OpenGL Engine"
@@ -11,88 +20,257 @@ __version__ = "0.0.1"
 __email__ = "clems71@gmail.com"
 __status__ = "Prototype"
 
-class Vector(object):
+cdef class Vector(object):
+	""" A vector of up to 4 floats, stored inline.
+
+	Arithmetic returns Vec2/Vec3/Vec4 instances (all of them are Vectors).
+	Vectors expose their values through the buffer protocol, so
+	numpy.asarray(vec) is a float32 view on them.
+	"""
+	cdef float v[4]
+	cdef int _size
+	cdef Py_ssize_t _shape[1]
+	cdef Py_ssize_t _strides[1]
+
 	def __init__(self, *args):
-		self.vals = [float(f) for f in args]
+		self.vals = args
+
+	cdef inline int _check(self, int idx) except -1:
+		if idx >= self._size:
+			raise IndexError('Vector%d has no component %d' % (self._size, idx))
+		return idx
+
+	@property
+	def vals(self):
+		return [self.v[i] for i in range(self._size)]
+	@vals.setter
+	def vals(self, vals):
+		cdef int i
+		if len(vals) > 4:
+			raise ValueError('Vector supports up to 4 components, got %d' % len(vals))
+		self._size = len(vals)
+		for i in range(self._size):
+			self.v[i] = vals[i]
 
 	@property
 	def x(self):
-		return self.vals[0]
+		return self.v[self._check(0)]
 	@x.setter
-	def x(self, val):
-		self.vals[0] = val
+	def x(self, float val):
+		self.v[self._check(0)] = val
 
 	@property
 	def y(self):
-		return self.vals[1]
+		return self.v[self._check(1)]
 	@y.setter
-	def y(self, val):
-		self.vals[1] = val
+	def y(self, float val):
+		self.v[self._check(1)] = val
 
 	@property
 	def z(self):
-		return self.vals[2]
+		return self.v[self._check(2)]
 	@z.setter
-	def z(self, val):
-		self.vals[2] = val
+	def z(self, float val):
+		self.v[self._check(2)] = val
 
 	@property
 	def w(self):
-		return self.vals[3]
+		return self.v[self._check(3)]
 	@w.setter
-	def w(self, val):
-		self.vals[3] = val
+	def w(self, float val):
+		self.v[self._check(3)] = val
+
+	def __getitem__(self, int idx):
+		if idx < 0:
+			idx += self._size
+		if idx < 0:
+			raise IndexError('Vector index out of range')
+		return self.v[self._check(idx)]
+
+	def __setitem__(self, int idx, float val):
+		if idx < 0:
+			idx += self._size
+		if idx < 0:
+			raise IndexError('Vector index out of range')
+		self.v[self._check(idx)] = val
+
+	def __imul__(self, float f):
+		cdef int i
+		for i in range(self._size):
+			self.v[i] *= f
+		return self
+
+	def __mul__(a, b):
+		cdef Vector vec
+		cdef Vector res
+		cdef float f
+		cdef int i
+
+		# Support both scalar * vec and vec * scalar
+		if isinstance(a, Vector):
+			vec, f = a, b
+		else:
+			vec, f = b, a
 
-	def __imul__(self, f):
-		self.vals = [v * f for v in self.vals]
+		res = _new_vector(vec._size)
+		for i in range(vec._size):
+			res.v[i] = vec.v[i] * f
+		return res
+
+	def __rmul__(self, f):
+		return self * f
 
-	def __mul__(self, f):
-		return Vector(*[v * f for v in self.vals])
+	def __itruediv__(self, float f):
+		cdef int i
+		for i in range(self._size):
+			self.v[i] /= f
+		return self
 
 	def __idiv__(self, f):
-		self.vals = [v / f for v in self.vals]
+		return self.__itruediv__(f)
 
-	def __sub__(self, vec):
-		return Vector(*[a - b for a, b in zip(self.vals, vec.vals)])
+	def __truediv__(Vector self, float f):
+		cdef Vector res = _new_vector(self._size)
+		cdef int i
+		for i in range(self._size):
+			res.v[i] = self.v[i] / f
+		return res
 
-	def __add__(self, vec):
-		return Vector(*[a + b for a, b in zip(self.vals, vec.vals)])
+	def __div__(self, f):
+		return self.__truediv__(f)
 
-	def cross(self, vec):
-		assert len(self) == 3
-		assert len(vec) == 3
-		return Vector(
-			self.y * vec.z - self.z * vec.y,
-			self.z * vec.x - self.x * vec.z,
-			self.x * vec.y - self.y * vec.x,
-			)
+	def __sub__(Vector self, Vector vec):
+		cdef Vector res = _new_vector(min(self._size, vec._size))
+		cdef int i
+		for i in range(res._size):
+			res.v[i] = self.v[i] - vec.v[i]
+		return res
 
-	def abs(self):
-		accum = 0.0
-		for v in self.vals:
-			accum += v * v
-		return math.sqrt(accum)
+	def __add__(Vector self, Vector vec):
+		cdef Vector res = _new_vector(min(self._size, vec._size))
+		cdef int i
+		for i in range(res._size):
+			res.v[i] = self.v[i] + vec.v[i]
+		return res
+
+	def __isub__(self, Vector vec):
+		cdef int i
+		for i in range(min(self._size, vec._size)):
+			self.v[i] -= vec.v[i]
+		return self
 
-	def dot(self, other):
-		accum = 0.0
-		for v1, v2 in zip(self.vals, other.vals):
-			accum += v1 * v2
+	def __iadd__(self, Vector vec):
+		cdef int i
+		for i in range(min(self._size, vec._size)):
+			self.v[i] += vec.v[i]
+		return self
+
+	def __neg__(self):
+		return self.negated()
+
+	cpdef Vector cross(self, Vector vec):
+		assert self._size == 3
+		assert vec._size == 3
+		cdef Vector res = _new_vector(3)
+		res.v[0] = self.v[1] * vec.v[2] - self.v[2] * vec.v[1]
+		res.v[1] = self.v[2] * vec.v[0] - self.v[0] * vec.v[2]
+		res.v[2] = self.v[0] * vec.v[1] - self.v[1] * vec.v[0]
+		return res
+
+	cpdef float abs(self):
+		return sqrt(self.abs2())
+
+	cpdef float dot(self, Vector other):
+		cdef float accum = 0.0
+		cdef int i
+		for i in range(min(self._size, other._size)):
+			accum += self.v[i] * other.v[i]
 		return accum
 
-	def abs2(self):
-		accum = 0.0
-		for v in self.vals:
-			accum += v * v
+	cpdef float abs2(self):
+		cdef float accum = 0.0
+		cdef int i
+		for i in range(self._size):
+			accum += self.v[i] * self.v[i]
 		return accum
 
-	def negated(self):
-		return Vector(*[-a for a in self.vals])
+	cpdef Vector negated(self):
+		cdef Vector res = _new_vector(self._size)
+		cdef int i
+		for i in range(self._size):
+			res.v[i] = -self.v[i]
+		return res
+
+	cpdef normalize(self):
+		cdef float norm = self.abs()
+		cdef int i
+		for i in range(self._size):
+			self.v[i] /= norm
+
+	@staticmethod
+	def from_array(arr):
+		""" Build a list of vectors from a (N, size) array-like (size <= 4)
+		"""
+		cdef float[:, ::1] data = np.ascontiguousarray(arr, dtype=np.float32)
+		cdef Py_ssize_t i, n = data.shape[0]
+		cdef int j, size = data.shape[1]
+		cdef Vector vec
+		if size > 4:
+			raise ValueError('Vector supports up to 4 components, got %d' % size)
+
+		res = []
+		for i in range(n):
+			vec = _new_vector(size)
+			for j in range(size):
+				vec.v[j] = data[i, j]
+			res.append(vec)
+		return res
+
+	@staticmethod
+	def to_array(vectors):
+		""" Pack a sequence of same-sized vectors into a float32 (N, size) array
+		"""
+		cdef Vector vec
+		cdef Py_ssize_t i = 0
+		cdef int j
+		vectors = list(vectors)
+		if len(vectors) == 0:
+			return np.empty((0, 0), dtype=np.float32)
+
+		cdef int size = (<Vector>vectors[0])._size
+		cdef float[:, ::1] data = np.empty((len(vectors), size), dtype=np.float32)
+		for vec in vectors:
+			if vec._size != size:
+				raise ValueError('Cannot pack Vector%d with Vector%d' % (vec._size, size))
+			for j in range(size):
+				data[i, j] = vec.v[j]
+			i += 1
+		return data.base
+
+	def __getbuffer__(self, Py_buffer *buffer, int flags):
+		self._shape[0] = self._size
+		self._strides[0] = sizeof(float)
+
+		buffer.buf = <char *>self.v
+		buffer.format = 'f'
+		buffer.internal = NULL
+		buffer.itemsize = sizeof(float)
+		buffer.len = self._size * sizeof(float)
+		buffer.ndim = 1
+		buffer.obj = self
+		buffer.readonly = 0
+		buffer.shape = self._shape
+		buffer.strides = self._strides
+		buffer.suboffsets = NULL
+
+	def __releasebuffer__(self, Py_buffer *buffer):
+		pass
 
-	def normalize(self):
-		self /= self.abs()
+	def __reduce__(self):
+		return (type(self), tuple(self.vals))
 
 	def __len__(self):
-		return len(self.vals)
+		return self._size
 
 	def __repr__(self):
 		s = 'Vector%d(' % len(self)
@@ -100,6 +278,39 @@ class Vector(object):
 			s += '%.3f, ' % v
 		return s + ')'
 
+@cython.final
+cdef class Vec2(Vector):
+	def __init__(self, x=0.0, y=0.0):
+		self._size = 2
+		self.v[0] = x ; self.v[1] = y
+
+@cython.final
+cdef class Vec3(Vector):
+	def __init__(self, x=0.0, y=0.0, z=0.0):
+		self._size = 3
+		self.v[0] = x ; self.v[1] = y ; self.v[2] = z
+
+@cython.final
+cdef class Vec4(Vector):
+	def __init__(self, x=0.0, y=0.0, z=0.0, w=0.0):
+		self._size = 4
+		self.v[0] = x ; self.v[1] = y ; self.v[2] = z ; self.v[3] = w
+
+cdef Vector _new_vector(int size):
+	""" Create an uninitialized vector of the fixed-size type matching size
+	"""
+	cdef Vector res
+	if size == 3:
+		res = Vec3.__new__(Vec3)
+	elif size == 4:
+		res = Vec4.__new__(Vec4)
+	elif size == 2:
+		res = Vec2.__new__(Vec2)
+	else:
+		res = Vector.__new__(Vector)
+	res._size = size
+	return res
+
 class Rect(object):
 	def __init__(self, x, y, width, height):
 		self.x = x
@@ -118,20 +329,349 @@ class AABB(object):
 		radii = ((self.max - self.min) * 0.5).abs()
 		return Sphere(center, radii)
 
+	def transformed(self, Matrix4x4 matrix not None):
+		""" Return the box enclosing this box transformed by matrix
+		"""
+		cdef float[3] mn, mx, out_mn, out_mx
+		cdef int i
+		for i in range(3):
+			mn[i] = self.min[i]
+			mx[i] = self.max[i]
+		_transform_aabb(matrix.vals, mn, mx, out_mn, out_mx)
+		return AABB(Vec3(out_mn[0], out_mn[1], out_mn[2]), Vec3(out_mx[0], out_mx[1], out_mx[2]))
+
 class Sphere(object):
 	def __init__(self, center, radii):
 		self.center = center
 		self.radii = radii
 
+cdef inline void _transform_aabb(const float *m, const float *mn, const float *mx,
+		float *out_mn, float *out_mx) noexcept nogil:
+	""" Box enclosing the box (mn, mx) transformed by m : the center is
+	transformed, and the extents by the absolute values of the linear part
+	"""
+	cdef float[3] c, e
+	cdef float wc, we
+	cdef int r
+
+	for r in range(3):
+		c[r] = (mn[r] + mx[r]) * 0.5
+		e[r] = (mx[r] - mn[r]) * 0.5
+	for r in range(3):
+		wc = m[r] * c[0] + m[4 + r] * c[1] + m[8 + r] * c[2] + m[12 + r]
+		we = fabs(m[r]) * e[0] + fabs(m[4 + r]) * e[1] + fabs(m[8 + r]) * e[2]
+		out_mn[r] = wc - we
+		out_mx[r] = wc + we
+
+def transform_aabbs(mins, maxs, Matrix4x4Array matrices):
+	""" Batched AABB.transformed : transform the boxes (mins[i], maxs[i]) by
+	matrices[i], and return the (world_mins, world_maxs) float32 arrays
+
+	mins, maxs -- (N, 3) array-likes
+	"""
+	cdef float[:, ::1] mn = np.ascontiguousarray(mins, dtype=np.float32).reshape((-1, 3))
+	cdef float[:, ::1] mx = np.ascontiguousarray(maxs, dtype=np.float32).reshape((-1, 3))
+	cdef Py_ssize_t i, n = mn.shape[0]
+	if mx.shape[0] != n or len(matrices) != n:
+		raise ValueError('Got %d min, %d max corners and %d matrices' % (n, mx.shape[0], len(matrices)))
+
+	out_mins = np.empty((n, 3), dtype=np.float32)
+	out_maxs = np.empty((n, 3), dtype=np.float32)
+	cdef float[:, ::1] omn = out_mins
+	cdef float[:, ::1] omx = out_maxs
+	for i in range(n):
+		_transform_aabb(matrices._ptr(i), &mn[i, 0], &mx[i, 0], &omn[i, 0], &omx[i, 0])
+	return out_mins, out_maxs
+
+def aabbs_to_spheres(mins, maxs):
+	""" Batched AABB.to_bounding_sphere : return the (centers, radii) arrays
+	"""
+	mins = np.asarray(mins, dtype=np.float32)
+	maxs = np.asarray(maxs, dtype=np.float32)
+	centers = (mins + maxs) * 0.5
+	radii = np.sqrt(np.sum(((maxs - mins) * 0.5) ** 2, axis=-1))
+	return centers, radii
+
+cdef inline void _mul44(const float *a, const float *b, float *out) noexcept nogil:
+	""" out = a * b, column-major storage. out may alias a or b
+	"""
+	cdef float[16] tmp
+	cdef int x
+
+	for x in range(4):
+		tmp[x * 4 + 0] = a[0] * b[x * 4] + a[4] * b[x * 4 + 1] + a[8 ] * b[x * 4 + 2] + a[12] * b[x * 4 + 3]
+		tmp[x * 4 + 1] = a[1] * b[x * 4] + a[5] * b[x * 4 + 1] + a[9 ] * b[x * 4 + 2] + a[13] * b[x * 4 + 3]
+		tmp[x * 4 + 2] = a[2] * b[x * 4] + a[6] * b[x * 4 + 1] + a[10] * b[x * 4 + 2] + a[14] * b[x * 4 + 3]
+		tmp[x * 4 + 3] = a[3] * b[x * 4] + a[7] * b[x * 4 + 1] + a[11] * b[x * 4 + 2] + a[15] * b[x * 4 + 3]
+
+	memcpy(out, tmp, 16 * sizeof(float))
+
+cdef inline void _mul44_affine(const float *a, const float *b, float *out) noexcept nogil:
+	""" out = a * b, when both a and b have a (0, 0, 0, 1) last row. Only
+	the upper 3x4 part is computed. out may alias a or b
+	"""
+	cdef float[16] tmp
+	cdef int x
+
+	for x in range(3):
+		tmp[x * 4 + 0] = a[0] * b[x * 4] + a[4] * b[x * 4 + 1] + a[8 ] * b[x * 4 + 2]
+		tmp[x * 4 + 1] = a[1] * b[x * 4] + a[5] * b[x * 4 + 1] + a[9 ] * b[x * 4 + 2]
+		tmp[x * 4 + 2] = a[2] * b[x * 4] + a[6] * b[x * 4 + 1] + a[10] * b[x * 4 + 2]
+		tmp[x * 4 + 3] = 0.0
+
+	tmp[12] = a[0] * b[12] + a[4] * b[13] + a[8 ] * b[14] + a[12]
+	tmp[13] = a[1] * b[12] + a[5] * b[13] + a[9 ] * b[14] + a[13]
+	tmp[14] = a[2] * b[12] + a[6] * b[13] + a[10] * b[14] + a[14]
+	tmp[15] = 1.0
+
+	memcpy(out, tmp, 16 * sizeof(float))
+
+cdef inline void _inverse44_rigid(const float *m, float *out) noexcept nogil:
+	""" Inverse of a rotation + translation matrix : transposed rotation and
+	rotated, negated translation. out must not alias m
+	"""
+	cdef int r
+
+	for r in range(3):
+		out[r * 4 + 0] = m[0 * 4 + r]
+		out[r * 4 + 1] = m[1 * 4 + r]
+		out[r * 4 + 2] = m[2 * 4 + r]
+		out[r * 4 + 3] = 0.0
+		out[12 + r] = -(m[r * 4 + 0] * m[12] + m[r * 4 + 1] * m[13] + m[r * 4 + 2] * m[14])
+	out[15] = 1.0
+
+cdef inline int _inverse44_affine(const float *m, float *out) noexcept nogil:
+	""" Inverse of an affine matrix : 3x3 inverse of the linear part, applied
+	to the negated translation. out must not alias m. Returns 0 if singular
+	"""
+	cdef float det
+	cdef int r
+
+	out[0 ] = m[5] * m[10] - m[9] * m[6]
+	out[4 ] = m[8] * m[6]  - m[4] * m[10]
+	out[8 ] = m[4] * m[9]  - m[8] * m[5]
+	out[1 ] = m[9] * m[2]  - m[1] * m[10]
+	out[5 ] = m[0] * m[10] - m[8] * m[2]
+	out[9 ] = m[8] * m[1]  - m[0] * m[9]
+	out[2 ] = m[1] * m[6]  - m[5] * m[2]
+	out[6 ] = m[4] * m[2]  - m[0] * m[6]
+	out[10] = m[0] * m[5]  - m[4] * m[1]
+
+	det = m[0] * out[0] + m[4] * out[1] + m[8] * out[2]
+	if det == 0:
+		return 0
+
+	det = 1.0 / det
+	for r in range(3):
+		out[r * 4 + 0] *= det
+		out[r * 4 + 1] *= det
+		out[r * 4 + 2] *= det
+		out[r * 4 + 3] = 0.0
+
+	for r in range(3):
+		out[12 + r] = -(out[r] * m[12] + out[4 + r] * m[13] + out[8 + r] * m[14])
+	out[15] = 1.0
+	return 1
+
+cdef inline void _identity44(float *out) noexcept nogil:
+	cdef int i
+	for i in range(16):
+		out[i] = 0.0
+	out[0] = 1.0 ; out[5] = 1.0 ; out[10] = 1.0 ; out[15] = 1.0
+
+cdef void _rotation44(float rx, float ry, float rz, float *out) noexcept nogil:
+	""" Same convention as Matrix4x4.rotation : X * Y * Z
+	"""
+	cdef float[16] x_rot, y_rot, z_rot
+	_identity44(x_rot) ; _identity44(y_rot) ; _identity44(z_rot)
+
+	x_rot[5] = cos(rx) ; x_rot[9] = -sin(rx) ; x_rot[6] = sin(rx) ; x_rot[10] = cos(rx)
+	y_rot[0] = cos(ry) ; y_rot[8] = sin(ry) ; y_rot[2] = -sin(ry) ; y_rot[10] = cos(ry)
+	z_rot[0] = cos(rz) ; z_rot[4] = -sin(rz) ; z_rot[1] = sin(rz) ; z_rot[5] = cos(rz)
+
+	_mul44(x_rot, y_rot, out)
+	_mul44(out, z_rot, out)
+
+cdef int _inverse44(const float *m, float *out) noexcept nogil:
+	""" General 4x4 inverse by cofactor expansion. Returns 0 if m is singular
+	"""
+	cdef float[16] inv
+	cdef float det
+	cdef int i
+
+	inv[0] = m[5]  * m[10] * m[15] - \
+			 m[5]  * m[11] * m[14] - \
+			 m[9]  * m[6]  * m[15] + \
+			 m[9]  * m[7]  * m[14] + \
+			 m[13] * m[6]  * m[11] - \
+			 m[13] * m[7]  * m[10]
+
+	inv[4] = -m[4]  * m[10] * m[15] + \
+			  m[4]  * m[11] * m[14] + \
+			  m[8]  * m[6]  * m[15] - \
+			  m[8]  * m[7]  * m[14] - \
+			  m[12] * m[6]  * m[11] + \
+			  m[12] * m[7]  * m[10]
+
+	inv[8] = m[4]  * m[9] * m[15] - \
+			 m[4]  * m[11] * m[13] - \
+			 m[8]  * m[5] * m[15] + \
+			 m[8]  * m[7] * m[13] + \
+			 m[12] * m[5] * m[11] - \
+			 m[12] * m[7] * m[9]
+
+	inv[12] = -m[4]  * m[9] * m[14] + \
+			   m[4]  * m[10] * m[13] +\
+			   m[8]  * m[5] * m[14] - \
+			   m[8]  * m[6] * m[13] - \
+			   m[12] * m[5] * m[10] + \
+			   m[12] * m[6] * m[9]
+
+	inv[1] = -m[1]  * m[10] * m[15] + \
+			  m[1]  * m[11] * m[14] + \
+			  m[9]  * m[2] * m[15] - \
+			  m[9]  * m[3] * m[14] - \
+			  m[13] * m[2] * m[11] + \
+			  m[13] * m[3] * m[10]
+
+	inv[5] = m[0]  * m[10] * m[15] - \
+			 m[0]  * m[11] * m[14] - \
+			 m[8]  * m[2] * m[15] + \
+			 m[8]  * m[3] * m[14] + \
+			 m[12] * m[2] * m[11] - \
+			 m[12] * m[3] * m[10]
+
+	inv[9] = -m[0]  * m[9] * m[15] + \
+			  m[0]  * m[11] * m[13] + \
+			  m[8]  * m[1] * m[15] - \
+			  m[8]  * m[3] * m[13] - \
+			  m[12] * m[1] * m[11] + \
+			  m[12] * m[3] * m[9]
+
+	inv[13] = m[0]  * m[9] * m[14] - \
+			  m[0]  * m[10] * m[13] - \
+			  m[8]  * m[1] * m[14] + \
+			  m[8]  * m[2] * m[13] + \
+			  m[12] * m[1] * m[10] - \
+			  m[12] * m[2] * m[9]
+
+	inv[2] = m[1]  * m[6] * m[15] - \
+			 m[1]  * m[7] * m[14] - \
+			 m[5]  * m[2] * m[15] + \
+			 m[5]  * m[3] * m[14] + \
+			 m[13] * m[2] * m[7] - \
+			 m[13] * m[3] * m[6]
+
+	inv[6] = -m[0]  * m[6] * m[15] + \
+			  m[0]  * m[7] * m[14] + \
+			  m[4]  * m[2] * m[15] - \
+			  m[4]  * m[3] * m[14] - \
+			  m[12] * m[2] * m[7] + \
+			  m[12] * m[3] * m[6]
+
+	inv[10] = m[0]  * m[5] * m[15] - \
+			  m[0]  * m[7] * m[13] - \
+			  m[4]  * m[1] * m[15] + \
+			  m[4]  * m[3] * m[13] + \
+			  m[12] * m[1] * m[7] - \
+			  m[12] * m[3] * m[5]
+
+	inv[14] = -m[0]  * m[5] * m[14] + \
+			   m[0]  * m[6] * m[13] + \
+			   m[4]  * m[1] * m[14] - \
+			   m[4]  * m[2] * m[13] - \
+			   m[12] * m[1] * m[6] + \
+			   m[12] * m[2] * m[5]
+
+	inv[3] = -m[1] * m[6] * m[11] + \
+			  m[1] * m[7] * m[10] + \
+			  m[5] * m[2] * m[11] - \
+			  m[5] * m[3] * m[10] - \
+			  m[9] * m[2] * m[7] + \
+			  m[9] * m[3] * m[6]
+
+	inv[7] = m[0] * m[6] * m[11] - \
+			 m[0] * m[7] * m[10] - \
+			 m[4] * m[2] * m[11] + \
+			 m[4] * m[3] * m[10] + \
+			 m[8] * m[2] * m[7] - \
+			 m[8] * m[3] * m[6]
+
+	inv[11] = -m[0] * m[5] * m[11] + \
+			   m[0] * m[7] * m[9] + \
+			   m[4] * m[1] * m[11] - \
+			   m[4] * m[3] * m[9] - \
+			   m[8] * m[1] * m[7] + \
+			   m[8] * m[3] * m[5]
+
+	inv[15] = m[0] * m[5] * m[10] - \
+			  m[0] * m[6] * m[9] - \
+			  m[4] * m[1] * m[10] + \
+			  m[4] * m[2] * m[9] + \
+			  m[8] * m[1] * m[6] - \
+			  m[8] * m[2] * m[5]
+
+	det = m[0] * inv[0] + m[1] * inv[4] + \
+			m[2] * inv[8] + m[3] * inv[12]
+
+	if det == 0:
+		return 0
+
+	det = 1.0 / det
+	for i in range(16):
+		out[i] = inv[i] * det
+	return 1
+
 float_ptr_t = POINTER(c_float)
 
+# Native glUniformMatrix4fv entry point, used to upload matrices without
+# going through PyOpenGL argument conversion
+ctypedef void (*uniform_matrix4fv_t)(int location, int count, unsigned char transpose, const float *value) noexcept nogil
+cdef uniform_matrix4fv_t _glUniformMatrix4fv = NULL
+
+def set_uniform_matrix4fv_proc(size_t address):
+	""" Install the native glUniformMatrix4fv entry point used by
+	Matrix4x4.upload_uniform (0 disables the fast path)
+	"""
+	global _glUniformMatrix4fv
+	_glUniformMatrix4fv = <uniform_matrix4fv_t>address
+
+# Buffer layout of a Matrix4x4 : a (4, 4) float array indexed [x, y] like
+# Matrix4x4Array, so np.asarray(m)[x, y] == m.get(x, y)
+cdef Py_ssize_t[2] _MAT_SHAPE
+cdef Py_ssize_t[2] _MAT_STRIDES
+_MAT_SHAPE[0] = 4 ; _MAT_SHAPE[1] = 4
+_MAT_STRIDES[0] = 4 * sizeof(float) ; _MAT_STRIDES[1] = sizeof(float)
+
 def _matrix44_unpickle():
+	# Kept to load pickles made with the former dict based format
 	return Matrix4x4()
 
+def _matrix44_from_bytes(raw, int flags):
+	cdef Matrix4x4 res = Matrix4x4.__new__(Matrix4x4)
+	res._load(np.frombuffer(raw, dtype='<f4').astype(np.float32).tobytes())
+	res._set_flags(flags)
+	return res
+
 @cython.final
 cdef class Matrix4x4(object):
-	cdef float[16] vals
+	cdef float[16] _storage
+	cdef float *vals
+	cdef object _owner
+	cdef object _data_ptr
 	cdef public int is_identity
+	# is_affine : the last row is (0, 0, 0, 1)
+	# is_rigid : affine, with an orthonormal upper 3x3 (rotation + translation)
+	# Both are conservative : 0 only means the fast paths cannot be used
+	cdef public int is_affine
+	cdef public int is_rigid
+
+	def __cinit__(self):
+		# vals points to the inline storage, unless the matrix is a view
+		# into a Matrix4x4Array (then _owner keeps the array alive)
+		self.vals = self._storage
+		self._owner = None
+		self._data_ptr = None
 
 	def __init__(self):
 		self.vals[0] = 1.0 ; self.vals[4] = 0.0 ; self.vals[8 ] = 0.0 ; self.vals[12] = 0.0
@@ -139,160 +679,141 @@ cdef class Matrix4x4(object):
 		self.vals[2] = 0.0 ; self.vals[6] = 0.0 ; self.vals[10] = 1.0 ; self.vals[14] = 0.0
 		self.vals[3] = 0.0 ; self.vals[7] = 0.0 ; self.vals[11] = 0.0 ; self.vals[15] = 1.0
 		self.is_identity = 1
+		self.is_affine = 1
+		self.is_rigid = 1
 	
 	cpdef float get(self, int x, int y):
 		return self.vals[y + x * 4]
 
 	cpdef set(self, int x, int y, float val):
 		self.vals[y + x * 4] = val
+		self.is_identity = 0
+		self.is_rigid = 0
+		if y == 3:
+			self.is_affine = self._has_affine_row()
+
+	cdef inline int _has_affine_row(self):
+		return self.vals[3] == 0.0 and self.vals[7] == 0.0 and \
+			self.vals[11] == 0.0 and self.vals[15] == 1.0
+
+	cpdef classify(self):
+		""" Recompute the is_identity, is_affine and is_rigid flags from the
+		matrix values
+		"""
+		cdef int x, y
+		cdef float d
+		self.is_affine = self._has_affine_row()
+
+		# Orthonormal columns <=> rigid
+		self.is_rigid = self.is_affine
+		for x in range(3):
+			for y in range(x, 3):
+				d = self.vals[x * 4] * self.vals[y * 4] + \
+					self.vals[x * 4 + 1] * self.vals[y * 4 + 1] + \
+					self.vals[x * 4 + 2] * self.vals[y * 4 + 2]
+				if fabs(d - (1.0 if x == y else 0.0)) > 1e-5:
+					self.is_rigid = 0
+
+		self.is_identity = self.is_rigid
+		for x in range(16):
+			if self.vals[x] != (1.0 if x % 5 == 0 else 0.0):
+				self.is_identity = 0
 
 	def data(self):
-		p_vals = <float *>self.vals
-		return cast(<long>p_vals, float_ptr_t)
+		# The values never move, so the ctypes pointer is built only once
+		if self._data_ptr is None:
+			p_vals = <float *>self.vals
+			self._data_ptr = cast(<long>p_vals, float_ptr_t)
+		return self._data_ptr
+
+	cpdef int upload_uniform(self, int location):
+		""" Upload the matrix to a mat4 uniform of the current program with
+		the native entry point. Returns False if it is not installed (see
+		set_uniform_matrix4fv_proc)
+		"""
+		if _glUniformMatrix4fv == NULL:
+			return False
+		_glUniformMatrix4fv(location, 1, 0, self.vals)
+		return True
+
+	def __getbuffer__(self, Py_buffer *buffer, int flags):
+		""" Expose the values as a read-only (4, 4) float32 buffer indexed
+		[x, y], the same order as get() and Matrix4x4Array.array[i] :
+		numpy.asarray(m)[x, y] == m.get(x, y).
+		"""
+		# Read-only : writing through the buffer would bypass the flags
+		if flags & PyBUF_WRITABLE:
+			raise BufferError('Matrix4x4 buffers are read-only')
+
+		buffer.buf = <char *>self.vals
+		buffer.format = 'f'
+		buffer.internal = NULL
+		buffer.itemsize = sizeof(float)
+		buffer.len = 16 * sizeof(float)
+		buffer.ndim = 2
+		buffer.obj = self
+		buffer.readonly = 1
+		buffer.shape = _MAT_SHAPE
+		buffer.strides = _MAT_STRIDES
+		buffer.suboffsets = NULL
+
+	def __releasebuffer__(self, Py_buffer *buffer):
+		pass
 
 	def __setstate__(self, data):
-		self.is_identity = 0
 		i = 0
 		for f in data['vals']:
 			self.vals[i] = f
 			i += 1
+		self.classify()
 
 	def __reduce__(self):
-		return (_matrix44_unpickle, (), {'vals' : [float(f) for f in self.vals]})
-		# data = ''
-		# for f in self.vals:
-		# 	f = float(f)
-		# 	data += '%f!' % f
-		# return data
+		# 64 bytes (little-endian, like pack_matrices) + the flags packed
+		# in an int
+		raw = np.frombuffer(self.tobytes(), dtype=np.float32).astype('<f4').tobytes()
+		return (_matrix44_from_bytes, (raw, self._get_flags()))
+
+	cdef int _get_flags(self):
+		return self.is_identity | (self.is_affine << 1) | (self.is_rigid << 2)
+
+	cdef _set_flags(self, int flags):
+		self.is_identity = flags & 1
+		self.is_affine = (flags >> 1) & 1
+		self.is_rigid = (flags >> 2) & 1
+
+	cdef _load(self, const unsigned char[:] raw):
+		if raw.shape[0] != 16 * sizeof(float):
+			raise ValueError('A Matrix4x4 needs %d bytes, got %d' % (16 * sizeof(float), raw.shape[0]))
+		memcpy(self.vals, &raw[0], 16 * sizeof(float))
+
+	def tobytes(self):
+		""" The 16 float32 values (native byte order, column-major) as bytes
+		"""
+		return (<char *>self.vals)[:16 * sizeof(float)]
 
-	cpdef inverse(self):
-		cdef float[16] inv
-		cdef float det
-		cdef int i
+	@staticmethod
+	def frombytes(raw):
+		""" Build a matrix from the output of tobytes()
+		"""
+		cdef Matrix4x4 res = Matrix4x4.__new__(Matrix4x4)
+		res._load(raw)
+		res.classify()
+		return res
 
-		inv[0] = self.vals[5]  * self.vals[10] * self.vals[15] - \
-				 self.vals[5]  * self.vals[11] * self.vals[14] - \
-				 self.vals[9]  * self.vals[6]  * self.vals[15] + \
-				 self.vals[9]  * self.vals[7]  * self.vals[14] + \
-				 self.vals[13] * self.vals[6]  * self.vals[11] - \
-				 self.vals[13] * self.vals[7]  * self.vals[10]
-
-		inv[4] = -self.vals[4]  * self.vals[10] * self.vals[15] + \
-				  self.vals[4]  * self.vals[11] * self.vals[14] + \
-				  self.vals[8]  * self.vals[6]  * self.vals[15] - \
-				  self.vals[8]  * self.vals[7]  * self.vals[14] - \
-				  self.vals[12] * self.vals[6]  * self.vals[11] + \
-				  self.vals[12] * self.vals[7]  * self.vals[10]
-
-		inv[8] = self.vals[4]  * self.vals[9] * self.vals[15] - \
-				 self.vals[4]  * self.vals[11] * self.vals[13] - \
-				 self.vals[8]  * self.vals[5] * self.vals[15] + \
-				 self.vals[8]  * self.vals[7] * self.vals[13] + \
-				 self.vals[12] * self.vals[5] * self.vals[11] - \
-				 self.vals[12] * self.vals[7] * self.vals[9]
-
-		inv[12] = -self.vals[4]  * self.vals[9] * self.vals[14] + \
-				   self.vals[4]  * self.vals[10] * self.vals[13] +\
-				   self.vals[8]  * self.vals[5] * self.vals[14] - \
-				   self.vals[8]  * self.vals[6] * self.vals[13] - \
-				   self.vals[12] * self.vals[5] * self.vals[10] + \
-				   self.vals[12] * self.vals[6] * self.vals[9]
-
-		inv[1] = -self.vals[1]  * self.vals[10] * self.vals[15] + \
-				  self.vals[1]  * self.vals[11] * self.vals[14] + \
-				  self.vals[9]  * self.vals[2] * self.vals[15] - \
-				  self.vals[9]  * self.vals[3] * self.vals[14] - \
-				  self.vals[13] * self.vals[2] * self.vals[11] + \
-				  self.vals[13] * self.vals[3] * self.vals[10]
-
-		inv[5] = self.vals[0]  * self.vals[10] * self.vals[15] - \
-				 self.vals[0]  * self.vals[11] * self.vals[14] - \
-				 self.vals[8]  * self.vals[2] * self.vals[15] + \
-				 self.vals[8]  * self.vals[3] * self.vals[14] + \
-				 self.vals[12] * self.vals[2] * self.vals[11] - \
-				 self.vals[12] * self.vals[3] * self.vals[10]
-
-		inv[9] = -self.vals[0]  * self.vals[9] * self.vals[15] + \
-				  self.vals[0]  * self.vals[11] * self.vals[13] + \
-				  self.vals[8]  * self.vals[1] * self.vals[15] - \
-				  self.vals[8]  * self.vals[3] * self.vals[13] - \
-				  self.vals[12] * self.vals[1] * self.vals[11] + \
-				  self.vals[12] * self.vals[3] * self.vals[9]
-
-		inv[13] = self.vals[0]  * self.vals[9] * self.vals[14] - \
-				  self.vals[0]  * self.vals[10] * self.vals[13] - \
-				  self.vals[8]  * self.vals[1] * self.vals[14] + \
-				  self.vals[8]  * self.vals[2] * self.vals[13] + \
-				  self.vals[12] * self.vals[1] * self.vals[10] - \
-				  self.vals[12] * self.vals[2] * self.vals[9]
-
-		inv[2] = self.vals[1]  * self.vals[6] * self.vals[15] - \
-				 self.vals[1]  * self.vals[7] * self.vals[14] - \
-				 self.vals[5]  * self.vals[2] * self.vals[15] + \
-				 self.vals[5]  * self.vals[3] * self.vals[14] + \
-				 self.vals[13] * self.vals[2] * self.vals[7] - \
-				 self.vals[13] * self.vals[3] * self.vals[6]
-
-		inv[6] = -self.vals[0]  * self.vals[6] * self.vals[15] + \
-				  self.vals[0]  * self.vals[7] * self.vals[14] + \
-				  self.vals[4]  * self.vals[2] * self.vals[15] - \
-				  self.vals[4]  * self.vals[3] * self.vals[14] - \
-				  self.vals[12] * self.vals[2] * self.vals[7] + \
-				  self.vals[12] * self.vals[3] * self.vals[6]
-
-		inv[10] = self.vals[0]  * self.vals[5] * self.vals[15] - \
-				  self.vals[0]  * self.vals[7] * self.vals[13] - \
-				  self.vals[4]  * self.vals[1] * self.vals[15] + \
-				  self.vals[4]  * self.vals[3] * self.vals[13] + \
-				  self.vals[12] * self.vals[1] * self.vals[7] - \
-				  self.vals[12] * self.vals[3] * self.vals[5]
-
-		inv[14] = -self.vals[0]  * self.vals[5] * self.vals[14] + \
-				   self.vals[0]  * self.vals[6] * self.vals[13] + \
-				   self.vals[4]  * self.vals[1] * self.vals[14] - \
-				   self.vals[4]  * self.vals[2] * self.vals[13] - \
-				   self.vals[12] * self.vals[1] * self.vals[6] + \
-				   self.vals[12] * self.vals[2] * self.vals[5]
-
-		inv[3] = -self.vals[1] * self.vals[6] * self.vals[11] + \
-				  self.vals[1] * self.vals[7] * self.vals[10] + \
-				  self.vals[5] * self.vals[2] * self.vals[11] - \
-				  self.vals[5] * self.vals[3] * self.vals[10] - \
-				  self.vals[9] * self.vals[2] * self.vals[7] + \
-				  self.vals[9] * self.vals[3] * self.vals[6]
-
-		inv[7] = self.vals[0] * self.vals[6] * self.vals[11] - \
-				 self.vals[0] * self.vals[7] * self.vals[10] - \
-				 self.vals[4] * self.vals[2] * self.vals[11] + \
-				 self.vals[4] * self.vals[3] * self.vals[10] + \
-				 self.vals[8] * self.vals[2] * self.vals[7] - \
-				 self.vals[8] * self.vals[3] * self.vals[6]
-
-		inv[11] = -self.vals[0] * self.vals[5] * self.vals[11] + \
-				   self.vals[0] * self.vals[7] * self.vals[9] + \
-				   self.vals[4] * self.vals[1] * self.vals[11] - \
-				   self.vals[4] * self.vals[3] * self.vals[9] - \
-				   self.vals[8] * self.vals[1] * self.vals[7] + \
-				   self.vals[8] * self.vals[3] * self.vals[5]
-
-		inv[15] = self.vals[0] * self.vals[5] * self.vals[10] - \
-				  self.vals[0] * self.vals[6] * self.vals[9] - \
-				  self.vals[4] * self.vals[1] * self.vals[10] + \
-				  self.vals[4] * self.vals[2] * self.vals[9] + \
-				  self.vals[8] * self.vals[1] * self.vals[6] - \
-				  self.vals[8] * self.vals[2] * self.vals[5]
-
-		det = self.vals[0] * inv[0] + self.vals[1] * inv[4] + \
-				self.vals[2] * inv[8] + self.vals[3] * inv[12]
-
-		if det == 0:
+	cpdef inverse(self):
+		cdef Matrix4x4 res = Matrix4x4()
+		if self.is_identity:
+			return res
+		elif self.is_rigid:
+			_inverse44_rigid(self.vals, res.vals)
+		elif self.is_affine:
+			if not _inverse44_affine(self.vals, res.vals):
+				return None
+		elif not _inverse44(self.vals, res.vals):
 			return None
-
-		det = 1.0 / det;
-		res = Matrix4x4()
 		res.is_identity = self.is_identity
-		for i in range(16):
-			res.vals[i] = inv[i] * det;
+		res.is_affine = self.is_affine
+		res.is_rigid = self.is_rigid
 		return res
 
 	@staticmethod
@@ -319,6 +840,7 @@ cdef class Matrix4x4(object):
 		res.set(2, 2, -forward.z)
 		
 		res.is_identity = 0
+		res.is_rigid = 1
 
 		res = res * Matrix4x4.translation(eye.negated())
 		return res
@@ -335,6 +857,8 @@ cdef class Matrix4x4(object):
 		res.vals[15] = 0.0
 
 		res.is_identity = 0
+		res.is_affine = 0
+		res.is_rigid = 0
 
 		return res
 
@@ -352,6 +876,7 @@ cdef class Matrix4x4(object):
 		res.set(2, 2, -2.0 / (far - near))
 		res.set(3, 2, -(far + near) / (far - near))
 		res.is_identity = 0
+		res.is_rigid = 0
 		return res
 
 	@staticmethod
@@ -362,6 +887,7 @@ cdef class Matrix4x4(object):
 		x_rot.set(1, 2, math.sin(vec3.x))
 		x_rot.set(2, 2, math.cos(vec3.x))
 		x_rot.is_identity = 0
+		x_rot.is_rigid = 1
 
 		y_rot = Matrix4x4()
 		y_rot.set(0, 0, math.cos(vec3.y))
@@ -369,6 +895,7 @@ cdef class Matrix4x4(object):
 		y_rot.set(0, 2, -math.sin(vec3.y))
 		y_rot.set(2, 2, math.cos(vec3.y))
 		y_rot.is_identity = 0
+		y_rot.is_rigid = 1
 
 		z_rot = Matrix4x4()
 		z_rot.set(0, 0, math.cos(vec3.z))
@@ -376,6 +903,7 @@ cdef class Matrix4x4(object):
 		z_rot.set(0, 1, math.sin(vec3.z))
 		z_rot.set(1, 1, math.cos(vec3.z))
 		z_rot.is_identity = 0
+		z_rot.is_rigid = 1
 
 		return x_rot * y_rot * z_rot
 
@@ -395,6 +923,7 @@ cdef class Matrix4x4(object):
 		res.vals[5] = vec3.y
 		res.vals[10] = vec3.z
 		res.is_identity = 0
+		res.is_rigid = 0
 		return res
 
 	def __repr__(self):
@@ -405,55 +934,475 @@ cdef class Matrix4x4(object):
 		return r
 
 	def __mul__(self, other):
-		cdef int i
-		cdef int x
-		cdef int y
-		cdef float s
-
-		if other.is_identity == 1:
-			return self
-		elif self.is_identity == 1:
-			return other
+		cdef Matrix4x4 a, b, result
+
+		if isinstance(other, Matrix4x4Array) or isinstance(self, Matrix4x4Array):
+			return Matrix4x4Array.multiply(self, other)
 		elif type(other) == Matrix4x4:
-			result = Matrix4x4()
+			a = self
+			b = other
+			if b.is_identity == 1:
+				return a
+			elif a.is_identity == 1:
+				return b
+
+			result = Matrix4x4.__new__(Matrix4x4)
 			result.is_identity = 0
-			for x in range(4):
-				for y in range(4):
-					s = 0.0
-					for i in range(4):
-						s += self.get(i, y) * other.get(x, i)
-					result.set(x, y, s)
-
+			if a.is_affine and b.is_affine:
+				_mul44_affine(a.vals, b.vals, result.vals)
+				result.is_affine = 1
+				result.is_rigid = a.is_rigid and b.is_rigid
+			else:
+				_mul44(a.vals, b.vals, result.vals)
+				result.is_affine = 0
+				result.is_rigid = 0
 			return result
 		else:
 			raise Exception('Cannot multiply Matrix4x4 with %s' % repr(type(other)))
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef class Matrix4x4Array(object):
+	""" A contiguous array of N 4x4 matrices, backed by a float32 (N, 4, 4)
+	NumPy array.
+
+	Each matrix is stored like Matrix4x4 (column-major, OpenGL order), so
+	array[i, x, y] == self[i].get(x, y) == numpy.asarray(self[i])[x, y].
+	Indexing returns Matrix4x4 views sharing the array memory, and all the
+	batched operations run in a single native loop.
+	"""
+	cdef float[:, :, ::1] _view
+	cdef readonly object array
+
+	def __init__(self, data=0):
+		""" data -- Either a matrix count (identity filled) or anything
+		            convertible to a float32 (N, 4, 4) array. Contiguous
+		            float32 arrays are shared, not copied.
+		"""
+		try:
+			count = operator.index(data)
+		except TypeError:
+			arr = np.ascontiguousarray(data, dtype=np.float32).reshape((-1, 4, 4))
+		else:
+			arr = np.zeros((count, 4, 4), dtype=np.float32)
+			arr[:] = np.identity(4, dtype=np.float32)
+
+		self.array = arr
+		self._view = arr
+
+	@staticmethod
+	def from_matrices(matrices):
+		""" Pack a sequence of Matrix4x4 into a new array
+		"""
+		cdef Matrix4x4 m
+		cdef Py_ssize_t i = 0
+		matrices = list(matrices)
+		cdef Matrix4x4Array res = Matrix4x4Array(np.empty((len(matrices), 4, 4), dtype=np.float32))
+		for m in matrices:
+			memcpy(&res._view[i, 0, 0], m.vals, 16 * sizeof(float))
+			i += 1
+		return res
+
+	cdef inline float *_ptr(self, Py_ssize_t i) noexcept nogil:
+		return &self._view[i, 0, 0]
+
+	cdef Py_ssize_t _index(self, Py_ssize_t i) except -1:
+		cdef Py_ssize_t n = self._view.shape[0]
+		if i < 0:
+			i += n
+		if i < 0 or i >= n:
+			raise IndexError('Matrix4x4Array index out of range')
+		return i
+
+	def __len__(self):
+		return self._view.shape[0]
+
+	def __getitem__(self, Py_ssize_t i):
+		""" Return a Matrix4x4 view on the i-th matrix (no copy)
+		"""
+		cdef Matrix4x4 m = Matrix4x4.__new__(Matrix4x4)
+		m.vals = self._ptr(self._index(i))
+		m._owner = self
+		m.is_identity = 0
+		return m
+
+	def __setitem__(self, Py_ssize_t i, Matrix4x4 m not None):
+		memcpy(self._ptr(self._index(i)), m.vals, 16 * sizeof(float))
+
+	def __array__(self, dtype=None, copy=None):
+		if dtype is None:
+			return self.array
+		return self.array.astype(dtype)
+
+	def __mul__(self, other):
+		return Matrix4x4Array.multiply(self, other)
+
+	@staticmethod
+	def multiply(a, b, Matrix4x4Array out=None):
+		""" Batched a[i] * b[i]. Either operand can be a single Matrix4x4,
+		which is then applied to every matrix of the other one.
+
+		out -- Optional destination array (can be a or b)
+		"""
+		cdef Matrix4x4Array arr_a = None, arr_b = None
+		cdef Matrix4x4 mat_a = None, mat_b = None
+		cdef Py_ssize_t i, n
+		cdef float *pa
+		cdef float *pb
+
+		if isinstance(a, Matrix4x4):
+			mat_a = a
+		else:
+			arr_a = a
+		if isinstance(b, Matrix4x4):
+			mat_b = b
+		else:
+			arr_b = b
+
+		if arr_a is None and arr_b is None:
+			n = 1
+		elif arr_a is None:
+			n = len(arr_b)
+		elif arr_b is None:
+			n = len(arr_a)
+		else:
+			n = len(arr_a)
+			if len(arr_b) != n:
+				raise ValueError('Cannot multiply arrays of %d and %d matrices' % (n, len(arr_b)))
+
+		if out is None:
+			out = Matrix4x4Array(np.empty((n, 4, 4), dtype=np.float32))
+		elif len(out) != n:
+			raise ValueError('Output array must hold %d matrices' % n)
+
+		if n == 0:
+			return out
+
+		pa = mat_a.vals if arr_a is None else arr_a._ptr(0)
+		pb = mat_b.vals if arr_b is None else arr_b._ptr(0)
+
+		with nogil:
+			for i in range(n):
+				_mul44(pa if arr_a is None else pa + i * 16,
+				       pb if arr_b is None else pb + i * 16,
+				       out._ptr(i))
+		return out
+
+	def inverse(self):
+		""" Return a new array with all matrices inverted. Singular matrices
+		are filled with NaN.
+		"""
+		cdef Py_ssize_t i, j, n = len(self)
+		cdef Matrix4x4Array res = Matrix4x4Array(np.empty((n, 4, 4), dtype=np.float32))
+		cdef float nan = float('nan')
+		with nogil:
+			for i in range(n):
+				if not _inverse44(self._ptr(i), res._ptr(i)):
+					for j in range(16):
+						res._ptr(i)[j] = nan
+		return res
+
+	def transpose(self):
+		""" Return a new array with all matrices transposed
+		"""
+		cdef Py_ssize_t i, n = len(self)
+		cdef int x, y
+		cdef Matrix4x4Array res = Matrix4x4Array(np.empty((n, 4, 4), dtype=np.float32))
+		with nogil:
+			for i in range(n):
+				for x in range(4):
+					for y in range(4):
+						res._view[i, y, x] = self._view[i, x, y]
+		return res
+
+	@staticmethod
+	def translation(vecs):
+		""" Build N translation matrices from a (N, 3) array-like
+		"""
+		cdef float[:, ::1] v = np.ascontiguousarray(vecs, dtype=np.float32).reshape((-1, 3))
+		cdef Py_ssize_t i, n = v.shape[0]
+		cdef Matrix4x4Array res = Matrix4x4Array(n)
+		with nogil:
+			for i in range(n):
+				res._view[i, 3, 0] = v[i, 0]
+				res._view[i, 3, 1] = v[i, 1]
+				res._view[i, 3, 2] = v[i, 2]
+		return res
+
+	@staticmethod
+	def scale(vecs):
+		""" Build N scale matrices from a (N, 3) array-like
+		"""
+		cdef float[:, ::1] v = np.ascontiguousarray(vecs, dtype=np.float32).reshape((-1, 3))
+		cdef Py_ssize_t i, n = v.shape[0]
+		cdef Matrix4x4Array res = Matrix4x4Array(n)
+		with nogil:
+			for i in range(n):
+				res._view[i, 0, 0] = v[i, 0]
+				res._view[i, 1, 1] = v[i, 1]
+				res._view[i, 2, 2] = v[i, 2]
+		return res
+
+	@staticmethod
+	def rotation(angles):
+		""" Build N rotation matrices from a (N, 3) array-like of euler angles,
+		with the same convention as Matrix4x4.rotation
+		"""
+		cdef float[:, ::1] v = np.ascontiguousarray(angles, dtype=np.float32).reshape((-1, 3))
+		cdef Py_ssize_t i, n = v.shape[0]
+		cdef Matrix4x4Array res = Matrix4x4Array(np.empty((n, 4, 4), dtype=np.float32))
+		with nogil:
+			for i in range(n):
+				_rotation44(v[i, 0], v[i, 1], v[i, 2], res._ptr(i))
+		return res
+
+	def tobytes(self):
+		""" All the matrices as one contiguous float32 buffer (native byte
+		order, see pack_matrices for a portable one)
+		"""
+		return self.array.tobytes()
+
+	@staticmethod
+	def frombytes(raw):
+		""" Build an array from the output of tobytes()
+		"""
+		return Matrix4x4Array(np.frombuffer(raw, dtype=np.float32).copy())
+
+	def __repr__(self):
+		return 'Matrix4x4Array(%d)' % len(self)
+
+cdef inline int _aabb_outside(const float *planes, float cx, float cy, float cz,
+		float ex, float ey, float ez) noexcept nogil:
+	cdef int p
+	cdef const float *pl
+	for p in range(6):
+		pl = planes + p * 4
+		if pl[0] * cx + pl[1] * cy + pl[2] * cz + pl[3] + \
+				fabs(pl[0]) * ex + fabs(pl[1]) * ey + fabs(pl[2]) * ez < 0.0:
+			return 1
+	return 0
+
+cdef inline int _sphere_outside(const float *planes, float cx, float cy, float cz,
+		float r) noexcept nogil:
+	cdef int p
+	cdef const float *pl
+	for p in range(6):
+		pl = planes + p * 4
+		if pl[0] * cx + pl[1] * cy + pl[2] * cz + pl[3] < -r:
+			return 1
+	return 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.final
+cdef class Frustum(object):
+	""" A view frustum, as 6 normalized planes (left, right, bottom, top, near,
+	far) pointing inwards, extracted from a view-projection matrix.
+
+	The test_* methods check packed arrays of bounding volumes at once and
+	return a uint8 visibility mask (1 = potentially visible).
+	"""
+	cdef float planes_[24]
+
+	def __init__(self, Matrix4x4 viewproj not None):
+		cdef const float *m = viewproj.vals
+		cdef int p, i
+		cdef float sign, norm
+		cdef float *pl
+
+		# Gribb & Hartmann : planes are row3 +/- row0, row1, row2
+		for p in range(6):
+			i = p // 2
+			sign = 1.0 if p % 2 == 0 else -1.0
+			pl = self.planes_ + p * 4
+			pl[0] = m[3 ] + sign * m[i]
+			pl[1] = m[7 ] + sign * m[4 + i]
+			pl[2] = m[11] + sign * m[8 + i]
+			pl[3] = m[15] + sign * m[12 + i]
+
+			norm = sqrt(pl[0] * pl[0] + pl[1] * pl[1] + pl[2] * pl[2])
+			if norm != 0.0:
+				pl[0] /= norm ; pl[1] /= norm ; pl[2] /= norm ; pl[3] /= norm
+
+	@staticmethod
+	def from_camera(camera):
+		return Frustum(camera.proj * camera.view)
+
+	@property
+	def planes(self):
+		""" The planes as a (6, 4) array of (a, b, c, d), with ax + by + cz + d
+		>= 0 inside
+		"""
+		return np.array([self.planes_[i] for i in range(24)], dtype=np.float32).reshape((6, 4))
+
+	def contains_sphere(self, sphere):
+		c = sphere.center
+		return not _sphere_outside(self.planes_, c.x, c.y, c.z, sphere.radii)
+
+	def contains_aabb(self, aabb):
+		mn, mx = aabb.min, aabb.max
+		return not _aabb_outside(self.planes_,
+			(mn.x + mx.x) * 0.5, (mn.y + mx.y) * 0.5, (mn.z + mx.z) * 0.5,
+			(mx.x - mn.x) * 0.5, (mx.y - mn.y) * 0.5, (mx.z - mn.z) * 0.5)
+
+	def test_spheres(self, centers, radii):
+		""" centers -- (N, 3) array-like
+		radii -- (N,) array-like
+		"""
+		cdef float[:, ::1] c = np.ascontiguousarray(centers, dtype=np.float32).reshape((-1, 3))
+		cdef float[::1] r = np.ascontiguousarray(radii, dtype=np.float32).reshape(-1)
+		cdef Py_ssize_t i, n = c.shape[0]
+		if r.shape[0] != n:
+			raise ValueError('Got %d centers and %d radii' % (n, r.shape[0]))
+
+		mask = np.empty(n, dtype=np.uint8)
+		cdef unsigned char[::1] res = mask
+		with nogil:
+			for i in range(n):
+				res[i] = not _sphere_outside(self.planes_, c[i, 0], c[i, 1], c[i, 2], r[i])
+		return mask
+
+	def test_aabbs(self, mins, maxs):
+		""" mins, maxs -- (N, 3) array-likes of world space box corners
+		"""
+		cdef float[:, ::1] mn = np.ascontiguousarray(mins, dtype=np.float32).reshape((-1, 3))
+		cdef float[:, ::1] mx = np.ascontiguousarray(maxs, dtype=np.float32).reshape((-1, 3))
+		cdef Py_ssize_t i, n = mn.shape[0]
+		if mx.shape[0] != n:
+			raise ValueError('Got %d min and %d max corners' % (n, mx.shape[0]))
+
+		mask = np.empty(n, dtype=np.uint8)
+		cdef unsigned char[::1] res = mask
+		with nogil:
+			for i in range(n):
+				res[i] = not _aabb_outside(self.planes_,
+					(mn[i, 0] + mx[i, 0]) * 0.5, (mn[i, 1] + mx[i, 1]) * 0.5, (mn[i, 2] + mx[i, 2]) * 0.5,
+					(mx[i, 0] - mn[i, 0]) * 0.5, (mx[i, 1] - mn[i, 1]) * 0.5, (mx[i, 2] - mn[i, 2]) * 0.5)
+		return mask
+
+	def test_local_aabbs(self, mins, maxs, Matrix4x4Array matrices):
+		""" Same as test_aabbs, with local space boxes transformed by
+		matrices[i] (conservatively, as the box enclosing the transformed box)
+		"""
+		cdef float[:, ::1] mn = np.ascontiguousarray(mins, dtype=np.float32).reshape((-1, 3))
+		cdef float[:, ::1] mx = np.ascontiguousarray(maxs, dtype=np.float32).reshape((-1, 3))
+		cdef Py_ssize_t i, n = mn.shape[0]
+		cdef float[3] wmn, wmx
+		if mx.shape[0] != n or len(matrices) != n:
+			raise ValueError('Got %d min, %d max corners and %d matrices' % (n, mx.shape[0], len(matrices)))
+
+		mask = np.empty(n, dtype=np.uint8)
+		cdef unsigned char[::1] res = mask
+		with nogil:
+			for i in range(n):
+				_transform_aabb(matrices._ptr(i), &mn[i, 0], &mx[i, 0], wmn, wmx)
+				res[i] = not _aabb_outside(self.planes_,
+					(wmn[0] + wmx[0]) * 0.5, (wmn[1] + wmx[1]) * 0.5, (wmn[2] + wmx[2]) * 0.5,
+					(wmx[0] - wmn[0]) * 0.5, (wmx[1] - wmn[1]) * 0.5, (wmx[2] - wmn[2]) * 0.5)
+		return mask
+
 class Transform(object):
 	""" A transform object, that enable parenting (hierarchy)
+
+	World matrices are computed lazily : changing a matrix only marks its
+	subtree as dirty, and the world matrices are recomputed on the first
+	premul_matrix read (or by an explicit flush()).
 	"""
 	def __init__(self, mat=Matrix4x4()):
 		self._children = set()
+		self._parent = None
 		self._matrix = mat
 		self._mulmat = mat
-		self._parentmat = Matrix4x4()
+		self._dirty = False
+		self._dirty_below = False   # Some descendant may be dirty
+		self._version = 0
 
-	def _update(self):
-		""" Recompute needed matrices to suit the latest changes
+		# Called with this transform each time it gets dirty
+		self._listeners = set()
+
+	def add_listener(self, callback):
+		""" Call callback(transform) each time this transform gets dirty
+		"""
+		self._listeners.add(callback)
+
+	def remove_listener(self, callback):
+		self._listeners.discard(callback)
+
+	def _mark_dirty(self):
+		""" Mark this transform and its subtree as needing an update
 		"""
-		self._mulmat = self._parentmat * self._matrix
+		# Invariant : the subtree of a dirty transform is dirty, so we can
+		# stop at the first already dirty transform
+		if self._dirty:
+			return
+		self._dirty = True
+		if self._listeners:
+			for callback in list(self._listeners):
+				callback(self)
+		self._flag_ancestors()
 		for childtf in self._children:
-			childtf._parentmat = self._mulmat
-			childtf._update()
+			childtf._mark_dirty()
+
+	def _flag_ancestors(self):
+		""" Let flush() find this dirty subtree from the roots
+		"""
+		tf = self._parent
+		while tf is not None and not tf._dirty_below:
+			tf._dirty_below = True
+			tf = tf._parent
+
+	def _update(self):
+		""" Recompute the world matrix. The parent must be up to date.
+		"""
+		if self._parent is None:
+			self._mulmat = self._matrix
+		else:
+			self._mulmat = self._parent._mulmat * self._matrix
+		self._dirty = False
+		self._version += 1
+		Stats.transforms_updated += 1
 
 	def add_child(self, childtf):
+		if childtf._parent is not None:
+			childtf._parent.remove_child(childtf)
 		self._children.add(childtf)
-		childtf._parentmat = self._mulmat
-		childtf._update()
+		childtf._parent = self
+		childtf._mark_dirty()
+		childtf._flag_ancestors()
 
 	def remove_child(self, childtf):
 		assert childtf in self._children
-		childtf._parentmat = Matrix4x4()
-		childtf._update()
+		self._children.remove(childtf)
+		childtf._parent = None
+		childtf._mark_dirty()
+
+	def flush(self):
+		""" Recompute all the dirty world matrices of this subtree at once
+		(typically once per frame, on the root transforms)
+		"""
+		stack = [self]
+		while len(stack) != 0:
+			tf = stack.pop()
+			if tf._dirty:
+				tf.premul_matrix
+			elif not tf._dirty_below:
+				# Clean subtree
+				continue
+			tf._dirty_below = False
+			stack.extend(tf._children)
+
+	@property
+	def parent(self):
+		return self._parent
+
+	@property
+	def version(self):
+		""" Incremented each time the world matrix changes, to invalidate
+		data derived from it
+		"""
+		if self._dirty:
+			self.premul_matrix
+		return self._version
 
 	@property
 	def matrix(self):
@@ -462,10 +1411,473 @@ class Transform(object):
 	@matrix.setter
 	def matrix(self, value):
 		self._matrix = value
-		self._update()
+		self._mark_dirty()
 
 	@property
 	def premul_matrix(self):
 		""" This is the matrix taking into account the whole hierarchy
 		"""
+		if self._dirty:
+			# Update the dirty ancestors first, from the top
+			chain = []
+			tf = self
+			while tf is not None and tf._dirty:
+				chain.append(tf)
+				tf = tf._parent
+			for tf in reversed(chain):
+				tf._update()
 		return self._mulmat
+
+@cython.final
+cdef class TransformHandle(object):
+	""" A lightweight Transform-like handle on an entry of a TransformGraph
+
+	It has the same interface as Transform. Matrices returned by matrix and
+	premul_matrix are views on the graph storage : they are only valid until
+	the graph is resized or reordered, and in-place changes to them must be
+	assigned back to matrix to be taken into account.
+	"""
+	cdef readonly TransformGraph graph
+	cdef Py_ssize_t _index
+
+	cdef inline Py_ssize_t _checked_index(self) except -1:
+		if self._index < 0:
+			raise ValueError('This transform has been removed from its graph')
+		return self._index
+
+	@property
+	def index(self):
+		""" The current slot of the transform in the graph storage
+		"""
+		return self._index
+
+	def add_child(self, TransformHandle childtf):
+		self.graph._set_parent(childtf, self)
+
+	def remove_child(self, TransformHandle childtf):
+		assert childtf.parent is self
+		self.graph._set_parent(childtf, None)
+
+	def flush(self):
+		self.graph.update()
+
+	@property
+	def version(self):
+		""" The graph stamp of the last world matrix change
+		"""
+		self._checked_index()
+		self.graph.update()
+		return self.graph._versions[self._index]
+
+	@property
+	def parent(self):
+		cdef int p = self.graph._parents[self._checked_index()]
+		if p < 0:
+			return None
+		return self.graph._handles[p]
+
+	@property
+	def matrix(self):
+		cdef Py_ssize_t i = self._checked_index()
+		return self.graph._view(self.graph._local, i, self.graph._affine[i])
+
+	@matrix.setter
+	def matrix(self, Matrix4x4 value not None):
+		cdef Py_ssize_t i = self._checked_index()
+		memcpy(self.graph._local._ptr(i), value.vals, 16 * sizeof(float))
+		self.graph._affine[i] = value.is_affine
+		self.graph._dirty[i] = 1
+		self.graph._any_dirty = 1
+
+	@property
+	def premul_matrix(self):
+		""" This is the matrix taking into account the whole hierarchy
+		"""
+		self._checked_index()
+		self.graph.update()
+		return self.graph._view(self.graph._world, self._index, self.graph._world_affine[self._index])
+
+	def detached(self):
+		""" Return a plain root Transform with the current world matrix of
+		this transform, to be used out of the graph
+		"""
+		cdef Matrix4x4 m = Matrix4x4.__new__(Matrix4x4)
+		self._checked_index()
+		self.graph.update()
+		memcpy(m.vals, self.graph._world._ptr(self._index), 16 * sizeof(float))
+		m.is_affine = self.graph._world_affine[self._index]
+		return Transform(m)
+
+
+cdef _permuted_flags(unsigned char[::1] flags, order, Py_ssize_t capacity):
+	res = np.zeros(capacity, dtype=np.uint8)
+	res[:len(order)] = np.asarray(flags)[order]
+	return res
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.final
+cdef class TransformGraph(object):
+	""" Flattened storage for a transform hierarchy.
+
+	Local and world matrices live in contiguous Matrix4x4Arrays, with an
+	array of parent indices kept in parent-before-child order. update()
+	computes all the dirty world matrices in a single native pass.
+	Transforms are manipulated through TransformHandle objects.
+	"""
+	cdef Matrix4x4Array _local
+	cdef Matrix4x4Array _world
+	cdef int[::1] _parents
+	cdef unsigned char[::1] _dirty
+	cdef unsigned char[::1] _affine
+	cdef unsigned char[::1] _world_affine
+	cdef unsigned int[::1] _versions
+	cdef Py_ssize_t _count
+	cdef list _handles
+	cdef int _unsorted
+	cdef int _any_dirty
+	cdef object _adopted
+	cdef readonly unsigned int stamp
+
+	def __init__(self, Py_ssize_t capacity=64):
+		self.stamp = 0
+		self._count = 0
+		self._handles = []
+		self._unsorted = 0
+		self._any_dirty = 0
+		self._adopted = weakref.WeakKeyDictionary()
+		self._allocate(max(capacity, 1))
+
+	cdef _allocate(self, Py_ssize_t capacity):
+		cdef Py_ssize_t n = self._count
+		local = Matrix4x4Array(capacity)
+		world = Matrix4x4Array(capacity)
+		parents = np.full(capacity, -1, dtype=np.intc)
+		dirty = np.zeros(capacity, dtype=np.uint8)
+		affine = np.zeros(capacity, dtype=np.uint8)
+		world_affine = np.zeros(capacity, dtype=np.uint8)
+		versions = np.zeros(capacity, dtype=np.uintc)
+
+		if n != 0:
+			local.array[:n] = self._local.array[:n]
+			world.array[:n] = self._world.array[:n]
+			parents[:n] = self._parents[:n]
+			dirty[:n] = self._dirty[:n]
+			affine[:n] = self._affine[:n]
+			world_affine[:n] = self._world_affine[:n]
+			versions[:n] = self._versions[:n]
+
+		self._local = local
+		self._world = world
+		self._parents = parents
+		self._dirty = dirty
+		self._affine = affine
+		self._world_affine = world_affine
+		self._versions = versions
+
+	cdef Matrix4x4 _view(self, Matrix4x4Array arr, Py_ssize_t i, int affine):
+		cdef Matrix4x4 m = arr[i]
+		m.is_affine = affine
+		return m
+
+	def __len__(self):
+		self._sort_if_needed()
+		return self._count
+
+	@property
+	def parents(self):
+		""" Parent indices (-1 for roots) of the transforms, as a NumPy array
+		"""
+		self._sort_if_needed()
+		return np.asarray(self._parents)[:self._count]
+
+	@property
+	def local(self):
+		self._sort_if_needed()
+		return Matrix4x4Array(self._local.array[:self._count])
+
+	@property
+	def world(self):
+		self.update()
+		return Matrix4x4Array(self._world.array[:self._count])
+
+	def create(self, Matrix4x4 mat=None, TransformHandle parent=None):
+		""" Add a new transform to the graph and return its handle
+		"""
+		cdef Py_ssize_t i
+		cdef TransformHandle h
+
+		if self._count == len(self._local):
+			self._allocate(2 * len(self._local))
+
+		i = self._count
+		self._count += 1
+
+		h = TransformHandle.__new__(TransformHandle)
+		h.graph = self
+		h._index = i
+		self._handles.append(h)
+
+		self._parents[i] = -1
+		if mat is None:
+			_identity44(self._local._ptr(i))
+			self._affine[i] = 1
+		else:
+			memcpy(self._local._ptr(i), mat.vals, 16 * sizeof(float))
+			self._affine[i] = mat.is_affine
+		self._dirty[i] = 1
+		self._any_dirty = 1
+
+		if parent is not None:
+			self._set_parent(h, parent)
+		return h
+
+	def adopt(self, tf):
+		""" Return the handle matching a Transform (or a handle of this graph),
+		creating it and the ones of its ancestors if needed.
+
+		The matrices and the hierarchy are copied : the handles are not
+		updated when the Transform objects change afterwards.
+		"""
+		if isinstance(tf, TransformHandle):
+			if (<TransformHandle>tf).graph is not self:
+				raise ValueError('The transform belongs to another graph')
+			return tf
+
+		h = self._adopted.get(tf)
+		if h is None or (<TransformHandle>h)._index < 0:
+			parent = None if tf.parent is None else self.adopt(tf.parent)
+			h = self.create(tf.matrix, parent)
+			self._adopted[tf] = h
+		return h
+
+	def remove(self, TransformHandle handle):
+		""" Remove a transform from the graph. Its children become roots.
+		"""
+		cdef Py_ssize_t i = handle._checked_index()
+		if handle.graph is not self:
+			raise ValueError('The transform belongs to another graph')
+
+		# Slots are compacted, and the children re-rooted, on the next sort
+		self._parents[i] = -2
+		self._handles[i] = None
+		handle._index = -1
+		self._unsorted = 1
+
+	cdef _set_parent(self, TransformHandle child, TransformHandle parent):
+		cdef Py_ssize_t c = child._checked_index()
+		cdef Py_ssize_t p = -1
+		cdef int j
+
+		if child.graph is not self:
+			raise ValueError('The transform belongs to another graph')
+
+		if parent is not None:
+			if parent.graph is not self:
+				raise ValueError('Cannot parent transforms of different graphs')
+			p = parent._checked_index()
+
+			# Refuse cycles
+			j = p
+			while j >= 0:
+				if j == c:
+					raise ValueError('A transform cannot be parented to its own subtree')
+				j = self._parents[j]
+
+		self._parents[c] = p
+		self._dirty[c] = 1
+		self._any_dirty = 1
+		if p > c:
+			self._unsorted = 1
+
+	cdef _sort_if_needed(self):
+		if self._unsorted:
+			self._sort()
+
+	cdef _sort(self):
+		""" Restore the parent-before-child order, by sorting on depth, and
+		compact the removed slots
+		"""
+		cdef Py_ssize_t i, j, k, n = self._count
+		cdef int base
+		cdef Py_ssize_t alive = 0
+		cdef int[::1] depth = np.full(n, -1, dtype=np.intc)
+		cdef Py_ssize_t[::1] stack = np.empty(n, dtype=np.intp)
+
+		for i in range(n):
+			j = self._parents[i]
+			if j == -2:
+				depth[i] = n + 1
+				continue
+			alive += 1
+			if j >= 0 and self._parents[j] == -2:
+				# The parent was removed
+				self._parents[i] = -1
+				self._dirty[i] = 1
+				self._any_dirty = 1
+
+		for i in range(n):
+			k = 0
+			j = i
+			while j >= 0 and depth[j] == -1:
+				stack[k] = j
+				k += 1
+				j = self._parents[j]
+			base = -1 if j < 0 else depth[j]
+			while k > 0:
+				k -= 1
+				base += 1
+				depth[stack[k]] = base
+
+		order = np.argsort(np.asarray(depth), kind='mergesort')[:alive]
+		remap = np.full(n, -1, dtype=np.intc)
+		remap[order] = np.arange(alive, dtype=np.intc)
+
+		parents = np.asarray(self._parents)[order]
+		parents = np.where(parents >= 0, remap[np.maximum(parents, 0)], -1)
+
+		capacity = len(self._local)
+		local = Matrix4x4Array(capacity)
+		world = Matrix4x4Array(capacity)
+		local.array[:alive] = self._local.array[order]
+		world.array[:alive] = self._world.array[order]
+		self._local = local
+		self._world = world
+
+		new_parents = np.full(capacity, -1, dtype=np.intc)
+		new_parents[:alive] = parents
+		self._parents = new_parents
+		self._dirty = _permuted_flags(self._dirty, order, capacity)
+		self._affine = _permuted_flags(self._affine, order, capacity)
+		self._world_affine = _permuted_flags(self._world_affine, order, capacity)
+		versions = np.zeros(capacity, dtype=np.uintc)
+		versions[:alive] = np.asarray(self._versions)[order]
+		self._versions = versions
+
+		handles = [self._handles[o] for o in order]
+		for i in range(alive):
+			(<TransformHandle>handles[i])._index = i
+		self._handles = handles
+		self._count = alive
+		self._unsorted = 0
+
+	def update(self):
+		""" Compute the dirty world matrices in a single pass, returning how
+		many were recomputed
+		"""
+		cdef Py_ssize_t i, n
+		cdef Py_ssize_t updated = 0
+		cdef int p
+
+		self._sort_if_needed()
+		if not self._any_dirty:
+			return 0
+
+		n = self._count
+		self.stamp += 1
+		with nogil:
+			for i in range(n):
+				p = self._parents[i]
+				if p >= 0 and self._dirty[p]:
+					self._dirty[i] = 1
+				if not self._dirty[i]:
+					continue
+
+				if p < 0:
+					memcpy(self._world._ptr(i), self._local._ptr(i), 16 * sizeof(float))
+					self._world_affine[i] = self._affine[i]
+				elif self._world_affine[p] and self._affine[i]:
+					_mul44_affine(self._world._ptr(p), self._local._ptr(i), self._world._ptr(i))
+					self._world_affine[i] = 1
+				else:
+					_mul44(self._world._ptr(p), self._local._ptr(i), self._world._ptr(i))
+					self._world_affine[i] = 0
+				self._versions[i] = self.stamp
+				updated += 1
+
+			# Cleared afterwards : children look at their parent flag
+			for i in range(n):
+				self._dirty[i] = 0
+
+		self._any_dirty = 0
+		Stats.transforms_updated += updated
+		return updated
+
+	def updated_since(self, unsigned int stamp):
+		""" Update, then return the handles whose world matrix changed after
+		the given stamp (a previous value of self.stamp)
+		"""
+		self.update()
+		changed = np.flatnonzero(np.asarray(self._versions[:self._count]) > stamp)
+		return [self._handles[i] for i in changed]
+
+
+_TRANSFORMS_MAGIC = b'PGTF'
+
+def pack_matrices(matrices):
+	""" Serialize a sequence of Matrix4x4 into a single buffer of N * 64 bytes
+	(little-endian float32, column-major)
+	"""
+	return Matrix4x4Array.from_matrices(matrices).array.astype('<f4').tobytes()
+
+def unpack_matrices(raw):
+	""" Deserialize the output of pack_matrices into a list of Matrix4x4
+	"""
+	cdef Matrix4x4Array arr = Matrix4x4Array(
+		np.frombuffer(raw, dtype='<f4').astype(np.float32).reshape((-1, 4, 4)))
+	cdef Matrix4x4 m
+	cdef Py_ssize_t i
+	res = []
+	for i in range(len(arr)):
+		m = Matrix4x4.__new__(Matrix4x4)
+		memcpy(m.vals, arr._ptr(i), 16 * sizeof(float))
+		m.classify()
+		res.append(m)
+	return res
+
+def pack_transforms(transforms):
+	""" Serialize a sequence of Transforms (or TransformHandles) into a single
+	buffer : their local matrices and the index of their parent in the
+	sequence (-1 if it is not part of it). Everything is little-endian.
+	"""
+	transforms = list(transforms)
+	index = dict((id(tf), i) for i, tf in enumerate(transforms))
+	parents = np.array(
+		[-1 if tf.parent is None else index.get(id(tf.parent), -1) for tf in transforms],
+		dtype='<i4')
+	header = np.array([len(transforms)], dtype='<u4')
+	return b''.join((
+		_TRANSFORMS_MAGIC,
+		header.tobytes(),
+		parents.tobytes(),
+		pack_matrices([tf.matrix for tf in transforms]),
+	))
+
+def unpack_transforms(raw, graph=None):
+	""" Deserialize the output of pack_transforms, rebuilding the hierarchy.
+
+	graph -- If given, a TransformGraph in which handles are created instead
+	         of Transform objects
+	"""
+	raw = memoryview(raw)
+	if raw[:4].tobytes() != _TRANSFORMS_MAGIC:
+		raise ValueError('Not a serialized transform buffer')
+	count = int(np.frombuffer(raw[4:8], dtype='<u4')[0])
+	parents = np.frombuffer(raw[8:8 + count * 4], dtype='<i4')
+	matrices = unpack_matrices(raw[8 + count * 4:])
+	if len(matrices) != count:
+		raise ValueError('Truncated transform buffer')
+
+	res = [None] * count
+	pending = []
+	for i in range(count):
+		if graph is None:
+			res[i] = Transform(matrices[i])
+		else:
+			res[i] = graph.create(matrices[i])
+		if parents[i] >= 0:
+			pending.append(i)
+
+	for i in pending:
+		res[parents[i]].add_child(res[i])
+	return res
@@ -5,9 +5,11 @@ from ctypes import *
 import cPickle
 import logging
 
-from pogle_math import Matrix4x4, AABB, Vector, Transform
+import numpy as np
+
+from pogle_math import Matrix4x4, Matrix4x4Array, AABB, Vector, Transform
 from pogle_scene import SceneNode
-from pogle_bufferobject import BufferObject
+from pogle_bufferobject import BufferObject, InstanceBuffer
 from pogle_opengl import *
 from pogle_stats import Stats
 
@@ -88,6 +90,37 @@ class GeometryNode(SceneNode):
 
         self.material = material
 
+        # World bounds cache, keyed by what they are derived from
+        self._world_key = None
+        self._world_aabb = None
+        self._world_sphere = None
+
+    def _update_world_bounds(self):
+        aabb = getattr(self.geom, 'aabb', None)
+        key = (self.transform, self.transform.version, aabb)
+        if key != self._world_key:
+            self._world_key = key
+            if aabb is None:
+                self._world_aabb = self._world_sphere = None
+            else:
+                self._world_aabb = aabb.transformed(self.transform.premul_matrix)
+                self._world_sphere = self._world_aabb.to_bounding_sphere()
+
+    @property
+    def world_aabb(self):
+        """ The geometry AABB in world space (None if the geometry has no AABB).
+        Only recomputed when the node transform changes.
+        """
+        self._update_world_bounds()
+        return self._world_aabb
+
+    @property
+    def world_sphere(self):
+        """ The bounding sphere of world_aabb
+        """
+        self._update_world_bounds()
+        return self._world_sphere
+
     @property
     def material(self):
         return self._material
@@ -97,7 +130,7 @@ class GeometryNode(SceneNode):
         if self._material != val:
             self._material = val
             if self.scene != None:
-                self.scene.mark_renderlist_as_dirty()
+                self.scene.node_material_changed(self)
 
     def render(self, renderer):
         self.geom.draw(renderer)
@@ -199,19 +232,164 @@ class DynamicGeom(object):
         Stats.drawcalls += 1
 
 
+def _setup_attribs(attrib_type):
+    """ Point the attributes of the bound VAO to the bound vertex buffer
+    """
+    attrib_type_size = sizeof(attrib_type)
+    attrib_id = 0
+    for attrib, details in zip(attrib_type._fields_, attrib_type._attribs_):
+        glEnableVertexAttribArray(attrib_id)
+        attrib_name = attrib[0]
+        attrib_size = details[0]
+        attrib_gltype = details[1]
+        attrib_normalized = details[2]
+        glVertexAttribPointer(attrib_id, attrib_size, attrib_gltype, attrib_normalized, attrib_type_size,
+                              ctypes.c_void_p(getattr(attrib_type, attrib_name).offset))
+        attrib_id += 1
+
+
+def _drawmode(renderer):
+    # If tessellation is enabled, it has to be rendered as patch
+    # Else, as simple triangles
+    if renderer.current_material._shader.has_tessellation:
+        return GL_PATCHES
+    return GL_TRIANGLES
+
+
+class GeometryArena(object):
+    """ Vertex and index buffers shared by geometries of a same attrib
+    struct. They all use the arena VAO, so a batch of them can be drawn with
+    a single glMultiDrawElementsIndirect (OpenGL 4.3).
+    """
+
+    def __init__(self, attrib_type=DefaultAttribStruct, vertex_capacity=65536,
+                 index_capacity=3 * 65536):
+        self.attrib_type = attrib_type
+        self.vertex_count = 0
+        self.index_count = 0
+        self.vertex_capacity = vertex_capacity
+        self.index_capacity = index_capacity
+
+        self.vao = VAO()
+        self.indices_vbo = BufferObject(GL_ELEMENT_ARRAY_BUFFER, sizeof(GLuint) * index_capacity, GL_STATIC_DRAW)
+        self.vbo = BufferObject(GL_ARRAY_BUFFER, sizeof(attrib_type) * vertex_capacity, GL_STATIC_DRAW)
+        _setup_attribs(attrib_type)
+
+        # Streamed at each draw_indirect
+        self._commands = None
+        self._instances = None
+
+    @staticmethod
+    def _grown(buf, used, size):
+        """ Return a bigger copy of the buffer object
+        """
+        new = BufferObject(buf.target, size, GL_STATIC_DRAW)
+        glBindBuffer(GL_COPY_READ_BUFFER, buf.glid)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, new.glid)
+        glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, 0, 0, used)
+        return new
+
+    def _reserve(self, vertex_count, index_count):
+        # The element buffer binding is part of the VAO state : the new index
+        # buffer (bound when created) and the unbinding of the old one must
+        # not reach the VAO of another geometry
+        self.vao.bind()
+
+        if vertex_count > self.vertex_capacity:
+            self.vertex_capacity = max(vertex_count, 2 * self.vertex_capacity)
+            stride = sizeof(self.attrib_type)
+            self.vbo = GeometryArena._grown(self.vbo, self.vertex_count * stride,
+                                            self.vertex_capacity * stride)
+            self.vbo.bind()
+            _setup_attribs(self.attrib_type)
+
+        if index_count > self.index_capacity:
+            self.index_capacity = max(index_count, 2 * self.index_capacity)
+            self.indices_vbo = GeometryArena._grown(self.indices_vbo,
+                                                    self.index_count * sizeof(GLuint),
+                                                    self.index_capacity * sizeof(GLuint))
+
+    def allocate(self, attribs, indices):
+        """ Copy the geometry data in the arena, returning its base vertex and
+        first index
+        """
+        if type(attribs[0]) is not self.attrib_type:
+            raise ValueError('The arena stores %s attributes, got %s' %
+                             (self.attrib_type.__name__, type(attribs[0]).__name__))
+
+        self._reserve(self.vertex_count + len(attribs), self.index_count + len(indices))
+
+        # The element buffer binding is part of the VAO state
+        self.vao.bind()
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.indices_vbo.glid)
+        BufferObject._current[GL_ELEMENT_ARRAY_BUFFER] = self.indices_vbo
+        glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, self.index_count * sizeof(GLuint), sizeof(indices), indices)
+        self.vbo.bind()
+        glBufferSubData(GL_ARRAY_BUFFER, self.vertex_count * sizeof(self.attrib_type), sizeof(attribs), attribs)
+
+        base = (self.vertex_count, self.index_count)
+        self.vertex_count += len(attribs)
+        self.index_count += len(indices)
+        return base
+
+    def draw_indirect(self, renderer, draws):
+        """ Draw a batch of geometries of this arena in a single call
+
+        draws -- A list of (geometry, nodes). The node model matrices are
+                 read as instanceModelMatrix (see DEFINE_VAO_3D_INSTANCED)
+        """
+        if self._commands is None:
+            self._commands = BufferObject(GL_DRAW_INDIRECT_BUFFER, 20 * len(draws), GL_STREAM_DRAW)
+            self._instances = InstanceBuffer()
+
+        # DrawElementsIndirectCommand : count, instanceCount, firstIndex,
+        # baseVertex, baseInstance
+        counts = np.array([len(nodes) for _, nodes in draws], dtype=np.uint32)
+        commands = np.empty((len(draws), 5), dtype=np.uint32)
+        commands[:, 0] = [geom.idx_count for geom, _ in draws]
+        commands[:, 1] = counts
+        commands[:, 2] = [geom.first_index for geom, _ in draws]
+        commands[:, 3] = [geom.base_vertex for geom, _ in draws]
+        commands[:, 4] = np.cumsum(counts) - counts
+
+        self._instances.upload(Matrix4x4Array.from_matrices(
+            [n.transform.premul_matrix for _, nodes in draws for n in nodes]))
+        self._commands.stream(commands)
+
+        self.vao.bind()
+        self._instances.bind_attribs()
+        self._commands.bind()
+        glMultiDrawElementsIndirect(_drawmode(renderer), GL_UNSIGNED_INT, None, len(draws), 0)
+
+        Stats.drawcalls += 1
+        Stats.instances += self._instances.count
+
+
 class Geometry(object):
     """ Raw geometry, with no transform applied on it
 	"""
 
-    def __init__(self, attribs, indices, aabb=None):
+    def __init__(self, attribs, indices, aabb=None, arena=None):
+        """
+        arena -- If given, the GeometryArena storing the geometry data, instead
+                 of dedicated buffers
+        """
         attrib_type = type(attribs[0])
-        attrib_type_size = sizeof(attrib_type)
 
         self.aabb = aabb
 
         self.idx_count = len(indices)
         self.tri_count = self.idx_count / 3
 
+        self.arena = arena
+        self.base_vertex = 0
+        self.first_index = 0
+
+        if arena is not None:
+            self.base_vertex, self.first_index = arena.allocate(attribs, indices)
+            self.vao = arena.vao
+            return
+
         # Create a container for all Buffer Objects
         self.vao = VAO()
 
@@ -219,30 +397,36 @@ class Geometry(object):
         self.indices_vbo = BufferObject(GL_ELEMENT_ARRAY_BUFFER, indices, GL_STATIC_DRAW)
         self.vbo = BufferObject(GL_ARRAY_BUFFER, attribs, GL_STATIC_DRAW)
 
-        attrib_id = 0
-        for attrib, details in zip(attrib_type._fields_, attrib_type._attribs_):
-            glEnableVertexAttribArray(attrib_id)
-            attrib_name = attrib[0]
-            attrib_size = details[0]
-            attrib_gltype = details[1]
-            attrib_normalized = details[2]
-            glVertexAttribPointer(attrib_id, attrib_size, attrib_gltype, attrib_normalized, attrib_type_size,
-                                  ctypes.c_void_p(getattr(attrib_type, attrib_name).offset))
-            attrib_id += 1
+        _setup_attribs(attrib_type)
 
         # VAO.unbind()
 
     def draw(self, renderer):
         self.vao.bind()
+        if self.arena is None:
+            glDrawElements(_drawmode(renderer), self.idx_count, GL_UNSIGNED_INT, None)
+        else:
+            glDrawElementsBaseVertex(_drawmode(renderer), self.idx_count, GL_UNSIGNED_INT,
+                                     c_void_p(self.first_index * sizeof(GLuint)), self.base_vertex)
+
+        Stats.drawcalls += 1
 
-        # If tessellation is enabled, it has to be rendered as patch
-        if renderer.current_material._shader.has_tessellation:
-            glDrawElements(GL_PATCHES, self.idx_count, GL_UNSIGNED_INT, None)
-        # Else, as simple triangles
+    def draw_instanced(self, renderer, instances):
+        """ Draw one instance per matrix of the InstanceBuffer, in a single
+        call
+        """
+        self.vao.bind()
+        instances.bind_attribs()
+        if self.arena is None:
+            glDrawElementsInstanced(_drawmode(renderer), self.idx_count,
+                                    GL_UNSIGNED_INT, None, instances.count)
         else:
-            glDrawElements(GL_TRIANGLES, self.idx_count, GL_UNSIGNED_INT, None)
+            glDrawElementsInstancedBaseVertex(_drawmode(renderer), self.idx_count, GL_UNSIGNED_INT,
+                                              c_void_p(self.first_index * sizeof(GLuint)),
+                                              instances.count, self.base_vertex)
 
         Stats.drawcalls += 1
+        Stats.instances += instances.count
 
     @staticmethod
     def load_from_file(path):
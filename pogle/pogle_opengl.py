@@ -49,4 +49,18 @@ GL_PATCH_VERTICES      = 0x8E72
 
 # Texture Buffers
 GL_TEXTURE_BUFFER      = 0x8C2A
-# glTexBuffer            = link_GL('glTexBuffer', None, [GLuint, GLuint, GLuint])
\ No newline at end of file
+# glTexBuffer            = link_GL('glTexBuffer', None, [GLuint, GLuint, GLuint])
+
+def gl_proc_address(func):
+	""" Return the native address of a raw PyOpenGL function (from
+	OpenGL.raw.GL), or None if it cannot be resolved. Functions loaded
+	lazily need a current context.
+	"""
+	if hasattr(func, 'load'):
+		func = func.load()
+		if func is None:
+			return None
+	try:
+		return cast(func, c_void_p).value
+	except Exception:
+		return None
@@ -1,17 +1,30 @@
+import functools
 import logging
 import time
 
-from ctypes import *
+import numpy as np
 
-from PIL import Image
+from ctypes import *
 
 from pogle_opengl import *
-from pogle_glprogram import GLProgram
+from pogle_bufferobject import InstanceBuffer, UniformBufferObject
+from pogle_capture import CaptureQueue
+from pogle_cmdlist import CommandList, set_command_procs, native_commands
+from pogle_glprogram import GLProgram, MAX_LIGHTS, UNIFORM_BLOCK_BINDINGS
 from pogle_fbo import FBO
-from pogle_math import Vector, Matrix4x4
-from pogle_mesh import GeometryNode
+from pogle_gputimer import GPUTimer
+from pogle_math import Vector, Matrix4x4, Matrix4x4Array, Frustum, set_uniform_matrix4fv_proc
+from pogle_mesh import GeometryNode, Geometry, VAO, GL_PATCHES
+from pogle_renderqueue import SortKeyLayout, RenderQueue
+from pogle_renderstate import RenderState
 from pogle_scene import SceneNode
 from pogle_stats import Stats
+from pogle_utils import platform, PLATFORM_WIN
+
+from OpenGL.raw.GL.VERSION.GL_1_1 import glDrawElements as _raw_glDrawElements
+from OpenGL.raw.GL.VERSION.GL_2_0 import glUniformMatrix4fv as _raw_glUniformMatrix4fv
+from OpenGL.raw.GL.VERSION.GL_3_0 import glBindVertexArray as _raw_glBindVertexArray
+from OpenGL.raw.GL.VERSION.GL_3_2 import glDrawElementsBaseVertex as _raw_glDrawElementsBaseVertex
 
 __author__ = 'Clement JACOB'
 __copyright__ = "Copyright 2013, The Python OpenGL Engine"
@@ -21,6 +34,32 @@ __email__ = "clems71@gmail.com"
 __status__ = "Prototype"
 
 
+class CameraBlock(Structure):
+    """ The CameraBlock uniform block (std140)
+    """
+    _fields_ = [
+        ('viewMatrix', c_float * 16),
+        ('projMatrix', c_float * 16),
+        ('viewProjMatrix', c_float * 16),
+        ('invViewMatrix', c_float * 16),
+        ('invViewProjMatrix', c_float * 16),
+    ]
+
+    def set_matrix(self, name, mat):
+        memmove(addressof(self) + getattr(CameraBlock, name).offset,
+                mat.data(), 16 * sizeof(c_float))
+
+
+class LightBlock(Structure):
+    """ The LightBlock uniform block (std140)
+    """
+    _fields_ = [
+        ('lightPositions', (c_float * 4) * MAX_LIGHTS),
+        ('lightCount', c_int),
+        ('_padding', c_int * 3),
+    ]
+
+
 class Material(object):
     _current_shader = None
 
@@ -28,8 +67,40 @@ class Material(object):
         self._shader = shader
         self._uniforms = kwargs
 
+        # Uniforms changed since the last use, and uniforms sent at each use
+        # (textures have to be bound again)
+        self._dirty = set(kwargs)
+        self._always = set(k for k, v in kwargs.iteritems()
+                           if type(v) not in GLProgram.UNIFORM_SNAPSHOT)
+
+        # Blended materials are drawn after the opaque ones
+        self.blended = False
+
+        # Optional state, applied over the pass one
+        self._renderstate = None
+
+    @property
+    def renderstate(self):
+        return self._renderstate
+
+    @renderstate.setter
+    def renderstate(self, val):
+        """ A RenderState (or dict), or None
+        """
+        self._renderstate = None if val is None else RenderState.of(val)
+        if self._renderstate is not None:
+            self.blended = self._renderstate['blending']
+
     def set(self, name, val):
+        """ Set an uniform value. Values modified in place must be set again
+        to be uploaded.
+        """
         self._uniforms[name] = val
+        self._dirty.add(name)
+        if type(val) in GLProgram.UNIFORM_SNAPSHOT:
+            self._always.discard(name)
+        else:
+            self._always.add(name)
 
     def _use(self):
         """ Make use of the material
@@ -37,15 +108,33 @@ class Material(object):
         This should not be called by the user. The renderer will call it for
         you.
         """
-        if Material._current_shader != self._shader:
-            Material._current_shader = self._shader
-            self._shader.use()
+        shader = self._shader
+        if Material._current_shader != shader:
+            Material._current_shader = shader
+            shader.use()
+
+        # If this material was the last one used with the program, the
+        # program still holds its unchanged uniforms
+        if shader.last_material is self:
+            names = self._dirty | self._always
+            Stats.uniforms_skipped += len(self._uniforms) - len(names)
+        else:
+            names = self._uniforms
+            shader.last_material = self
 
-        for k, v in self._uniforms.iteritems():
-            self._shader.set_uniform(k, v)
+        for k in names:
+            shader.set_uniform(k, self._uniforms[k])
+        self._dirty.clear()
 
 
 class RenderPass(object):
+    # Depth sort modes : the draws are ordered by the camera depth of their
+    # world bounds centers
+    SORT_NONE = 0           # Sort key order only
+    SORT_FRONT_TO_BACK = 1  # Within material groups (less overdraw)
+    SORT_BACK_TO_FRONT = 2  # All the draws (as needed by blending)
+    SORT_AUTO = 3           # Opaque front to back, then blended back to front
+
     def __init__(self, name, scene, overridematerial=None, fbo=None,
                  clearflags=GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT):
         """
@@ -56,17 +145,205 @@ class RenderPass(object):
                             material instead
         """
         self.name = name
+        self._revision = 0  # Incremented on each render list change
         self._scene = None
         self.scene = scene
-        self.overridematerial = overridematerial
+        self._overridematerial = overridematerial
         self.fbo = fbo
         self.clearflags = clearflags
         self.enabled = True
         self.renderlist = None
-        self.renderstate = {}
+        self._renderstate = RenderState.DEFAULT
+
+        # Opt-in frustum culling of the nodes having a bounding box. It goes
+        # through the scene spatial index when it has one.
+        self.culling = False
+
+        # The render list buckets, one per material and geometry. They are
+        # kept up to date from the scene add / remove / material change
+        # events, and only fully regenerated when marked as dirty.
+        self._buckets = None
+        self._node_buckets = None
+        self._renderlist_changed = False
+
+        # The buckets are drawn in the order of their sort keys. The depth
+        # field depends on the camera, so the keys are computed again when
+        # it moves (and every frame with blended buckets, whose nodes can
+        # move too).
+        self.sortkey_layout = SortKeyLayout.DEFAULT
+        self._queue = None
+        self._index = 0
+        self._view_dependent = False
+        self._sorted_view = None
+
+        # Draw consecutive buckets of a same material whose geometries share
+        # a GeometryArena with one glMultiDrawElementsIndirect (needs an
+        # OpenGL 4.3 context and an instanced shader)
+        self.multidraw = False
+
+        # One of the SORT_* modes
+        self.depthsort = RenderPass.SORT_NONE
+
+        # Count the samples passing the depth test into Stats.samples, to
+        # measure overdraw. It waits for the GPU at the end of the pass.
+        self.count_samples = False
+
+        # Record the draws into a CommandList, replayed while the render
+        # list does not change (without culling nor depth sorting). Changing
+        # the transform object or the geometry of a node needs a
+        # mark_renderlist_as_dirty().
+        self.record = False
+        self._commands = None
+        self._commands_key = None
+        self._commands_objects = 0
 
     def mark_renderlist_as_dirty(self):
+        """ Drop the render list, to regenerate it from scratch
+        """
         self.renderlist = None
+        self._buckets = None
+        self._node_buckets = None
+        self._revision += 1
+
+    @property
+    def renderstate(self):
+        return self._renderstate
+
+    @renderstate.setter
+    def renderstate(self, val):
+        """ A RenderState, or a dict of state values
+        """
+        self._renderstate = RenderState.of(val)
+
+    @property
+    def overridematerial(self):
+        return self._overridematerial
+
+    @overridematerial.setter
+    def overridematerial(self, val):
+        if val is not self._overridematerial:
+            self._overridematerial = val
+            self.mark_renderlist_as_dirty()
+
+    def _reset_buckets(self):
+        self._buckets = {}
+        self._node_buckets = {}
+        self.renderlist = []
+        self._renderlist_changed = True
+        self._revision += 1
+
+    def _bucket_node(self, node):
+        mat = node.material if self._overridematerial is None \
+            else self._overridematerial
+
+        bkt = self._buckets.get((mat, node.geom))
+        if bkt is None:
+            bkt = self._buckets[(mat, node.geom)] = RenderBucket(
+                RenderBucket.SAME_MATERIAL_FLAG + RenderBucket.SAME_GEOMETRY_FLAG)
+            bkt.geom = node.geom
+            bkt.mat = mat
+            self._renderlist_changed = True
+
+        bkt.add_node(node)
+        self._node_buckets[node] = bkt
+        self._revision += 1
+
+    def _unbucket_node(self, node):
+        bkt = self._node_buckets.pop(node)
+        bkt.remove_node(node)
+        if len(bkt) == 0:
+            del self._buckets[(bkt.mat, bkt.geom)]
+            self._renderlist_changed = True
+        self._revision += 1
+
+    @property
+    def index(self):
+        """ The index of the pass in the frame (the 'pass' sort key field),
+        set by the renderer
+        """
+        return self._index
+
+    @index.setter
+    def index(self, value):
+        if value != self._index:
+            self._index = value
+            self._renderlist_changed = True
+
+    def sortkey_fields(self, buckets):
+        """ Return the sort key field values of the buckets, as a dict of
+        field name -> list of values. Override it (with sortkey_layout) to
+        define a custom ordering.
+
+        The depth is the camera depth of the buckets, quantized over the
+        depth range of the pass. Blended buckets are ordered by depth only
+        (back to front), opaque ones by state then front to back.
+        """
+        layout = self.sortkey_layout
+        mats = [bkt.mat for bkt in buckets]
+        blended = np.array([mat is not None and mat.blended for mat in mats], dtype=bool)
+
+        view = self.scene.camera.view
+        viewrow = np.array([view.get(x, 2) for x in range(4)], dtype=np.float32)
+        depths = np.array([bkt.depths(bkt.nodes, viewrow).mean() if bkt.nodes else 0.0
+                           for bkt in buckets])
+        depth = np.zeros(len(buckets), dtype=np.uint64)
+        if len(buckets):
+            depth = layout.quantize('depth', depths, depths.min(), depths.max())
+            depth[blended] = np.uint64((1 << layout.bits('depth')) - 1) - depth[blended]
+
+        def states(name, objs):
+            ids = np.array([layout.id_of(name, obj) for obj in objs], dtype=np.uint64)
+            ids[blended] = 0
+            return ids
+
+        return {
+            'pass': self._index,
+            'blend': blended,
+            'shader': states('shader', [mat and mat._shader for mat in mats]),
+            'material': states('material', mats),
+            'geometry': states('geometry', [bkt.geom for bkt in buckets]),
+            'depth': depth,
+        }
+
+    def _update_renderlist(self):
+        """ Sort the buckets into the render list, once some were added or
+        removed or the camera moved (every frame with blended buckets)
+        """
+        view = self.scene.camera.view.tobytes()
+        if self._renderlist_changed or self._view_dependent or \
+                view != self._sorted_view:
+            if self._queue is None or self._queue.layout is not self.sortkey_layout:
+                self._queue = RenderQueue(self.sortkey_layout)
+            buckets = list(self._buckets.values())
+            fields = self.sortkey_fields(buckets)
+            renderlist = self._queue.build(buckets, **fields)
+            if renderlist != self.renderlist:
+                self.renderlist = renderlist
+                self._revision += 1
+            self._renderlist_changed = False
+            self._view_dependent = bool(np.any(fields.get('blend', False)))
+            self._sorted_view = view
+
+    def node_added(self, node):
+        """ Called by the scene when a node is added
+        """
+        if self.renderlist is not None and \
+                node.has_flag(SceneNode.NODE_HAS_GEOMETRY):
+            self._bucket_node(node)
+
+    def node_removed(self, node):
+        """ Called by the scene when a node is removed
+        """
+        if self._node_buckets is not None and node in self._node_buckets:
+            self._unbucket_node(node)
+
+    def node_material_changed(self, node):
+        """ Called by the scene when the material of a node changed
+        """
+        if self._overridematerial is None and \
+                self._node_buckets is not None and node in self._node_buckets:
+            self._unbucket_node(node)
+            self._bucket_node(node)
 
     @property
     def scene(self):
@@ -90,34 +367,19 @@ class RenderPass(object):
     def _use(self, renderer):
         """ The renderer call it to be prepared to render this pass
         """
-        if self.fbo is None:
+        fbo = renderer.target_fbo(self)
+        if fbo is None:
             FBO.bind_default()
             glViewport(0, 0, renderer.width, renderer.height)
         else:
-            self.fbo.bind()
-            glViewport(0, 0, self.fbo.width, self.fbo.height)
+            fbo.bind()
+            glViewport(0, 0, fbo.width, fbo.height)
 
-        renderer.setstate(self.renderstate)
+        renderer.setstate(self._renderstate)
 
         if self.clearflags != 0:
             glClear(self.clearflags)
 
-    def _capture(self, renderer, path):
-        width = renderer.width
-        height = renderer.height
-        if not self.fbo is None:
-            width = self.fbo.width
-            height = self.fbo.height
-
-        logging.info('Captured a frame in the render pass \'%s\'' % self.name)
-
-        buf = create_string_buffer(width * height * 4)
-        glFlush()
-        glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE, buf)
-
-        im = Image.frombuffer("RGBA", (width, height), buf)
-        im.save(path)
-
 
 class DefaultForwardRenderingPass(RenderPass):
     def __init__(self, scene):
@@ -136,9 +398,118 @@ class RenderBucket(object):
         self.nodes = []
         self.geom = None
         self.mat = None
+        self._bounds = None
+        self._unindexed = None
+        self._positions = {}
+        self._instances = None
+        self._center = None
+        # Nodes overriding render(), which an instanced draw would skip
+        self._custom = 0
 
     def add_node(self, node):
+        self._positions[node] = len(self.nodes)
         self.nodes.append(node)
+        if type(node).render != GeometryNode.render:
+            self._custom += 1
+        self._bounds = None
+        self._unindexed = None
+
+    def remove_node(self, node):
+        """ Remove a node in constant time (the last node takes its place)
+        """
+        idx = self._positions.pop(node)
+        last = self.nodes.pop()
+        if last is not node:
+            self.nodes[idx] = last
+            self._positions[last] = idx
+        if type(node).render != GeometryNode.render:
+            self._custom -= 1
+        self._bounds = None
+        self._unindexed = None
+
+    def unindexed_nodes(self, index):
+        """ The nodes missing from the spatial index (no bounding box),
+        which are always visible
+        """
+        if self._unindexed is None:
+            self._unindexed = [n for n in self.nodes if n not in index]
+        return self._unindexed
+
+    def visible_nodes(self, frustum):
+        """ Return the nodes whose bounding box intersects the frustum. Nodes
+        without bounding box are always visible.
+        """
+        # Local bounds are packed once, only matrices change per frame
+        if self._bounds is None:
+            bounded = []
+            unbounded = []
+            for node in self.nodes:
+                if getattr(node.geom, 'aabb', None) is None:
+                    unbounded.append(node)
+                else:
+                    bounded.append(node)
+            mins = np.array([n.geom.aabb.min.vals for n in bounded], dtype=np.float32)
+            maxs = np.array([n.geom.aabb.max.vals for n in bounded], dtype=np.float32)
+            self._bounds = (bounded, unbounded, mins, maxs)
+
+        bounded, unbounded, mins, maxs = self._bounds
+        if len(bounded) == 0:
+            return unbounded
+
+        matrices = Matrix4x4Array.from_matrices(
+            [n.transform.premul_matrix for n in bounded])
+        mask = frustum.test_local_aabbs(mins, maxs, matrices)
+
+        visible = unbounded + [bounded[i] for i in np.flatnonzero(mask)]
+        Stats.culled += len(self.nodes) - len(visible)
+        return visible
+
+    def depths(self, nodes, viewrow):
+        """ Return the camera space depths of the world bounds centers of
+        the nodes
+
+        viewrow -- The third row of the view matrix, as a NumPy array
+        """
+        if self._center is None:
+            aabb = getattr(self.geom, 'aabb', None)
+            if aabb is None:
+                self._center = np.array([0.0, 0.0, 0.0, 1.0], dtype=np.float32)
+            else:
+                self._center = np.append(
+                    (np.array(aabb.min.vals, dtype=np.float32) +
+                     np.array(aabb.max.vals, dtype=np.float32)) * 0.5, 1.0)
+
+        # Same geometry : the world center is the model matrix applied to
+        # the local one
+        matrices = Matrix4x4Array.from_matrices(
+            [n.transform.premul_matrix for n in nodes])
+        centers = np.dot(self._center, matrices.array)
+        return -np.dot(centers, viewrow)
+
+    def can_instance(self, shader):
+        """ Whether the nodes can be drawn with a single instanced call
+        """
+        return self.has_flag(RenderBucket.SAME_GEOMETRY_FLAG) and \
+            not self._custom and \
+            shader.supports_instancing and \
+            hasattr(self.geom, 'draw_instanced')
+
+    def can_multidraw(self):
+        """ Whether the bucket can be part of a multi draw indirect batch
+        """
+        return self.mat is not None and \
+            getattr(self.geom, 'arena', None) is not None and \
+            self.can_instance(self.mat._shader)
+
+    def render_instanced(self, renderer, nodes):
+        """ Stream the model matrices of the nodes into the bucket instance
+        buffer, and draw them all at once
+        """
+        if self._instances is None:
+            self._instances = InstanceBuffer(len(nodes))
+        self._instances.upload(Matrix4x4Array.from_matrices(
+            [n.transform.premul_matrix for n in nodes]))
+        self.geom.draw_instanced(renderer, self._instances)
 
     def has_flag(self, flag):
         return ((self.flags & flag) != 0x00000000)
@@ -147,6 +518,69 @@ class RenderBucket(object):
         return len(self.nodes)
 
 
+def _draw_node(renderer, node):
+    renderer.current_material._shader.set_uniform(
+        'modelMatrix',
+        node.transform.premul_matrix)
+    node.render(renderer)
+
+
+def _sync_native_vao(vao):
+    # Native commands bypass the VAO cache
+    VAO._current = vao
+
+
+class _CommandRecorder(object):
+    """ Records draws into a CommandList. Nodes of plain geometries become
+    native commands when possible, everything else Python calls.
+    """
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.commands = CommandList()
+        self.native = native_commands()
+        self.objects = 0
+
+        # The VAO bound by the previous commands (None if unknown), and the
+        # one to report to the VAO cache before the next Python call
+        self._bound = None
+        self._vao = None
+
+    def _sync(self):
+        if self._vao is not None:
+            self.commands.call(functools.partial(_sync_native_vao, self._vao))
+            self._vao = None
+
+    def call(self, func, *args):
+        self._sync()
+        self._bound = None
+        self.commands.call(functools.partial(func, *args))
+
+    def node(self, mat, node):
+        geom = node.geom
+        shader = mat._shader
+        if not self.native or type(node).render != GeometryNode.render or \
+                type(geom).draw != Geometry.draw:
+            self.call(_draw_node, self.renderer, node)
+            return
+
+        if geom.vao is not self._bound:
+            self.commands.bind_vao(geom.vao.glid)
+            self._bound = self._vao = geom.vao
+
+        location = shader.uniform_location('modelMatrix')
+        if location != -1:
+            self.commands.uniform_matrix(location, node.transform)
+
+        self.commands.draw_elements(
+            GL_PATCHES if shader.has_tessellation else GL_TRIANGLES,
+            geom.idx_count, geom.first_index * sizeof(GLuint), geom.base_vertex)
+
+    def finish(self, graph):
+        self._sync()
+        self.commands.finish(graph)
+        return self.commands
+
+
 class GLRenderer(object):
     DEFAULT_SHADER = """
 <shader version="330">
@@ -180,6 +614,23 @@ class GLRenderer(object):
         # Culling mode
         glCullFace(GL_BACK)
 
+        # Uniform blocks, bound once for all
+        self._camera_ubo = UniformBufferObject(CameraBlock)
+        self._camera_ubo.bind_base(UNIFORM_BLOCK_BINDINGS['CameraBlock'])
+        self._light_ubo = UniformBufferObject(LightBlock)
+        self._light_ubo.bind_base(UNIFORM_BLOCK_BINDINGS['LightBlock'])
+
+        # Native matrix uploads. Not on Windows 32 bits, where GL entry
+        # points use the stdcall convention
+        if platform != PLATFORM_WIN or sizeof(c_void_p) == 8:
+            set_uniform_matrix4fv_proc(
+                gl_proc_address(_raw_glUniformMatrix4fv) or 0)
+            set_command_procs(
+                gl_proc_address(_raw_glBindVertexArray) or 0,
+                gl_proc_address(_raw_glUniformMatrix4fv) or 0,
+                gl_proc_address(_raw_glDrawElements) or 0,
+                gl_proc_address(_raw_glDrawElementsBaseVertex) or 0)
+
     def _init_materials(self):
         """ Initialize the default materials of the Engine
         """
@@ -198,78 +649,50 @@ class GLRenderer(object):
 
         self.passes = []
 
-        self.pending_captures = {}
+        # If set, a RenderGraph scheduling the passes instead of the passes
+        # list
+        self.graph = None
 
-        # Functions to call to apply a state value
-        self._state_funcs = {
-            'blending': lambda val: self._set_gl_state(GL_BLEND, val),
-            'culling': lambda val: self._set_gl_state(GL_CULL_FACE, val),
-            'depth_test': lambda val: self._set_gl_state(GL_DEPTH_TEST, val),
-            'depthfunc': self._set_depthfunc,
-            'blendfunc': self._set_blendfunc,
-            'pointsize': self._set_pointsize,
-            'blendequ': self._set_blendequ,
-        }
+        # If set, the FBO replacing the default framebuffer (no window)
+        self.default_fbo = None
 
-        # The default OpenGL state
-        self._state_default = {
-            'blending': False,
-            'culling': True,
-            'depth_test': True,
-            'depthfunc': GL_LESS,
-            'blendfunc': (GL_ONE, GL_ZERO),
-            'blendequ': GL_FUNC_ADD,
-            'pointsize': 1.0,
-        }
-
-        self._current_state = None
+        self.pending_captures = {}
 
-    def _set_gl_state(self, flag, val):
-        if val:
-            glEnable(flag)
-        else:
-            glDisable(flag)
+        # Captures are read back asynchronously, and saved by worker threads
+        self.capture_queue = CaptureQueue()
 
-    def _set_pointsize(self, val):
-        glPointSize(val)
+        # Per pass GPU and CPU timings, see Stats.gpu_times
+        self.timer = GPUTimer()
 
-    def _set_blendequ(self, val):
-        glBlendEquation(val)
+        # Per pass uniform blocks (created with the context)
+        self._camera_ubo = None
+        self._light_ubo = None
 
-    def _set_depthfunc(self, val):
-        glDepthFunc(val)
+        # The current RenderState, None when unknown
+        self._current_state = None
 
-    def _set_blendfunc(self, val):
-        glBlendFunc(val[0], val[1])
+        # GL_SAMPLES_PASSED query of the passes counting samples
+        self._samples_query = None
 
     @property
     def defaultstate(self):
-        return self._state_default
+        return RenderState.DEFAULT
 
-    def setstate(self, renderer_state={}):
-        """ Set the renderer state to be the one passed in renderer_state. If
-        renderer_state is empty, the state is resetted to the default one.
+    def setstate(self, renderer_state=None):
+        """ Set the renderer state to be the one passed in renderer_state (a
+        RenderState or a dict). If renderer_state is empty, the state is
+        resetted to the default one.
 
         WARNING : It also reset the non-passed states to the default ones.
         """
+        state = RenderState.of(renderer_state)
+        if state is self._current_state:
+            return
 
-        # Not initialized yet, so fill it with empty state
-        if self._current_state is None:
-            self._current_state = {}
-            for statename in self._state_funcs.iterkeys():
-                self._current_state[statename] = None
-
-        # For each state, check if the user gave new one
-        for statename, statefunc in self._state_funcs.iteritems():
-            new_state = None
-            if statename in renderer_state:
-                new_state = renderer_state[statename]
-            else:
-                new_state = self._state_default[statename]
-
-            if new_state != self._current_state[statename]:
-                statefunc(new_state)
-                self._current_state[statename] = new_state
+        # Only the differing categories are applied
+        for apply, val in RenderState.diff(self._current_state, state):
+            apply(val)
+        self._current_state = state
 
     def resize(self, w, h):
         self.width = w
@@ -285,10 +708,23 @@ class GLRenderer(object):
         self.setstate()
 
     def capture(self, pass_, path, callback=None):
-        """ Capture the result of the given pass into a file
+        """ Capture the result of the given pass (or pass name) into a file
+        (.exr paths are saved as float EXR). The capture is taken at the next
+        frame and saved in the background : callback is called once the file
+        is written, by a later render() or finish_captures().
         """
         self.pending_captures[pass_] = (path, callback)
 
+    def target_fbo(self, pass_):
+        """ The FBO a pass renders to, None for the default framebuffer
+        """
+        return self.default_fbo if pass_.fbo is None else pass_.fbo
+
+    def finish_captures(self):
+        """ Wait for all the requested captures to be written
+        """
+        self.capture_queue.finish()
+
     def _use_material(self, mat):
         """ Use a new material
         """
@@ -305,71 +741,122 @@ class GLRenderer(object):
         for idx, pass_ in enumerate(self.passes):
             logging.info(' >> %d : %s', idx + 1, pass_.name)
 
+    def _upload_pass_uniforms(self, camera, lights):
+        """ Fill the camera and light uniform blocks, shared by all the
+        shaders of the pass
+        """
+        viewproj = camera.proj * camera.view
+
+        block = self._camera_ubo[0]
+        block.set_matrix('viewMatrix', camera.view)
+        block.set_matrix('projMatrix', camera.proj)
+        block.set_matrix('viewProjMatrix', viewproj)
+        # Singular matrices (degenerate cameras) have no inverse : identity
+        # is used instead
+        block.set_matrix('invViewMatrix', camera.view.inverse() or Matrix4x4())
+        block.set_matrix('invViewProjMatrix', viewproj.inverse() or Matrix4x4())
+        self._camera_ubo.upload()
+
+        if len(lights) > MAX_LIGHTS:
+            logging.warn('Only the first %d lights are used', MAX_LIGHTS)
+            lights = lights[:MAX_LIGHTS]
+
+        block = self._light_ubo[0]
+        for idx, light in enumerate(lights):
+            pos = light.position
+            block.lightPositions[idx][:] = [pos.x, pos.y, pos.z, 1.0]
+        block.lightCount = len(lights)
+        self._light_ubo.upload()
+
     def _generate_render_list(self, pass_):
-        lst = set(pass_.scene.get_nodes(SceneNode.NODE_HAS_GEOMETRY))
-
-        pass_.renderlist = []
-
-        # Try to group elements as much as possible
-        # Same geometry, same material = instancing if available
-        # Same material only = avoid context switches
-        # Same geometry only = nothing for the moment
-        #   (1 node = 1 render bucket)
-
-        while len(lst) > 0:
-            geom_mat_bkt = RenderBucket(RenderBucket.SAME_MATERIAL_FLAG +
-                                        RenderBucket.SAME_GEOMETRY_FLAG
-                                        )
-            mat_bkt = RenderBucket(RenderBucket.SAME_MATERIAL_FLAG)
-            default_bkt = RenderBucket()
-
-            # The element to match against
-            cur_base_elem = lst.pop()
-            cur_base_geom = cur_base_elem.geom
-            cur_base_mat = \
-                cur_base_elem.material if pass_.overridematerial \
-                is None else pass_.overridematerial
-
-            # Add the base element to the bucket
-            geom_mat_bkt.add_node(cur_base_elem)
-            mat_bkt.add_node(cur_base_elem)
-            default_bkt.add_node(cur_base_elem)
-
-            for elem in lst:
-                mat = \
-                    elem.material if pass_.overridematerial is None \
-                    else pass_.overridematerial
-                geom = elem.geom
-
-                # Later, we should maybe only check the shader
-                if mat == cur_base_mat:
-                    if geom == cur_base_geom:
-                        geom_mat_bkt.add_node(elem)
-                    else:
-                        mat_bkt.add_node(elem)
-
-            to_remove_nodes = []
-            bkt = None
-            if len(geom_mat_bkt) > 1:
-                to_remove_nodes = geom_mat_bkt.nodes[1:]
-                bkt = geom_mat_bkt
-            elif len(mat_bkt) > 1:
-                to_remove_nodes = mat_bkt.nodes[1:]
-                bkt = mat_bkt
+        """ Regenerate the whole render list of a pass. Afterwards, the pass
+        keeps it up to date from the scene events.
+        """
+        # Group elements as much as possible : one bucket per material and
+        # geometry (instancing if available), and the buckets are sorted
+        # by shader, material then geometry (avoids context switches)
+        pass_._reset_buckets()
+        for node in pass_.scene.get_nodes_i(SceneNode.NODE_HAS_GEOMETRY):
+            pass_._bucket_node(node)
+        pass_._update_renderlist()
+
+    def _visible_nodes_per_bucket(self, pass_, frustum):
+        """ Cull through the scene spatial index, and dispatch the visible
+        nodes to their buckets
+        """
+        visible = {}
+        node_buckets = pass_._node_buckets
+        for node in pass_.scene.query_frustum(frustum):
+            bkt = node_buckets.get(node)
+            if bkt is not None:
+                visible.setdefault(bkt, []).append(node)
+        return visible
+
+    def _depth_sorted(self, pass_, draws):
+        """ Reorder the (bucket, nodes) draws following pass_.depthsort.
+        Front to back sorting keeps the material groups, back to front
+        sorting is done per node.
+        """
+        view = self.current_camera.view
+        viewrow = np.array([view.get(x, 2) for x in range(4)], dtype=np.float32)
+
+        mode = pass_.depthsort
+        front = []
+        back = []
+        for bkt, nodes in draws:
+            if mode == RenderPass.SORT_AUTO:
+                state = pass_.renderstate if bkt.mat is None else \
+                    pass_.renderstate.merged(bkt.mat.renderstate)
+                to_front = not state['blending']
             else:
-                bkt = default_bkt
-
-            # Remove nodes added to bucket
-            for n in to_remove_nodes:
-                lst.remove(n)
-
-            bkt.geom = cur_base_geom
-            bkt.mat = cur_base_mat
-
-            # Add the bucket to the render list
-            pass_.renderlist.append(bkt)
+                to_front = mode == RenderPass.SORT_FRONT_TO_BACK
+            (front if to_front else back).append((bkt, nodes, bkt.depths(nodes, viewrow)))
+
+        res = []
+
+        # Nearest nodes first in each bucket, and the buckets of a material
+        # ordered by their nearest node
+        group = []
+        for bkt, nodes, depths in front + [(None, None, None)]:
+            if group and (bkt is None or bkt.mat is not group[0][1].mat):
+                group.sort(key=lambda item: item[0])
+                res.extend((b, n) for _, b, n in group)
+                group = []
+            if bkt is not None:
+                order = np.argsort(depths, kind='stable')
+                group.append((depths[order[0]], bkt, [nodes[i] for i in order]))
+
+        # Farthest nodes first, consecutive nodes of a bucket stay batched
+        if back:
+            items = [(bkt, node) for bkt, nodes, _ in back for node in nodes]
+            depths = np.concatenate([depths for _, _, depths in back])
+            first = len(res)
+            for i in np.argsort(-depths, kind='stable'):
+                bkt, node = items[i]
+                if len(res) > first and res[-1][0] is bkt:
+                    res[-1][1].append(node)
+                else:
+                    res.append((bkt, [node]))
+
+        return res
+
+    def _draw_batch(self, pass_, batch):
+        """ Draw a list of (bucket, nodes) sharing a material and a geometry
+        arena, with a single indirect call
+        """
+        bkt = batch[0][0]
+        self._use_pass_material(pass_, bkt.mat)
+        bkt.geom.arena.draw_indirect(
+            self, [(b.geom, nodes) for b, nodes in batch])
 
     def render_pass(self, pass_):
+        self.timer.begin(pass_.name)
+        try:
+            self._render_pass(pass_)
+        finally:
+            self.timer.end()
+
+    def _render_pass(self, pass_):
         self.current_pass = pass_
         self.current_camera = pass_.scene.camera
         if self.current_camera._follow_viewport is True:
@@ -381,38 +868,149 @@ class GLRenderer(object):
                 c._far)
 
         pass_._use(self)
+        self._upload_pass_uniforms(self.current_camera, pass_.scene.lights)
 
         # Generate the render list the most efficient possible, avoiding
         # too much context switches.
         if pass_.renderlist is None:
             self._generate_render_list(pass_)
+        else:
+            pass_._update_renderlist()
+
+        if pass_.count_samples:
+            if self._samples_query is None:
+                self._samples_query = GLuint(0)
+                glGenQueries(1, byref(self._samples_query))
+            glBeginQuery(GL_SAMPLES_PASSED, self._samples_query.value)
+
+        if pass_.record and not pass_.culling and \
+                pass_.depthsort == RenderPass.SORT_NONE:
+            self._replay(pass_)
+        else:
+            self._draw(pass_, self._visible_draws(pass_))
+
+        if pass_.count_samples:
+            glEndQuery(GL_SAMPLES_PASSED)
+            samples = GLuint(0)
+            glGetQueryObjectuiv(self._samples_query.value, GL_QUERY_RESULT, byref(samples))
+            Stats.samples += samples.value
+
+        # Signal the event to the pass, that it has been rendered properly
+        pass_.rendered(self)
 
-        # Effectively render the buckets
+    def _visible_draws(self, pass_):
+        """ The (bucket, nodes) to draw, culled and depth sorted
+        """
+        frustum = None
+        visible = None
+        index = pass_.scene.spatial_index
+        if pass_.culling:
+            frustum = Frustum.from_camera(self.current_camera)
+            if index is not None:
+                visible = self._visible_nodes_per_bucket(pass_, frustum)
+
+        draws = []
         for bkt in pass_.renderlist:
-            self._use_material(bkt.mat)
+            nodes = bkt.nodes
+            if visible is not None:
+                nodes = visible.get(bkt, []) + bkt.unindexed_nodes(index)
+                Stats.culled += len(bkt) - len(nodes)
+                if len(nodes) == 0:
+                    continue
+            elif frustum is not None:
+                nodes = bkt.visible_nodes(frustum)
+                if len(nodes) == 0:
+                    continue
+            draws.append((bkt, nodes))
+
+        if pass_.depthsort != RenderPass.SORT_NONE:
+            draws = self._depth_sorted(pass_, draws)
+        return draws
+
+    def _replay(self, pass_):
+        """ Replay the recorded commands of the pass, recording them first
+        if the render list changed
+        """
+        key = (pass_._revision, pass_.multidraw)
+        if pass_._commands is None or pass_._commands_key != key:
+            if pass_._commands is not None:
+                pass_._commands.release()
+            rec = _CommandRecorder(self)
+            self._draw(pass_, [(bkt, bkt.nodes) for bkt in pass_.renderlist], rec)
+            pass_._commands = rec.finish(pass_.scene.transform_graph)
+            pass_._commands_key = key
+            pass_._commands_objects = rec.objects
+
+        commands = pass_._commands
+        commands.patch()
+        commands.replay()
+
+        Stats.objects += pass_._commands_objects
+        Stats.drawcalls += commands.draw_count
+        Stats.uniforms_issued += commands.matrix_count
+
+    def _use_pass_material(self, pass_, mat):
+        self._use_material(mat)
+        self.setstate(pass_.renderstate.merged(
+            self.current_material.renderstate))
+
+    def _draw(self, pass_, draws, rec=None):
+        """ Draw the (bucket, nodes) list. With rec (a _CommandRecorder),
+        the draws are recorded instead.
+        """
+        # Effectively render the buckets. With multidraw, consecutive
+        # buckets of a same material and arena are batched.
+        batch = []
+        for bkt, nodes in draws:
+            if rec is None:
+                Stats.objects += len(nodes)
+            else:
+                rec.objects += len(nodes)
+
+            if pass_.multidraw and bkt.can_multidraw():
+                if batch and (batch[0][0].mat is not bkt.mat or
+                              batch[0][0].geom.arena is not bkt.geom.arena):
+                    self._flush_batch(pass_, batch, rec)
+                    batch = []
+                batch.append((bkt, nodes))
+                continue
+            elif batch:
+                self._flush_batch(pass_, batch, rec)
+                batch = []
+
+            mat = self.default_mat if bkt.mat is None else bkt.mat
+            instanced = bkt.can_instance(mat._shader)
+
+            if rec is not None:
+                rec.call(self._use_pass_material, pass_, bkt.mat)
+                if instanced:
+                    rec.call(bkt.render_instanced, self, nodes)
+                else:
+                    for node in nodes:
+                        rec.node(mat, node)
+                continue
 
-            # Bucket uniforms
-            self.current_material._shader.set_uniform(
-                'viewMatrix',
-                self.current_camera.view)
-            self.current_material._shader.set_uniform(
-                'projMatrix',
-                self.current_camera.proj)
+            self._use_pass_material(pass_, bkt.mat)
 
-            if len(pass_.scene.lights) != 0:
-                self.current_material._shader.set_uniform(
-                    'lightPos',
-                    pass_.scene.lights[0].position)
+            if instanced:
+                bkt.render_instanced(self, nodes)
+                continue
 
-            for node in bkt.nodes:
+            for node in nodes:
                 # Per instance uniform
                 self.current_material._shader.set_uniform(
                     'modelMatrix',
                     node.transform.premul_matrix)
                 node.render(self)
 
-        # Signal the event to the pass, that it has been rendered properly
-        pass_.rendered(self)
+        if batch:
+            self._flush_batch(pass_, batch, rec)
+
+    def _flush_batch(self, pass_, batch, rec):
+        if rec is None:
+            self._draw_batch(pass_, batch)
+        else:
+            rec.call(self._draw_batch, pass_, batch)
 
     def render(self):
         """ Effectively render all the enabled passes
@@ -420,23 +1018,20 @@ class GLRenderer(object):
 
         Stats.clear()
 
-        for pass_ in self.passes:
+        passes = self.passes if self.graph is None else self.graph.schedule(self)
+        for index, pass_ in enumerate(passes):
             if not pass_.enabled:
                 continue
 
+            pass_.index = index
             self.render_pass(pass_)
 
-            # If any capture is pending for this pass, then, capture!
-            # and remove from pending list
-            callback = None
-            if pass_ in self.pending_captures:
-                pass_._capture(self, self.pending_captures[pass_][0])
-                callback = self.pending_captures[pass_][1]
-                del self.pending_captures[pass_]
-            if pass_.name in self.pending_captures:
-                pass_._capture(self, self.pending_captures[pass_.name][0])
-                callback = self.pending_captures[pass_.name][1]
-                del self.pending_captures[pass_.name]
-
-            if callback:
-                callback()
+            # If any capture is pending for this pass, then, start its read
+            # back and remove from pending list
+            for key in (pass_, pass_.name):
+                if key in self.pending_captures:
+                    path, callback = self.pending_captures.pop(key)
+                    self.capture_queue.request(self, pass_, path, callback)
+
+        self.capture_queue.update()
+        self.timer.update()
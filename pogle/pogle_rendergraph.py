@@ -0,0 +1,285 @@
+import heapq
+import logging
+
+from pogle_fbo import FBO
+from pogle_gltexture import Texture2D
+
+__author__ = 'Clement JACOB'
+__copyright__ = "Copyright 2013, The Python OpenGL Engine"
+__license__ = "Closed Source"
+__version__ = "0.0.1"
+__email__ = "clems71@gmail.com"
+__status__ = "Prototype"
+
+
+class TransientTarget(object):
+    """ The description of a render target owned by a RenderGraph. Its
+    texture only lives between its first write and its last read, and is
+    shared with other targets of a same description otherwise.
+    """
+    def __init__(self, name, format='rgba', size=None, scale=1.0, filtering='linear'):
+        """
+        format -- A Texture2D format
+        size -- (width, height), or None to follow the renderer size
+        scale -- Scale applied to the renderer size, when size is None
+        """
+        self.name = name
+        self.format = format
+        self.size = size
+        self.scale = scale
+        self.filtering = filtering
+
+    def key(self, renderer):
+        """ The texture description : targets of a same key can alias
+        """
+        if self.size is None:
+            size = (max(1, int(renderer.width * self.scale)),
+                    max(1, int(renderer.height * self.scale)))
+        else:
+            size = tuple(self.size)
+        return (self.format, size, self.filtering)
+
+
+class _GraphPass(object):
+    def __init__(self, pass_, reads, writes, material, index):
+        self.pass_ = pass_
+        self.reads = dict(reads or {})
+        self.writes = None if writes is None else dict(writes)
+        self.material = material
+        self.index = index
+
+
+class RenderGraph(object):
+    """ Render passes declaring the textures they read and write.
+
+    Each frame, the passes are ordered so that writers run before readers,
+    passes whose writes are not used by an output (see outputs) are skipped,
+    and the transient targets (see declare) are allocated from a pool where
+    targets with non-overlapping lifetimes share a same texture.
+
+    The graph is used by a GLRenderer through its graph attribute, instead
+    of its passes list.
+    """
+    BACKBUFFER = 'backbuffer'
+
+    def __init__(self):
+        self._passes = []
+        self._targets = {}
+        self._imported = {}
+        self._next_index = 0
+
+        # The resources whose writers are always run
+        self.outputs = set([RenderGraph.BACKBUFFER])
+
+        # The compiled schedule, and what it depends on
+        self._key = None
+        self._schedule = []
+        self._pool = {}
+        self._fbos = {}
+
+        self.textures = {}
+        self.culled = []
+
+    def declare(self, name, format='rgba', size=None, scale=1.0, filtering='linear'):
+        """ Declare a transient render target, allocated by the graph
+        """
+        if name in self._imported or name == RenderGraph.BACKBUFFER:
+            raise ValueError('The resource \'%s\' already exists' % name)
+        self._targets[name] = TransientTarget(name, format, size, scale, filtering)
+        self._key = None
+
+    def import_texture(self, name, texture):
+        """ Declare a texture owned by the user (never aliased)
+        """
+        if name in self._targets or name == RenderGraph.BACKBUFFER:
+            raise ValueError('The resource \'%s\' already exists' % name)
+        self._imported[name] = texture
+        self._key = None
+
+    def add_pass(self, pass_, reads=None, writes=None, material=None):
+        """ Add a pass to the graph
+
+        reads -- A dict of uniform name -> resource, the textures set on the
+                 material before the pass is rendered
+        writes -- A dict of FBO attachment ('color0', 'depth', ...) ->
+                  resource, or {'color0': RenderGraph.BACKBUFFER} to render
+                  to the default framebuffer. Passes without writes keep
+                  their own fbo and are never skipped.
+        material -- The material receiving the reads (defaults to the pass
+                    override material)
+        """
+        if material is None:
+            material = pass_.overridematerial
+        if reads and material is None:
+            raise ValueError('The pass \'%s\' reads textures, but has no material' % pass_.name)
+
+        node = _GraphPass(pass_, reads, writes, material, self._next_index)
+        self._next_index += 1
+
+        for name in node.reads.values():
+            self._check_resource(name)
+            if name == RenderGraph.BACKBUFFER:
+                raise ValueError('The backbuffer can not be read')
+        if node.writes is not None:
+            names = set(node.writes.values())
+            for name in names:
+                self._check_resource(name)
+            if RenderGraph.BACKBUFFER in names and len(names) > 1:
+                raise ValueError('The pass \'%s\' mixes the backbuffer with other targets' % pass_.name)
+            if names & set(node.reads.values()):
+                raise ValueError('The pass \'%s\' reads a target it writes' % pass_.name)
+
+        self._passes.append(node)
+        self._key = None
+
+    def remove_pass(self, pass_):
+        self._passes = [node for node in self._passes if node.pass_ is not pass_]
+        self._key = None
+
+    @property
+    def passes(self):
+        return [node.pass_ for node in self._passes]
+
+    def _check_resource(self, name):
+        if name != RenderGraph.BACKBUFFER and name not in self._targets \
+                and name not in self._imported:
+            raise ValueError('Unknown render graph resource \'%s\'' % name)
+
+    def _sorted(self, nodes):
+        """ Order the nodes so that the writers of a resource run before its
+        readers (insertion order otherwise)
+        """
+        writers = {}
+        for node in nodes:
+            for name in (node.writes or {}).values():
+                writers.setdefault(name, []).append(node)
+
+        deps = dict((node, set()) for node in nodes)
+        users = dict((node, []) for node in nodes)
+        for node in nodes:
+            for name in node.reads.values():
+                for writer in writers.get(name, []):
+                    if node not in users[writer]:
+                        deps[node].add(writer)
+                        users[writer].append(node)
+
+        ready = [(node.index, node) for node in nodes if not deps[node]]
+        heapq.heapify(ready)
+        res = []
+        while ready:
+            _, node = heapq.heappop(ready)
+            res.append(node)
+            for user in users[node]:
+                deps[user].discard(node)
+                if not deps[user]:
+                    heapq.heappush(ready, (user.index, user))
+
+        if len(res) != len(nodes):
+            raise ValueError('The render graph has a dependency cycle')
+        return res, writers
+
+    def _compile(self, renderer):
+        nodes = [node for node in self._passes if node.pass_.enabled]
+        ordered, writers = self._sorted(nodes)
+
+        # Walk back from the outputs to find the needed passes
+        alive = set(node for node in ordered
+                    if node.writes is None or set(node.writes.values()) & self.outputs)
+        stack = list(alive)
+        while stack:
+            node = stack.pop()
+            for name in node.reads.values():
+                for writer in writers.get(name, []):
+                    if writer not in alive:
+                        alive.add(writer)
+                        stack.append(writer)
+
+        schedule = [node for node in ordered if node in alive]
+        self.culled = [node.pass_ for node in ordered if node not in alive]
+
+        # Lifetime of the transient targets, in schedule steps
+        first = {}
+        last = {}
+        for step, node in enumerate(schedule):
+            for names in (node.reads.values(), (node.writes or {}).values()):
+                for name in names:
+                    if name in self._targets:
+                        first.setdefault(name, step)
+                        last[name] = step
+        # The outputs are used after the graph, so they are never aliased
+        for name in self.outputs:
+            if name in last:
+                last[name] = len(schedule)
+        for step, node in enumerate(schedule):
+            for name in node.reads.values():
+                if name in self._targets and first[name] == step:
+                    raise ValueError('\'%s\' is read by \'%s\' before being written' %
+                                     (name, node.pass_.name))
+
+        # Allocate the targets : a texture is reused once the lifetime of
+        # its previous target ended
+        available = self._pool
+        self._pool = {}
+        physical = []
+        self.textures = dict(self._imported)
+        for name in sorted(first, key=lambda name: first[name]):
+            key = self._targets[name].key(renderer)
+            for entry in physical:
+                if entry[0] == key and entry[2] < first[name]:
+                    break
+            else:
+                stock = available.get(key)
+                if stock:
+                    tex = stock.pop()
+                else:
+                    fmt, size, filtering = key
+                    tex = Texture2D(None, size[0], size[1], format=fmt, filtering=filtering)
+                entry = [key, tex, None]
+                physical.append(entry)
+                self._pool.setdefault(key, []).append(tex)
+            entry[2] = last[name]
+            self.textures[name] = entry[1]
+
+        # Release the pooled textures the new schedule does not use
+        for stock in available.itervalues():
+            for tex in stock:
+                tex.delete()
+
+        # Bind the passes to their targets
+        fbos = {}
+        for node in schedule:
+            for uniform, name in node.reads.iteritems():
+                node.material.set(uniform, self.textures[name])
+            if node.writes is None:
+                continue
+            if RenderGraph.BACKBUFFER in node.writes.values():
+                node.pass_.fbo = None
+                continue
+
+            attachments = dict((attach, self.textures[name])
+                               for attach, name in node.writes.iteritems())
+            key = tuple(sorted(attachments.iteritems()))
+            fbo = fbos.get(key) or self._fbos.get(key)
+            if fbo is None:
+                fbo = FBO(**attachments)
+            fbos[key] = node.pass_.fbo = fbo
+        for key, fbo in self._fbos.iteritems():
+            if key not in fbos:
+                fbo.delete()
+        self._fbos = fbos
+
+        logging.info('Render graph : %d passes (%d skipped), %d targets on %d textures',
+                     len(schedule), len(self.culled), len(first), len(physical))
+        return [node.pass_ for node in schedule]
+
+    def schedule(self, renderer):
+        """ Return the passes to render this frame, in order. The graph is
+        compiled again when the passes, their enabled flags, the outputs or
+        the renderer size changed.
+        """
+        key = (tuple(node.pass_.enabled for node in self._passes),
+               frozenset(self.outputs), renderer.width, renderer.height)
+        if key != self._key:
+            self._schedule = self._compile(renderer)
+            self._key = key
+        return self._schedule
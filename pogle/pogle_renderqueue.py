@@ -0,0 +1,168 @@
+import weakref
+
+import numpy as np
+
+__author__ = 'Clement JACOB'
+__copyright__ = "Copyright 2013, The Python OpenGL Engine"
+__license__ = "Closed Source"
+__version__ = "0.0.1"
+__email__ = "clems71@gmail.com"
+__status__ = "Prototype"
+
+
+class SortKeyIds(object):
+    """ Small integer ids given to objects (shaders, materials, ...), to be
+    packed in a sort key field. 0 is reserved for None.
+
+    When more objects than the field can hold are registered, ids wrap
+    around : ordering stays valid, only grouping gets worse.
+    """
+    def __init__(self, bits):
+        self._mask = (1 << bits) - 1
+        self._next = 1
+        self._ids = weakref.WeakKeyDictionary()
+        self._strong_ids = {}
+
+    def __call__(self, obj):
+        if obj is None:
+            return 0
+
+        try:
+            ids = self._ids
+            val = ids.get(obj)
+        except TypeError:
+            # Not weak referenceable
+            ids = self._strong_ids
+            val = ids.get(obj)
+
+        if val is None:
+            val = ids[obj] = self._next
+            self._next += 1
+            if self._next > self._mask:
+                self._next = 1
+        return val
+
+
+class SortKeyLayout(object):
+    """ The layout of a packed 64-bit sort key : a list of (name, bits)
+    fields, from the most significant to the least significant one.
+
+    Sorting the keys orders draws by the first field, then the second, and
+    so on. The default layout is DEFAULT_FIELDS.
+    """
+    DEFAULT_FIELDS = [
+        ('pass', 4),
+        ('blend', 1),
+        ('shader', 12),
+        ('material', 16),
+        ('geometry', 16),
+        ('depth', 15),
+    ]
+
+    def __init__(self, fields=None):
+        """
+        fields -- A list of (name, bits), most significant first, of 64 bits
+                  at most
+        """
+        if fields is None:
+            fields = SortKeyLayout.DEFAULT_FIELDS
+
+        self.fields = list(fields)
+        self._shifts = {}
+        self._bits = {}
+
+        shift = 64
+        for name, bits in self.fields:
+            shift -= bits
+            self._shifts[name] = shift
+            self._bits[name] = bits
+
+        if shift < 0:
+            raise ValueError('The sort key fields take %d bits, 64 at most' %
+                             (64 - shift))
+
+        self._ids = {}
+
+    def bits(self, name):
+        return self._bits[name]
+
+    def shift(self, name):
+        return self._shifts[name]
+
+    def mask(self, name):
+        """ The mask of a field, once shifted in place
+        """
+        return ((1 << self._bits[name]) - 1) << self._shifts[name]
+
+    def id_of(self, name, obj):
+        """ A stable small integer for obj, fitting in the field name
+        """
+        ids = self._ids.get(name)
+        if ids is None:
+            ids = self._ids[name] = SortKeyIds(self._bits[name])
+        return ids(obj)
+
+    def quantize(self, name, vals, lo, hi):
+        """ Map the values in [lo, hi] onto the integer range of a field
+        """
+        top = (1 << self._bits[name]) - 1
+        scale = top / float(hi - lo) if hi > lo else 0.0
+        vals = (np.asarray(vals, dtype=np.float64) - lo) * scale
+        return np.clip(vals, 0, top).astype(np.uint64)
+
+    def pack(self, **values):
+        """ Pack a single key. Missing fields are 0.
+        """
+        key = 0
+        for name, val in values.iteritems():
+            key |= (int(val) & ((1 << self._bits[name]) - 1)) << self._shifts[name]
+        return key
+
+    def pack_arrays(self, count, **arrays):
+        """ Pack count keys into an uint64 array, from one array (or scalar)
+        per field. Missing fields are 0.
+        """
+        keys = np.zeros(count, dtype=np.uint64)
+        for name, vals in arrays.iteritems():
+            vals = np.asarray(vals).astype(np.uint64) & \
+                np.uint64((1 << self._bits[name]) - 1)
+            keys |= vals << np.uint64(self._shifts[name])
+        return keys
+
+    def unpack(self, key):
+        """ Return the fields of a key as a dict
+        """
+        key = int(key)
+        return dict((name, (key >> self._shifts[name]) & ((1 << bits) - 1))
+                    for name, bits in self.fields)
+
+
+SortKeyLayout.DEFAULT = SortKeyLayout()
+
+
+class RenderQueue(object):
+    """ Draw items ordered by their packed sort keys, so that state changes
+    are minimized over the whole queue
+    """
+    def __init__(self, layout=None):
+        self.layout = SortKeyLayout.DEFAULT if layout is None else layout
+        self.items = []
+        self.keys = np.zeros(0, dtype=np.uint64)
+
+    def build(self, items, **fields):
+        """ Sort the items
+
+        items -- The draw items
+        fields -- One array (or scalar) of values per sort key field
+        """
+        keys = self.layout.pack_arrays(len(items), **fields)
+        order = np.argsort(keys, kind='stable')
+        self.items = [items[i] for i in order]
+        self.keys = keys[order]
+        return self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
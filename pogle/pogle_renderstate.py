@@ -0,0 +1,163 @@
+from pogle_opengl import *
+
+__author__ = 'Clement JACOB'
+__copyright__ = "Copyright 2013, The Python OpenGL Engine"
+__license__ = "Closed Source"
+__version__ = "0.0.1"
+__email__ = "clems71@gmail.com"
+__status__ = "Prototype"
+
+
+def _capability(flag):
+    def apply(val):
+        if val:
+            glEnable(flag)
+        else:
+            glDisable(flag)
+    return apply
+
+
+def _set_polygon_offset(val):
+    if val is None:
+        glDisable(GL_POLYGON_OFFSET_FILL)
+    else:
+        glEnable(GL_POLYGON_OFFSET_FILL)
+        glPolygonOffset(val[0], val[1])
+
+
+def _set_scissor(val):
+    if val is None:
+        glDisable(GL_SCISSOR_TEST)
+    else:
+        glEnable(GL_SCISSOR_TEST)
+        glScissor(*val)
+
+
+class RenderState(object):
+    """ An immutable (and hashable) set of render state values. Categories
+    which are not given take their default value.
+
+    States are meant to be created once (per pass or material). Switching
+    from a state to another one only issues the GL calls of the categories
+    which differ, and these differences are computed once per pair of
+    states.
+
+    New categories are added with RenderState.register().
+    """
+    _categories = []
+    _defaults = {}
+    _appliers = {}
+
+    # (from, to) -> [(applier, value)], and (base, over) -> merged state
+    _diffs = {}
+    _merges = {}
+
+    @staticmethod
+    def register(name, default, apply):
+        """ Add a state category
+
+        name -- The name of the category
+        default -- Its value when not given
+        apply -- A function applying a value of the category
+        """
+        if name in RenderState._appliers:
+            raise ValueError('The render state \'%s\' already exists' % name)
+        RenderState._categories.append(name)
+        RenderState._defaults[name] = default
+        RenderState._appliers[name] = apply
+        RenderState._diffs.clear()
+
+    def __init__(self, values=None, **kwargs):
+        """
+        values -- A dict of category -> value
+        kwargs -- More category values
+        """
+        specified = dict(values or {}, **kwargs)
+        for name in specified:
+            if name not in RenderState._appliers:
+                raise ValueError('Unknown render state \'%s\'' % name)
+        self._specified = specified
+        self._key = tuple(sorted(specified.iteritems()))
+        self._hash = hash(self._key)
+
+    @staticmethod
+    def of(val):
+        """ Return val as a RenderState (from a dict, or None for the
+        default state)
+        """
+        if isinstance(val, RenderState):
+            return val
+        if val is None:
+            return RenderState.DEFAULT
+        return RenderState(val)
+
+    def __getitem__(self, name):
+        return self._specified.get(name, RenderState._defaults[name])
+
+    def get(self, name, default=None):
+        if name in self._specified:
+            return self._specified[name]
+        return RenderState._defaults.get(name, default)
+
+    def items(self):
+        return [(name, self[name]) for name in RenderState._categories]
+
+    def __eq__(self, other):
+        return isinstance(other, RenderState) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return 'RenderState(%r)' % self._specified
+
+    def merged(self, other):
+        """ This state, with the values given in other overriding its own
+        """
+        if other is None or len(other._specified) == 0:
+            return self
+
+        key = (self, other)
+        res = RenderState._merges.get(key)
+        if res is None:
+            res = RenderState(self._specified, **other._specified)
+            RenderState._merges[key] = res
+        return res
+
+    @staticmethod
+    def diff(frm, to):
+        """ The (apply, value) calls switching from the state frm (None if
+        unknown) to the state to
+        """
+        key = (frm, to)
+        calls = RenderState._diffs.get(key)
+        if calls is None:
+            calls = []
+            for name in RenderState._categories:
+                val = to[name]
+                if frm is None or frm[name] != val:
+                    calls.append((RenderState._appliers[name], val))
+            RenderState._diffs[key] = calls
+        return calls
+
+
+RenderState.register('blending', False, _capability(GL_BLEND))
+RenderState.register('culling', True, _capability(GL_CULL_FACE))
+RenderState.register('depth_test', True, _capability(GL_DEPTH_TEST))
+RenderState.register('depthfunc', GL_LESS, glDepthFunc)
+RenderState.register('depthmask', True, glDepthMask)
+RenderState.register('blendfunc', (GL_ONE, GL_ZERO), lambda val: glBlendFunc(val[0], val[1]))
+RenderState.register('blendequ', GL_FUNC_ADD, glBlendEquation)
+RenderState.register('pointsize', 1.0, glPointSize)
+RenderState.register('colormask', (True, True, True, True), lambda val: glColorMask(*val))
+RenderState.register('stencil_test', False, _capability(GL_STENCIL_TEST))
+RenderState.register('stencilfunc', (GL_ALWAYS, 0, 0xFF), lambda val: glStencilFunc(*val))
+RenderState.register('stencilop', (GL_KEEP, GL_KEEP, GL_KEEP), lambda val: glStencilOp(*val))
+RenderState.register('stencilmask', 0xFF, glStencilMask)
+RenderState.register('polygon_offset', None, _set_polygon_offset)
+RenderState.register('scissor', None, _set_scissor)
+
+RenderState.DEFAULT = RenderState()
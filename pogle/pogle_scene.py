@@ -1,4 +1,7 @@
-from pogle_math import Vector, Matrix4x4, Transform
+from collections import OrderedDict
+
+from pogle_math import Vector, Matrix4x4, Transform, TransformGraph, TransformHandle
+from pogle_bvh import BVH
 
 __author__ = 'Clement JACOB'
 __copyright__ = "Copyright 2013, The Python OpenGL Engine"
@@ -43,14 +46,49 @@ class Scene(object):
 	Basically, it contains a root node to be rendered, a camera and 
 	0 to 3 directional lights.
 	"""
-	def __init__(self, camera=None):
+
+	# The spatial index is rebuilt when its cost grew by this ratio
+	REBUILD_RATIO = 1.5
+
+	def __init__(self, camera=None, transform_graph=None, spatial_index=False):
+		"""
+		transform_graph -- If True or a TransformGraph, the transforms of the
+		                   added nodes are stored in this flattened graph, and
+		                   all world matrices are updated in a single pass.
+		                   The Transform of an added node (and its ancestors)
+		                   is copied into the graph, and node.transform is
+		                   replaced by its handle : later changes must go
+		                   through node.transform, changing the former
+		                   Transform objects has no effect on the node.
+		spatial_index -- If True, the world bounds of the geometry nodes are
+		                 kept in a BVH, used by the query_* methods and by the
+		                 renderer culling
+		"""
 		if camera is None:
 			camera = Camera()
 
+		if transform_graph is True:
+			transform_graph = TransformGraph()
+
 		self.passes = []
 		self.camera = camera
 		self.lights = []
-		self._nodes = []
+		self._nodes = OrderedDict()
+		self.transform_graph = transform_graph
+
+		# The graph handles adopted for the nodes transforms : handle ->
+		# [nodes and child handles using it, parent handle]. They are
+		# removed from the graph once unused.
+		self._graph_refs = {}
+
+		# Flag bit -> nodes having it (node -> insertion number)
+		self._flag_index = {}
+		self._node_count = 0
+
+		self.spatial_index = BVH() if spatial_index else None
+		self._indexed = {}
+		self._moved = set()
+		self._graph_stamp = 0
 
 	def register_pass(self, pass_):
 		assert pass_ not in self.passes
@@ -63,9 +101,21 @@ class Scene(object):
 	def add_node(self, node):
 		assert node.scene == None, 'The node is already attached to a scene'
 		
-		self._nodes.append(node)
+		if self.transform_graph is not None:
+			owned = not isinstance(node.transform, TransformHandle)
+			node.transform = self.transform_graph.adopt(node.transform)
+			if owned:
+				self._retain_transform(node.transform)
+
+		self._nodes[node] = None
 		node.scene = self
-		self.mark_renderlist_as_dirty()
+		node._scene_number = self._node_count
+		self._node_count += 1
+		self._index_flags(node, node.flags)
+		if self.spatial_index is not None:
+			self._index_node(node)
+		for p in self.passes:
+			p.node_added(node)
 
 	def mark_renderlist_as_dirty(self):
 		for p in self.passes:
@@ -74,9 +124,143 @@ class Scene(object):
 	def remove_node(self, node):
 		assert node.scene == self, 'The node is not attached to this scene'
 
-		self._nodes.remove(node)
+		del self._nodes[node]
 		node.scene = None
-		self.mark_renderlist_as_dirty()
+		self._unindex_flags(node, node.flags)
+		if self.spatial_index is not None and node in self.spatial_index:
+			self._unindex_node(node)
+		for p in self.passes:
+			p.node_removed(node)
+
+		# Back to a plain Transform, so that the node can join another scene
+		handle = node.transform
+		if handle in self._graph_refs:
+			node.transform = handle.detached()
+			self._release_transform(handle)
+
+	def _retain_transform(self, handle):
+		ref = self._graph_refs.get(handle)
+		if ref is None:
+			parent = handle.parent
+			ref = self._graph_refs[handle] = [0, parent]
+			if parent is not None:
+				self._retain_transform(parent)
+		ref[0] += 1
+
+	def _release_transform(self, handle):
+		ref = self._graph_refs[handle]
+		ref[0] -= 1
+		if ref[0] == 0:
+			del self._graph_refs[handle]
+			self.transform_graph.remove(handle)
+			if ref[1] is not None:
+				self._release_transform(ref[1])
+
+	@staticmethod
+	def _bits(flags):
+		while flags:
+			bit = flags & -flags
+			yield bit
+			flags ^= bit
+
+	def _index_flags(self, node, flags):
+		for bit in Scene._bits(flags):
+			nodes = self._flag_index.get(bit)
+			if nodes is None:
+				nodes = self._flag_index[bit] = OrderedDict()
+			nodes[node] = node._scene_number
+
+	def _unindex_flags(self, node, flags):
+		for bit in Scene._bits(flags):
+			del self._flag_index[bit][node]
+
+	def node_flags_changed(self, node, oldflags):
+		""" Called by the nodes of this scene when their flags change
+		"""
+		self._unindex_flags(node, oldflags & ~node.flags)
+		self._index_flags(node, node.flags & ~oldflags)
+		if (oldflags ^ node.flags) & SceneNode.NODE_HAS_GEOMETRY:
+			for p in self.passes:
+				p.node_removed(node)
+				p.node_added(node)
+
+	def node_material_changed(self, node):
+		""" Called by the nodes of this scene when their material changes
+		"""
+		for p in self.passes:
+			p.node_material_changed(node)
+
+	def _index_node(self, node):
+		aabb = getattr(node, 'world_aabb', None)
+		if aabb is None:
+			return
+
+		self.spatial_index.insert(node, aabb.min, aabb.max)
+
+		# Transforms report themselves when they change. Graph transforms
+		# are found from the graph update stamps.
+		tf = node.transform
+		self._indexed.setdefault(tf, []).append(node)
+		if isinstance(tf, Transform):
+			tf.add_listener(self._moved.add)
+
+	def _unindex_node(self, node):
+		self.spatial_index.remove(node)
+
+		tf = node.transform
+		nodes = self._indexed[tf]
+		nodes.remove(node)
+		if len(nodes) == 0:
+			del self._indexed[tf]
+			if isinstance(tf, Transform):
+				tf.remove_listener(self._moved.add)
+
+	def update_spatial_index(self):
+		""" Refit the bounds of the nodes which moved since the last call,
+		and rebuild the index when refits degraded it too much. The query_*
+		methods call it for you.
+		"""
+		index = self.spatial_index
+		assert index is not None, 'The scene has no spatial index'
+
+		moved = set(self._moved)
+		self._moved.clear()
+		if self.transform_graph is not None:
+			moved.update(self.transform_graph.updated_since(self._graph_stamp))
+			self._graph_stamp = self.transform_graph.stamp
+
+		for tf in moved:
+			for node in self._indexed.get(tf, ()):
+				aabb = node.world_aabb
+				index.update(node, aabb.min, aabb.max)
+
+		if index.cost() > Scene.REBUILD_RATIO * index.rebuild_cost:
+			index.rebuild()
+
+	def query_frustum(self, frustum):
+		""" The indexed nodes which are (potentially) visible in the frustum
+		"""
+		self.update_spatial_index()
+		return self.spatial_index.query_frustum(frustum)
+
+	def query_aabb(self, aabb):
+		""" The indexed nodes whose world AABB overlaps aabb
+		"""
+		self.update_spatial_index()
+		return self.spatial_index.query_aabb(aabb.min, aabb.max)
+
+	def query_sphere(self, center, radius):
+		""" The indexed nodes whose world AABB overlaps the sphere
+		"""
+		self.update_spatial_index()
+		return self.spatial_index.query_sphere(center, radius)
+
+	def raycast(self, origin, direction, max_distance=float('inf')):
+		""" Return (node, distance) for the first indexed node whose world
+		AABB is hit by the ray, or None
+		"""
+		self.update_spatial_index()
+		return self.spatial_index.raycast(origin, direction, max_distance)
 
 
 	def add_light(self, light):
@@ -87,27 +271,32 @@ class Scene(object):
 
 		flag -- The flag that must be present on all nodes returned
 		"""
-		match = []
-		for n in self._nodes:
-			if n.has_flag(flag):
-				match.append(n)
-		return match
+		return list(self.get_nodes_i(flag))
 
 	def get_nodes_i(self, flag):
 		""" A generator method returning all nodes having the flag 'flag'
 
 		flag -- The flag that must be present on all nodes returned
 		"""
-		for n in self._nodes:
-			if n.has_flag(flag):
+		bits = list(Scene._bits(flag))
+		if len(bits) == 1:
+			for n in self._flag_index.get(bits[0], ()):
 				yield n
+			return
+
+		# Several bits (any of them matches) : merge in insertion order
+		match = {}
+		for bit in bits:
+			match.update(self._flag_index.get(bit, {}))
+		for n in sorted(match, key=match.get):
+			yield n
 
 	def __len__(self):
 		return len(self._nodes)
 
 	@property
 	def nodes(self):
-		return self._nodes
+		return list(self._nodes)
 
 class SceneNode(object):
 	NODE_HAS_GEOMETRY = 1
@@ -116,7 +305,8 @@ class SceneNode(object):
 	"""
 	def __init__(self, transform=None, flags=0x00000000):
 		self.name = ''
-		self.flags = flags
+		self.scene = None
+		self._flags = flags
 
 		# Trick to avoid the one default arg instanciation for all
 		# If the default arg == Tranform(), every node which doesn't
@@ -126,7 +316,18 @@ class SceneNode(object):
 			transform = Transform()
 
 		self.transform = transform
-		self.scene = None
+
+	@property
+	def flags(self):
+		return self._flags
+
+	@flags.setter
+	def flags(self, val):
+		oldflags = self._flags
+		if val != oldflags:
+			self._flags = val
+			if self.scene is not None:
+				self.scene.node_flags_changed(self, oldflags)
 
 	def has_flag(self, flag):
-		return (self.flags & flag) != 0
+		return (self._flags & flag) != 0
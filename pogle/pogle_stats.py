@@ -1,3 +1,5 @@
+from collections import deque
+
 __author__ = 'Clement JACOB'
 __copyright__ = "Copyright 2013, The Python OpenGL Engine"
 __license__ = "Closed Source"
@@ -7,13 +9,77 @@ __status__ = "Prototype"
 
 class Stats(object):
 	drawcalls = 0
+	instances = 0
+	objects = 0
+	samples = 0
+	transforms_updated = 0
+	culled = 0
+	uniforms_issued = 0
+	uniforms_skipped = 0
+
+	# Per pass timings of the frame, in milliseconds. The GPU times are the
+	# ones of an older frame, read back a few frames later (see GPUTimer).
+	cpu_times = {}
+	gpu_times = {}
+
+	# Rolling per pass history of the timings, kept by clear()
+	HISTORY_SIZE = 120
+	cpu_history = {}
+	gpu_history = {}
+
+	@staticmethod
+	def _push(history, times):
+		for name, ms in times.iteritems():
+			if name not in history:
+				history[name] = deque(maxlen=Stats.HISTORY_SIZE)
+			history[name].append(ms)
+
+	@staticmethod
+	def set_cpu_times(times):
+		""" Record the CPU times of a frame, a dict of pass name -> ms
+		"""
+		Stats.cpu_times = times
+		Stats._push(Stats.cpu_history, times)
+
+	@staticmethod
+	def set_gpu_times(times):
+		""" Record the GPU times of a frame, a dict of pass name -> ms
+		"""
+		Stats.gpu_times = times
+		Stats._push(Stats.gpu_history, times)
+
+	@staticmethod
+	def average(name, gpu=True):
+		""" Average time of a pass over its history, None if never timed
+		"""
+		history = (Stats.gpu_history if gpu else Stats.cpu_history).get(name)
+		if not history:
+			return None
+		return sum(history) / len(history)
 
 	@staticmethod
 	def clear():
 		Stats.drawcalls = 0
+		Stats.instances = 0
+		Stats.objects = 0
+		Stats.samples = 0
+		Stats.transforms_updated = 0
+		Stats.culled = 0
+		Stats.uniforms_issued = 0
+		Stats.uniforms_skipped = 0
 
 	def __repr__(self):
 		r = ''
 		r += 'DRAWCALLS = %d\n' % Stats.drawcalls
+		r += 'INSTANCES = %d\n' % Stats.instances
+		r += 'OBJECTS = %d\n' % Stats.objects
+		r += 'SAMPLES = %d\n' % Stats.samples
+		r += 'TRANSFORMS UPDATED = %d\n' % Stats.transforms_updated
+		r += 'CULLED = %d\n' % Stats.culled
+		r += 'UNIFORMS ISSUED = %d\n' % Stats.uniforms_issued
+		r += 'UNIFORMS SKIPPED = %d\n' % Stats.uniforms_skipped
+		for name in sorted(set(Stats.cpu_times) | set(Stats.gpu_times)):
+			r += 'PASS %s : CPU = %.3f ms, GPU = %.3f ms\n' % (
+				name, Stats.cpu_times.get(name, 0.0), Stats.gpu_times.get(name, 0.0))
 		return r
 		
\ No newline at end of file